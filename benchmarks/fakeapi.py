@@ -0,0 +1,452 @@
+"""Minimal in-memory kubernetes API server for benchmarks.
+
+Serves the resources the controller works with: StorageClasses, PVCs, PVs,
+Pods, Nodes, Namespaces, ConfigMaps and Events. Supports list, watch (with resourceVersion
+and label selectors), get, create (including generateName), replace,
+merge patch and delete (honouring finalizers). Anything else, like the kopf
+peering resources, is answered with 404.
+
+Instead of a kubelet and the PV controller, the server simulates:
+
+- dataset pods going from Pending to Running to Succeeded (or Failed)
+  after the configured latencies
+- binding PVCs to the PVs that claim them
+
+It is not a conformant API server, only good enough to drive the controller.
+"""
+import asyncio
+import collections
+import copy
+import datetime
+import json
+import logging
+import random
+import uuid
+
+import aiohttp.web
+
+from zfs_provisioner import fakezfs
+
+log = logging.getLogger('zfs-provisioner.fakeapi')
+
+
+Resource = collections.namedtuple('Resource', ('group', 'version', 'plural', 'kind', 'namespaced'))
+
+RESOURCES = [
+    Resource('', 'v1', 'namespaces', 'Namespace', False),
+    Resource('', 'v1', 'nodes', 'Node', False),
+    Resource('', 'v1', 'pods', 'Pod', True),
+    Resource('', 'v1', 'events', 'Event', True),
+    Resource('', 'v1', 'configmaps', 'ConfigMap', True),
+    Resource('', 'v1', 'persistentvolumeclaims', 'PersistentVolumeClaim', True),
+    Resource('', 'v1', 'persistentvolumes', 'PersistentVolume', False),
+    Resource('storage.k8s.io', 'v1', 'storageclasses', 'StorageClass', False),
+]
+
+RESOURCES_BY_PATH = {(r.group, r.version, r.plural): r for r in RESOURCES}
+
+# Number of events kept to serve watches that start at an older resourceVersion.
+HISTORY_SIZE = 100000
+
+
+class ApiError(Exception):
+
+    def __init__(self, status, reason, message):
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+        self.message = message
+
+    def response(self):
+        return aiohttp.web.json_response({
+            'kind': 'Status', 'apiVersion': 'v1', 'metadata': {},
+            'status': 'Failure', 'message': self.message,
+            'reason': self.reason, 'code': self.status,
+        }, status=self.status)
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def merge_patch(target, patch):
+    """Apply the RFC 7386 merge patch to target and return the result.
+    """
+    if not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+    if not isinstance(target, dict):
+        target = {}
+    for key,value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        else:
+            target[key] = merge_patch(target.get(key, None), value)
+    return target
+
+
+def label_selector(selector):
+    """Return a predicate for the labels of objects matching the label selector.
+    Supports `key=value`, `key==value`, `key!=value`, `key` and `!key`.
+    """
+    requirements = []
+    for term in filter(None, (selector or '').split(',')):
+        term = term.strip()
+        if '!=' in term:
+            key, value = term.split('!=', 1)
+            requirements.append(lambda labels, k=key, v=value: labels.get(k, None) != v)
+        elif '=' in term:
+            key, value = term.replace('==', '=').split('=', 1)
+            requirements.append(lambda labels, k=key, v=value: labels.get(k, None) == v)
+        elif term.startswith('!'):
+            requirements.append(lambda labels, k=term[1:]: k not in labels)
+        else:
+            requirements.append(lambda labels, k=term: k in labels)
+    return lambda labels: all(requirement(labels) for requirement in requirements)
+
+
+class Store():
+    """Objects of all resources with a cluster wide resourceVersion.
+    """
+
+    def __init__(self):
+        # Map of (resource, namespace, name) to object.
+        self.objects = {}
+        self.resource_version = 0
+        self.history = collections.deque(maxlen=HISTORY_SIZE)
+        # Queues of the running watches with the resource, namespace and
+        # label predicate they watch.
+        self.watches = []
+        # Functions called with (event_type, resource, object) on every change.
+        self.listeners = []
+
+    def _notify(self, event_type, resource, obj):
+        self.resource_version += 1
+        obj['metadata']['resourceVersion'] = str(self.resource_version)
+        event = (self.resource_version, resource, event_type, copy.deepcopy(obj))
+        self.history.append(event)
+        for watch in self.watches:
+            self._offer(watch, event)
+        for listener in self.listeners:
+            listener(event_type, resource, obj)
+
+    @staticmethod
+    def _matches(watch, event):
+        resource, namespace, predicate, queue = watch
+        _, event_resource, _, obj = event
+        return (event_resource == resource
+            and (namespace is None or obj['metadata'].get('namespace', None) == namespace)
+            and predicate(obj['metadata'].get('labels', None) or {}))
+
+    def _offer(self, watch, event):
+        if self._matches(watch, event):
+            watch[3].put_nowait(event)
+
+    def _key(self, resource, namespace, name):
+        return (resource, namespace if resource.namespaced else None, name)
+
+    def get(self, resource, namespace, name):
+        try:
+            return self.objects[self._key(resource, namespace, name)]
+        except KeyError:
+            raise ApiError(404, 'NotFound', f'{resource.plural} "{name}" not found')
+
+    def list(self, resource, namespace=None, selector=None):
+        predicate = label_selector(selector)
+        return [obj for (r,ns,_),obj in self.objects.items()
+            if r == resource and (namespace is None or ns == namespace)
+            and predicate(obj['metadata'].get('labels', None) or {})]
+
+    def create(self, resource, namespace, obj):
+        obj = copy.deepcopy(obj)
+        metadata = obj.setdefault('metadata', {})
+        if not metadata.get('name', None):
+            if not metadata.get('generateName', None):
+                raise ApiError(422, 'Invalid', 'name or generateName is required')
+            metadata['name'] = metadata['generateName'] + uuid.uuid4().hex[:5]
+        key = self._key(resource, namespace, metadata['name'])
+        if key in self.objects:
+            raise ApiError(409, 'AlreadyExists', f'{resource.plural} "{metadata["name"]}" already exists')
+        if resource.namespaced:
+            metadata['namespace'] = namespace
+        metadata['uid'] = str(uuid.uuid4())
+        metadata['creationTimestamp'] = _now()
+        obj['apiVersion'] = f'{resource.group}/{resource.version}'.lstrip('/')
+        obj['kind'] = resource.kind
+        self.objects[key] = obj
+        self._notify('ADDED', resource, obj)
+        return obj
+
+    def replace(self, resource, namespace, name, obj):
+        current = self.get(resource, namespace, name)
+        obj = copy.deepcopy(obj)
+        obj['metadata'] = merge_patch(copy.deepcopy(current['metadata']), obj.get('metadata', {}))
+        self.objects[self._key(resource, namespace, name)] = obj
+        return self._changed(resource, namespace, name, obj)
+
+    def patch(self, resource, namespace, name, patch):
+        obj = self.get(resource, namespace, name)
+        merge_patch(obj, patch)
+        return self._changed(resource, namespace, name, obj)
+
+    def _changed(self, resource, namespace, name, obj):
+        if obj['metadata'].get('deletionTimestamp', None) and not obj['metadata'].get('finalizers', None):
+            del self.objects[self._key(resource, namespace, name)]
+            self._notify('DELETED', resource, obj)
+        else:
+            self._notify('MODIFIED', resource, obj)
+        return obj
+
+    def delete(self, resource, namespace, name):
+        obj = self.get(resource, namespace, name)
+        if obj['metadata'].get('finalizers', None):
+            if not obj['metadata'].get('deletionTimestamp', None):
+                obj['metadata']['deletionTimestamp'] = _now()
+                self._notify('MODIFIED', resource, obj)
+            return obj
+        del self.objects[self._key(resource, namespace, name)]
+        self._notify('DELETED', resource, obj)
+        return obj
+
+    def watch(self, resource, namespace=None, selector=None, resource_version=None):
+        """Return a queue of (resource_version, resource, event_type, object)
+        events and a function that stops the watch.
+        """
+        watch = (resource, namespace, label_selector(selector), asyncio.Queue())
+        if resource_version:
+            for event in self.history:
+                if event[0] > int(resource_version):
+                    self._offer(watch, event)
+        self.watches.append(watch)
+        return watch[3], lambda: self.watches.remove(watch)
+
+
+class Cluster():
+    """Simulate the parts of kubernetes the controller relies on.
+
+    `pod_start` and `pod_run` are latency distribution specs, as used by
+    `fakezfs`, of the time a pod takes to start and to run to completion.
+    """
+
+    def __init__(self, store, pod_start='const:0.5', pod_run='const:0.1',
+            pod_failures=0, seed=None):
+        self.store = store
+        self.random = random.Random(seed)
+        self.pod_start = fakezfs.distribution(pod_start)
+        self.pod_run = fakezfs.distribution(pod_run)
+        self.pod_failures = pod_failures
+        self.tasks = set()
+        store.listeners.append(self.on_change)
+
+    def resource(self, plural, group=''):
+        return RESOURCES_BY_PATH[(group, 'v1', plural)]
+
+    def _spawn(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def on_change(self, event_type, resource, obj):
+        if event_type != 'ADDED':
+            return
+        if resource.plural == 'pods':
+            self._spawn(self.run_pod(obj['metadata']['namespace'], obj['metadata']['name']))
+        elif resource.plural == 'persistentvolumes' and obj['spec'].get('claimRef', None):
+            self._spawn(self.bind(obj))
+
+    async def run_pod(self, namespace, name):
+        pods = self.resource('pods')
+        try:
+            self.store.patch(pods, namespace, name, {'status': {'phase': 'Pending'}})
+            await asyncio.sleep(self.pod_start(self.random))
+            self.store.patch(pods, namespace, name, {'status': {'phase': 'Running'}})
+            await asyncio.sleep(self.pod_run(self.random))
+            phase = 'Failed' if self.random.random() < self.pod_failures else 'Succeeded'
+            self.store.patch(pods, namespace, name, {'status': {'phase': phase}})
+        except ApiError:
+            # The pod was deleted in the meantime.
+            pass
+
+    async def bind(self, pv):
+        claim = pv['spec']['claimRef']
+        name = pv['metadata']['name']
+        self.store.patch(self.resource('persistentvolumes'), None, name, {'status': {'phase': 'Bound'}})
+        try:
+            self.store.patch(self.resource('persistentvolumeclaims'), claim['namespace'], claim['name'], {
+                'spec': {'volumeName': name},
+                'status': {'phase': 'Bound'},
+            })
+        except ApiError:
+            log.warning('claim of persistent volume %s does not exist: %s', name, claim)
+
+    def add_node(self, name, address):
+        self.store.create(self.resource('nodes'), None, {
+            'metadata': {'name': name, 'labels': {'kubernetes.io/hostname': name}},
+            'status': {'addresses': [
+                {'type': 'InternalIP', 'address': address},
+                {'type': 'Hostname', 'address': name},
+            ]},
+        })
+
+
+def _parse_path(segments):
+    """Return the namespace, plural, name and subresource of the path segments
+    of a request below /api/v1 or /apis/<group>/<version>.
+    """
+    namespace = None
+    if len(segments) >= 3 and segments[0] == 'namespaces':
+        namespace, segments = segments[1], segments[2:]
+    plural, name, subresource = (segments + [None, None])[:3]
+    if len(segments) > 3:
+        raise ApiError(404, 'NotFound', 'the server could not find the requested resource')
+    return namespace, plural, name, subresource
+
+
+class Server():
+    """aiohttp application serving the store.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def make_app(self):
+        app = aiohttp.web.Application()
+        app.router.add_get('/api', self.handle_versions)
+        app.router.add_get('/apis', self.handle_groups)
+        app.router.add_get('/version', self.handle_version)
+        app.router.add_route('*', '/api/{version}', self.handle_resources)
+        app.router.add_route('*', '/apis/{group}/{version}', self.handle_resources)
+        app.router.add_route('*', '/api/{version}/{path:.*}', self.handle_request)
+        app.router.add_route('*', '/apis/{group}/{version}/{path:.*}', self.handle_request)
+        return app
+
+    async def handle_version(self, request):
+        return aiohttp.web.json_response({'major': '1', 'minor': '17', 'gitVersion': 'v1.17.0-fake'})
+
+    async def handle_versions(self, request):
+        return aiohttp.web.json_response({'kind': 'APIVersions', 'versions': ['v1']})
+
+    async def handle_groups(self, request):
+        groups = sorted({r.group for r in RESOURCES if r.group})
+        return aiohttp.web.json_response({'kind': 'APIGroupList', 'apiVersion': 'v1', 'groups': [{
+            'name': group,
+            'versions': [{'groupVersion': f'{group}/v1', 'version': 'v1'}],
+            'preferredVersion': {'groupVersion': f'{group}/v1', 'version': 'v1'},
+        } for group in groups]})
+
+    async def handle_resources(self, request):
+        group = request.match_info.get('group', '')
+        version = request.match_info['version']
+        resources = [r for r in RESOURCES if r.group == group and r.version == version]
+        if not resources:
+            return ApiError(404, 'NotFound', 'the server could not find the requested resource').response()
+        return aiohttp.web.json_response({
+            'kind': 'APIResourceList',
+            'groupVersion': f'{group}/{version}'.lstrip('/'),
+            'resources': [{
+                'name': r.plural, 'singularName': r.kind.lower(), 'kind': r.kind,
+                'namespaced': r.namespaced,
+                'verbs': ['create', 'delete', 'get', 'list', 'patch', 'update', 'watch'],
+            } for r in resources],
+        })
+
+    async def handle_request(self, request):
+        try:
+            group = request.match_info.get('group', '')
+            namespace, plural, name, subresource = _parse_path(
+                request.match_info['path'].strip('/').split('/'))
+            try:
+                resource = RESOURCES_BY_PATH[(group, request.match_info['version'], plural)]
+            except KeyError:
+                raise ApiError(404, 'NotFound', 'the server could not find the requested resource')
+            if name is None:
+                return await self.handle_collection(request, resource, namespace)
+            return await self.handle_object(request, resource, namespace, name)
+        except ApiError as e:
+            return e.response()
+
+    async def handle_collection(self, request, resource, namespace):
+        store = self.store
+        if request.method == 'POST':
+            obj = store.create(resource, namespace, await request.json())
+            return aiohttp.web.json_response(obj, status=201)
+        if request.method != 'GET':
+            raise ApiError(405, 'MethodNotAllowed', f'{request.method} is not supported')
+        selector = request.query.get('labelSelector', None)
+        if request.query.get('watch', 'false').lower() in ('true', '1'):
+            return await self.handle_watch(request, resource, namespace, selector)
+        return aiohttp.web.json_response({
+            'kind': f'{resource.kind}List',
+            'apiVersion': f'{resource.group}/{resource.version}'.lstrip('/'),
+            'metadata': {'resourceVersion': str(store.resource_version)},
+            'items': store.list(resource, namespace, selector),
+        })
+
+    async def handle_watch(self, request, resource, namespace, selector):
+        timeout = float(request.query.get('timeoutSeconds', 0)) or None
+        queue, stop = self.store.watch(resource, namespace, selector,
+            request.query.get('resourceVersion', None))
+        response = aiohttp.web.StreamResponse()
+        response.content_type = 'application/json'
+        await response.prepare(request)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout else None
+        try:
+            while True:
+                remaining = deadline - loop.time() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    break
+                try:
+                    _, _, event_type, obj = await asyncio.wait_for(queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                line = json.dumps({'type': event_type, 'object': obj}) + '\n'
+                await response.write(line.encode('utf-8'))
+        except (ConnectionResetError, asyncio.CancelledError):
+            pass
+        finally:
+            stop()
+        return response
+
+    async def handle_object(self, request, resource, namespace, name):
+        store = self.store
+        if request.method == 'GET':
+            obj = store.get(resource, namespace, name)
+        elif request.method == 'PUT':
+            obj = store.replace(resource, namespace, name, await request.json())
+        elif request.method == 'PATCH':
+            if request.content_type == 'application/json-patch+json':
+                raise ApiError(415, 'UnsupportedMediaType', 'json patches are not supported')
+            obj = store.patch(resource, namespace, name, await request.json())
+        elif request.method == 'DELETE':
+            obj = store.delete(resource, namespace, name)
+        else:
+            raise ApiError(405, 'MethodNotAllowed', f'{request.method} is not supported')
+        return aiohttp.web.json_response(obj)
+
+
+async def start(store, host='127.0.0.1', port=0):
+    """Serve the store on host:port and return the runner and the port.
+    Port 0 picks a free port.
+    """
+    runner = aiohttp.web.AppRunner(Server(store).make_app(), access_log=None)
+    await runner.setup()
+    site = aiohttp.web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, port
+
+
+def write_kubeconfig(path, url):
+    """Write a kubeconfig for the fake API server at url to path.
+    """
+    config = {
+        'apiVersion': 'v1',
+        'kind': 'Config',
+        'clusters': [{'name': 'fake', 'cluster': {'server': url}}],
+        'users': [{'name': 'fake', 'user': {'token': 'fake'}}],
+        'contexts': [{'name': 'fake', 'context': {'cluster': 'fake', 'user': 'fake'}}],
+        'current-context': 'fake',
+    }
+    with open(path, 'w') as f:
+        # json is valid yaml.
+        json.dump(config, f)
@@ -0,0 +1,235 @@
+"""Microbenchmarks of the code that runs for every PVC event.
+
+The filters run for the events of all PVCs in the cluster, not only the
+ones of our storage classes, so their cost scales with the cluster size.
+
+Results are compared against the stored baseline in
+benchmarks/baselines/hotpaths.json. Baselines are only comparable on the
+same machine, re-create them with --save before comparing a change.
+
+Usage: python -m benchmarks.hotpaths [--save] [--check] [--threshold RATIO]
+    [--baseline FILE] [--filter SUBSTRING]
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+import types
+
+from zfs_provisioner import cache
+from zfs_provisioner import datasetconfig
+from zfs_provisioner import datasets
+from zfs_provisioner import handlers
+from zfs_provisioner import manifests
+from zfs_provisioner import zfs
+
+from benchmarks.manifests import PV_VALUES
+
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'baselines', 'hotpaths.json')
+
+STORAGE_CLASS_BODY = {
+    'provisioner': 'zfs-provisioner',
+    'reclaimPolicy': 'Delete',
+    'volumeBindingMode': 'WaitForFirstConsumer',
+    'parameters': {'mode': 'local'},
+    'allowVolumeExpansion': True,
+}
+
+STORAGE_CLASS_META = {
+    'name': 'local-zfs',
+    'uid': 'c5a4bb36-7c47-4b1f-b3a4-7f4e6fbb55a1',
+    'resourceVersion': '1234',
+    'creationTimestamp': '2020-05-11T12:00:00Z',
+    'annotations': {'storageclass.kubernetes.io/is-default-class': 'false'},
+}
+
+
+def _pvc(storage_class, phase, annotations):
+    # Stand-in for the kopf body, meta, spec and status kwargs.
+    spec = {
+        'storageClassName': storage_class,
+        'accessModes': ['ReadWriteOnce'],
+        'resources': {'requests': {'storage': '10Gi'}},
+        'volumeMode': 'Filesystem',
+    }
+    status = {'phase': phase}
+    meta = types.SimpleNamespace(annotations=annotations, labels={})
+    return dict(body={'spec': spec, 'status': status}, meta=meta, spec=spec, status=status)
+
+
+OUR_PVC = _pvc('local-zfs', 'Pending', {'volume.kubernetes.io/selected-node': 'node-1'})
+BOUND_PVC = _pvc('local-zfs', 'Bound', {
+    'volume.kubernetes.io/selected-node': 'node-1',
+    handlers.CONFIG.dataset_annotation: '{}',
+})
+FOREIGN_PVC = _pvc('gp2', 'Pending', {'volume.kubernetes.io/storage-provisioner': 'ebs.csi.aws.com'})
+
+GET_PROPERTIES_OUTPUT = [
+    f'tank/provisioner/default-data-web-0\t{key}\t{value}\tlocal\n'.encode('utf-8')
+    for key,value in (
+        ('mountpoint', '/var/lib/zfs-provisioner/default-data-web-0'),
+        ('quota', '0'), ('refquota', '10737418240'), ('used', '98304'),
+        ('available', '10737319936'), ('referenced', '98304'),
+        ('compression', 'lz4'), ('recordsize', '131072'),
+    )
+]
+
+GET_PROPERTIES_MANY_OUTPUT = [
+    f'tank/provisioner/pvc-{i}\t{key}\t{value}\n'.encode('utf-8')
+    for i in range(100)
+    for key,value in (('mountpoint', 'legacy'), ('quota', '0'), ('refquota', '10737418240'))
+]
+
+
+def parse_get_properties_many():
+    result = {}
+    for line in GET_PROPERTIES_MANY_OUTPUT:
+        record = zfs._property_record(line)
+        result.setdefault(record.name, {})[record.property] = \
+            zfs.parse_property(record.property, record.value)
+    return result
+
+
+# A cluster with 2000 nodes named by hardware class and rack.
+DATASET_CONFIG = datasetconfig.parse(json.dumps({
+    'node_dataset_map': dict(
+        {f'node-{i}': f'tank/node-{i}' for i in range(2000)},
+        __default__='tank/provisioner',
+    ),
+    'node_dataset_rules': [
+        {'node': f'{kind}-rack{rack}-*', 'dataset': f'{kind}/provisioner'}
+        for kind in ('gpu', 'nvme', 'sata', 'arm') for rack in range(25)
+    ] + [
+        {'regex': rf'storage-{i}-[0-9]+', 'dataset': f'big{i}/provisioner'} for i in range(20)
+    ] + [
+        {'labels': {'hardware-class': kind}, 'dataset': f'{kind}/provisioner'}
+        for kind in ('gpu', 'nvme')
+    ],
+}).encode('utf-8'))
+
+
+PVC_EVENT = {'type': 'MODIFIED', 'object': {
+    'metadata': {'name': 'data-web-0', 'namespace': 'default', 'resourceVersion': '1234'},
+    **OUR_PVC['body'],
+}}
+PV_EVENT = {'type': 'MODIFIED', 'object': manifests.PERSISTENT_VOLUME.render(**PV_VALUES)}
+
+
+def setup():
+    handlers.CONFIG.storage_classes['local-zfs'] = handlers.StorageClass.from_dicts(
+        STORAGE_CLASS_META, STORAGE_CLASS_BODY)
+
+
+BENCHMARKS = {
+    'filter_create_dataset[ours]': lambda: handlers.filter_create_dataset(**OUR_PVC),
+    'filter_create_dataset[bound]': lambda: handlers.filter_create_dataset(**BOUND_PVC),
+    'filter_create_dataset[foreign]': lambda: handlers.filter_create_dataset(**FOREIGN_PVC),
+    'filter_delete_dataset[ours]': lambda: handlers.filter_delete_dataset(**BOUND_PVC),
+    'filter_delete_dataset[foreign]': lambda: handlers.filter_delete_dataset(**FOREIGN_PVC),
+    'StorageClass.from_dicts': lambda: handlers.StorageClass.from_dicts(
+        STORAGE_CLASS_META, STORAGE_CLASS_BODY),
+    'datasets._get_pod': lambda: datasets._get_pod('default-data-web-0-create', 'node-1',
+        'asteven/zfs-provisioner:latest', '/var/lib/zfs-provisioner',
+        ['create', '--refquota', '10737418240', 'tank/provisioner/default-data-web-0',
+         '/var/lib/zfs-provisioner/default-data-web-0']),
+    'PERSISTENT_VOLUME.render': lambda: manifests.PERSISTENT_VOLUME.render(**PV_VALUES),
+    'datasets.size_in_bytes': lambda: datasets.size_in_bytes('10Gi'),
+    'zfs.get_properties[parse]': lambda: zfs._parse_get_properties_output(GET_PROPERTIES_OUTPUT),
+    'zfs.get_properties_many[parse 100]': parse_get_properties_many,
+    'cache.PVCS.apply': lambda: cache.PVCS.apply(PVC_EVENT),
+    'cache.PVS.apply': lambda: cache.PVS.apply(PV_EVENT),
+    'DatasetConfig.parent_dataset[cached]': lambda: DATASET_CONFIG.parent_dataset(
+        'nvme-rack17-42', 'tank/provisioner'),
+    'NodeDatasetMatcher.match[exact]': lambda: DATASET_CONFIG.matcher.match('node-1234'),
+    'NodeDatasetMatcher.match[glob]': lambda: DATASET_CONFIG.matcher.match('nvme-rack17-42'),
+    'NodeDatasetMatcher.match[regex]': lambda: DATASET_CONFIG.matcher.match('storage-19-7'),
+    'NodeDatasetMatcher.match[labels]': lambda: DATASET_CONFIG.matcher.match('worker-7',
+        {'kubernetes.io/arch': 'amd64', 'hardware-class': 'nvme'}),
+}
+
+
+def measure(func, repeat=7):
+    """Return the best time per call in nanoseconds.
+    """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return round(min(timer.repeat(repeat=repeat, number=number)) / number * 1e9, 1)
+
+
+def machine():
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def load_baseline(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def report(results, baseline, threshold):
+    """Print the comparison with the baseline and return the names
+    of the benchmarks that regressed.
+    """
+    regressions = []
+    previous = (baseline or {}).get('results', {})
+    if baseline and baseline.get('machine', {}) != machine():
+        print('Warning: the baseline was recorded on a different machine.', file=sys.stderr)
+    print(f'{"benchmark":40} {"baseline":>12} {"current":>12} {"ratio":>8}')
+    for name,current in results.items():
+        before = previous.get(name, None)
+        if before is None:
+            print(f'{name:40} {"-":>12} {current:10.0f}ns {"-":>8}')
+            continue
+        ratio = current / before
+        flag = ''
+        if ratio > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 / threshold:
+            flag = '  improved'
+        print(f'{name:40} {before:10.0f}ns {current:10.0f}ns {ratio:7.2f}x{flag}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save', action='store_true', help='Store the results as the new baseline.')
+    parser.add_argument('--check', action='store_true', help='Exit with status 1 on regressions.')
+    parser.add_argument('--threshold', type=float, default=1.3,
+        help='Ratio to the baseline above which a benchmark counts as regressed.')
+    parser.add_argument('--filter', default='', help='Only run benchmarks containing this string.')
+    args = parser.parse_args()
+
+    setup()
+    results = {name:measure(func) for name,func in BENCHMARKS.items() if args.filter in name}
+    baseline = load_baseline(args.baseline)
+    regressions = report(results, baseline, args.threshold)
+
+    if args.save:
+        # Keep the baselines of the benchmarks that were filtered out.
+        saved = dict((baseline or {}).get('results', {}))
+        saved.update(results)
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump({'machine': machine(), 'results': saved}, f, indent=2)
+            f.write('\n')
+        print(f'Saved baseline to {args.baseline}')
+    if args.check and regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Per object cost of rendering the manifests.
+
+Compares formatting the template text and parsing it with yaml for every
+object, as done before, with rendering the precompiled templates.
+
+Usage: python -m benchmarks.manifests [--number N]
+"""
+import argparse
+import timeit
+
+import yaml
+
+from zfs_provisioner import get_template
+from zfs_provisioner import manifests
+
+
+POD_VALUES = dict(
+    pod_name='default-data-web-0-create',
+    node_name='node-1',
+    image='asteven/zfs-provisioner:latest',
+    dataset_mount_dir='/var/lib/zfs-provisioner',
+    log_level='INFO',
+)
+
+PV_VALUES = dict(
+    provisioner_name='asteven/zfs-provisioner',
+    pv_name='default-data-web-0',
+    access_mode='ReadWriteOnce',
+    storage='1Gi',
+    pvc_name='data-web-0',
+    pvc_namespace='default',
+    pvc_uid='5fdc9d7f-2a27-11e9-8180-a4bf0112bd54',
+    local_path='/var/lib/zfs-provisioner/default-data-web-0',
+    selected_node_name='node-1',
+    storage_class_name='local-zfs',
+    volume_mode='Filesystem',
+    reclaim_policy='Delete',
+)
+
+
+def format_and_parse(template_file, values):
+    # What the handlers did before: read, format and parse per object.
+    return yaml.safe_load(get_template(template_file).format(**values))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--number', type=int, default=2000)
+    args = parser.parse_args()
+
+    cases = [
+        ('dataset-pod.yaml', manifests.DATASET_POD, POD_VALUES),
+        ('pvc.yaml', manifests.PERSISTENT_VOLUME, PV_VALUES),
+    ]
+    for template_file, template, values in cases:
+        assert format_and_parse(template_file, values) == template.render(**values)
+        before = timeit.timeit(lambda: format_and_parse(template_file, values), number=args.number)
+        after = timeit.timeit(lambda: template.render(**values), number=args.number)
+        print(f'{template_file:20} before: {before / args.number * 1e6:9.1f} us/object'
+            f'  after: {after / args.number * 1e6:7.1f} us/object'
+            f'  speedup: {before / after:6.1f}x')
+
+
+if __name__ == '__main__':
+    main()
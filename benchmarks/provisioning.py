@@ -0,0 +1,255 @@
+"""Provisioning throughput of the controller against a fake API server.
+
+Starts `zfs-provisioner controller` as a subprocess against the in-memory
+API server of `benchmarks.fakeapi`, submits PVCs at the given rate and
+measures the time from creating each PVC until it is Bound. Dataset pods
+are simulated by the fake API server, see its --pod-* options.
+
+The results are written as JSON, together with the version of the code
+and the settings, so runs of different versions can be compared:
+
+    python -m benchmarks.provisioning --pvcs 500 --rate 50 --output before.json
+
+Usage: python -m benchmarks.provisioning [--pvcs N] [--rate R] [--output FILE]
+    [--controller-arg ARG ...]
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import fakeapi
+from zfs_provisioner import handlers
+
+
+STORAGE_CLASS = 'zfs-bench'
+NAMESPACE = 'default'
+
+
+def get_version():
+    version = {'python': platform.python_version()}
+    try:
+        import importlib.metadata
+        version['zfs_provisioner'] = importlib.metadata.version('zfs_provisioner')
+        version['kopf'] = importlib.metadata.version('kopf')
+    except Exception:
+        pass
+    try:
+        version['git'] = subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL,
+            text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return version
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    quantiles = statistics.quantiles(values, n=100) if len(values) > 1 else values * 99
+    return {
+        'p50': round(quantiles[49], 4),
+        'p95': round(quantiles[94], 4),
+        'p99': round(quantiles[98], 4),
+        'max': round(values[-1], 4),
+        'mean': round(statistics.fmean(values), 4),
+    }
+
+
+class Recorder():
+    """Record when PVCs are created and when they are first seen Bound.
+    """
+
+    def __init__(self):
+        self.created = {}
+        self.bound = {}
+
+    def on_change(self, event_type, resource, obj):
+        if resource.plural != 'persistentvolumeclaims':
+            return
+        name = obj['metadata']['name']
+        if event_type == 'ADDED':
+            self.created[name] = time.monotonic()
+        elif obj.get('status', {}).get('phase', None) == 'Bound' and name not in self.bound:
+            self.bound[name] = time.monotonic()
+
+
+def pvc(index, node):
+    return {
+        'metadata': {
+            'name': f'bench-{index}',
+            'annotations': {'volume.kubernetes.io/selected-node': node},
+        },
+        'spec': {
+            'storageClassName': STORAGE_CLASS,
+            'accessModes': ['ReadWriteOnce'],
+            'resources': {'requests': {'storage': '1Gi'}},
+            'volumeMode': 'Filesystem',
+        },
+        'status': {'phase': 'Pending'},
+    }
+
+
+async def wait_for(predicate, timeout, interval=0.05):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(interval)
+    return True
+
+
+def is_watching_pvcs(store, pvcs):
+    """Return whether the controller watches new PVCs and the PVCs it labelled.
+
+    Without --label-pvcs kopf watches all PVCs, with it pvcwatch watches
+    the unlabelled and the labelled PVCs separately.
+    """
+    config = handlers.Config()
+    labelled = {config.managed_label: config.provisioner_name}
+    predicates = [watch[2] for watch in store.watches if watch[0] == pvcs]
+    return (any(predicate({}) for predicate in predicates)
+        and any(predicate(labelled) for predicate in predicates))
+
+
+def start_controller(kubeconfig, log_file, controller_args):
+    env = dict(os.environ,
+        KUBECONFIG=kubeconfig,
+        NAMESPACE='zfs',
+        CONTAINER_IMAGE='zfs-provisioner:bench',
+        METRICS_PORT='0',
+    )
+    cmd = [sys.executable, '-m', 'zfs_provisioner.cli', '--verbose', 'controller']
+    cmd.extend(controller_args)
+    return subprocess.Popen(cmd, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+
+
+def stop_controller(process):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+async def benchmark(args, tmp):
+    store = fakeapi.Store()
+    cluster = fakeapi.Cluster(store, pod_start=args.pod_start, pod_run=args.pod_run,
+        pod_failures=args.pod_failures, seed=args.seed)
+    recorder = Recorder()
+    store.listeners.append(recorder.on_change)
+
+    store.create(cluster.resource('namespaces'), None, {'metadata': {'name': NAMESPACE}})
+    nodes = [f'node-{i}' for i in range(args.nodes)]
+    for node in nodes:
+        cluster.add_node(node, '127.0.0.1')
+    store.create(cluster.resource('storageclasses', 'storage.k8s.io'), None, {
+        'metadata': {'name': STORAGE_CLASS},
+        'provisioner': 'zfs-provisioner',
+        'reclaimPolicy': 'Delete',
+        'volumeBindingMode': 'Immediate',
+        'parameters': {'mode': 'local'},
+    })
+
+    runner, port = await fakeapi.start(store)
+    kubeconfig = os.path.join(tmp, 'kubeconfig')
+    fakeapi.write_kubeconfig(kubeconfig, f'http://127.0.0.1:{port}')
+    log_path = os.path.join(tmp, 'controller.log')
+    with open(log_path, 'w') as log_file:
+        process = start_controller(kubeconfig, log_file, args.controller_arg or [])
+    pvcs = cluster.resource('persistentvolumeclaims')
+    try:
+        # The controller is ready once it watches the PVCs.
+        ready = await wait_for(lambda: process.poll() is not None
+            or is_watching_pvcs(store, pvcs), args.timeout)
+        if not ready or process.poll() is not None:
+            raise RuntimeError('Controller did not start watching PVCs')
+
+        start = time.monotonic()
+        for index in range(args.pvcs):
+            delay = start + index / args.rate - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            store.create(pvcs, NAMESPACE, pvc(index, nodes[index % len(nodes)]))
+        submitted = time.monotonic() - start
+
+        await wait_for(lambda: len(recorder.bound) == args.pvcs or process.poll() is not None,
+            args.timeout)
+    finally:
+        stop_controller(process)
+        await runner.cleanup()
+        for task in list(cluster.tasks):
+            task.cancel()
+
+    times = [recorder.bound[name] - recorder.created[name] for name in recorder.bound]
+    duration = max(recorder.bound.values()) - start if recorder.bound else None
+    return {
+        'version': get_version(),
+        'settings': {
+            'pvcs': args.pvcs,
+            'rate': args.rate,
+            'nodes': args.nodes,
+            'pod_start': args.pod_start,
+            'pod_run': args.pod_run,
+            'pod_failures': args.pod_failures,
+            'controller_args': args.controller_arg or [],
+        },
+        'submitted': args.pvcs,
+        'submit_seconds': round(submitted, 3),
+        'bound': len(recorder.bound),
+        'duration_seconds': round(duration, 3) if duration else None,
+        'pvcs_per_second': round(len(recorder.bound) / duration, 2) if duration else 0,
+        'time_to_bound_seconds': percentiles(times),
+    }, log_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--pvcs', type=int, default=100, help='Number of PVCs to submit.')
+    parser.add_argument('--rate', type=float, default=20, help='PVCs submitted per second.')
+    parser.add_argument('--nodes', type=int, default=3, help='Number of nodes to spread the PVCs over.')
+    parser.add_argument('--pod-start', default='lognormal:0.5:0.3',
+        help='Latency distribution of starting a dataset pod.')
+    parser.add_argument('--pod-run', default='lognormal:0.05:0.5',
+        help='Latency distribution of a dataset pod running zfs.')
+    parser.add_argument('--pod-failures', type=float, default=0,
+        help='Probability of a dataset pod failing.')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--timeout', type=float, default=300,
+        help='Seconds to wait for the controller to start and for the PVCs to be bound.')
+    parser.add_argument('--controller-arg', action='append',
+        help='Additional argument for `zfs-provisioner controller`, can be given multiple times.')
+    parser.add_argument('--output', help='Write the results to this file instead of stdout.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            report, log_path = asyncio.run(benchmark(args, tmp))
+        except RuntimeError as e:
+            print(f'Error: {e}, controller output:', file=sys.stderr)
+            with open(os.path.join(tmp, 'controller.log')) as f:
+                sys.stderr.write(f.read()[-4000:])
+            sys.exit(1)
+        if report['bound'] < report['submitted']:
+            with open(log_path) as f:
+                sys.stderr.write(f.read()[-4000:])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    sys.exit(0 if report['bound'] == report['submitted'] else 1)
+
+
+if __name__ == '__main__':
+    main()
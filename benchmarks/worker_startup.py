@@ -0,0 +1,86 @@
+"""Cold-start cost of the worker entry point run in the dataset pods.
+
+Reports the wall time of starting the slim `zfs_provisioner.worker` entry
+point and the full cli, and checks the worker against an import budget:
+it must not import any of the controllers heavy dependencies and its
+cumulative import time must stay below --budget-ms.
+
+Exits with status 1 if the budget is exceeded.
+
+Usage: python -m benchmarks.worker_startup [--runs N] [--budget-ms MS]
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+
+# Modules the worker must never import.
+FORBIDDEN_MODULES = (
+    'aiofiles', 'aiohttp', 'asyncio', 'click', 'inotipy', 'kopf',
+    'kubernetes', 'kubernetes_asyncio', 'prometheus_client', 'yaml',
+)
+
+COMMANDS = {
+    'worker': [sys.executable, '-m', 'zfs_provisioner.worker', '--help'],
+    'cli': [sys.executable, '-m', 'zfs_provisioner.cli', 'dataset', '--help'],
+}
+
+
+def wall_time(cmd, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def import_profile(module):
+    """Return the names of the modules imported by module and its
+    cumulative import time in microseconds.
+    """
+    cmd = [sys.executable, '-X', 'importtime', '-c', f'import {module}']
+    output = subprocess.run(cmd, stderr=subprocess.PIPE, check=True).stderr.decode()
+    modules = {}
+    for line in output.splitlines():
+        # import time: <self us> | <cumulative us> | <indented name>
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        modules[name.strip()] = int(cumulative)
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--budget-ms', type=float, default=50)
+    args = parser.parse_args()
+
+    result = {name:wall_time(cmd, args.runs) for name,cmd in COMMANDS.items()}
+    modules = import_profile('zfs_provisioner.worker')
+    import_ms = modules['zfs_provisioner.worker'] / 1000
+    forbidden = sorted(name for name in modules if name.split('.')[0] in FORBIDDEN_MODULES)
+
+    print(json.dumps({
+        'wall_time_ms': {name:round(value * 1000, 1) for name,value in result.items()},
+        'worker_import_ms': import_ms,
+        'worker_modules': len(modules),
+        'forbidden_modules': forbidden,
+    }, indent=2))
+
+    failed = False
+    if forbidden:
+        print(f'FAIL: worker imports forbidden modules: {forbidden}', file=sys.stderr)
+        failed = True
+    if import_ms > args.budget_ms:
+        print(f'FAIL: worker import took {import_ms}ms, budget is {args.budget_ms}ms', file=sys.stderr)
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
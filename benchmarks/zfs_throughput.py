@@ -0,0 +1,102 @@
+"""Throughput and retry behaviour of the agents dataset operations.
+
+Creates and destroys datasets with `agent.create_dataset` and
+`agent.destroy_dataset` against the fake `zfs` executable of
+`zfs_provisioner.fakezfs`, so no real pool is needed. Failed operations are
+retried like the controller does, without its delay. Latency and failures
+are injected with the FAKEZFS_LATENCY and FAKEZFS_FAILURES environment
+variables, e.g.:
+
+    FAKEZFS_LATENCY=create=lognormal:0.05:0.5,*=const:0.005 FAKEZFS_FAILURES=create=0.05 \\
+        python -m benchmarks.zfs_throughput --datasets 200 --concurrency 16
+
+Every zfs command starts the fake executable, a Python interpreter, so
+absolute numbers are bounded by the available CPUs.
+
+Usage: python -m benchmarks.zfs_throughput [--datasets N] [--concurrency N] [--retries N]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from zfs_provisioner import agent
+from zfs_provisioner import aiozfs
+from zfs_provisioner import fakezfs
+from zfs_provisioner import zfs
+
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bin')
+
+PARENT = 'tank/provisioner'
+
+
+async def run_with_retries(func, retries, *args):
+    """Run func until it succeeds, return its duration and the number of attempts.
+    """
+    start = time.monotonic()
+    for attempt in range(1, retries + 2):
+        try:
+            await func(*args)
+            return time.monotonic() - start, attempt
+        except (zfs.ZfsCommandError, OSError):
+            if attempt > retries:
+                return None, attempt
+
+
+def summarize(results, wall_time):
+    durations = sorted(d for d,_ in results if d is not None)
+    quantiles = statistics.quantiles(durations, n=100) if len(durations) > 1 else durations * 99
+    return {
+        'operations': len(results),
+        'failed': sum(1 for d,_ in results if d is None),
+        'retries': sum(attempts - 1 for _,attempts in results),
+        'ops_per_second': round(len(results) / wall_time, 1),
+        'p50_ms': round(quantiles[49] * 1000, 3),
+        'p95_ms': round(quantiles[94] * 1000, 3),
+        'p99_ms': round(quantiles[98] * 1000, 3),
+    }
+
+
+async def benchmark(count, concurrency, retries, mount_dir):
+    aiozfs.configure(max_concurrency=concurrency)
+    names = [f'{PARENT}/pvc-{i}' for i in range(count)]
+    report = {}
+    for action, func in (('create', agent.create_dataset), ('delete', agent.destroy_dataset)):
+        start = time.monotonic()
+        results = await asyncio.gather(*[
+            run_with_retries(func, retries, name, os.path.join(mount_dir, name.rsplit('/', 1)[1]))
+            for name in names
+        ])
+        report[action] = summarize(results, time.monotonic() - start)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--datasets', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--retries', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # The fake zfs executable has to import zfs_provisioner.
+        root = os.path.dirname(os.path.dirname(BIN_DIR))
+        os.environ['PYTHONPATH'] = os.pathsep.join(filter(None, (root, os.environ.get('PYTHONPATH'))))
+        os.environ['PATH'] = os.pathsep.join((BIN_DIR, os.environ['PATH']))
+        os.environ[fakezfs.STATE_ENV] = os.path.join(tmp, 'fakezfs.json')
+        # The fake mountpoints are plain directories.
+        mount_dir = os.path.join(tmp, 'mnt')
+        report = asyncio.run(benchmark(args.datasets, args.concurrency, args.retries, mount_dir))
+
+    report['concurrency'] = args.concurrency
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
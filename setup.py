@@ -20,17 +20,19 @@ setup(
     include_package_data=True,
     install_requires=[
         'aiofiles',
-        'bitmath',
+        'aiohttp',
         'click',
         'inotipy',
         'kopf',
         'kubernetes',
         'kubernetes_asyncio',
+        'prometheus_client',
         'pyyaml',
     ],
     entry_points={
         'console_scripts': [
-            '{command} = {name}.cli:main'.format(command=command, name=name)
+            '{command} = {name}.cli:main'.format(command=command, name=name),
+            '{command}-worker = {name}.worker:main'.format(command=command, name=name),
         ],
     },
 )
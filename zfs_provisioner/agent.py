@@ -0,0 +1,259 @@
+"""Long-running node agent that performs dataset operations on behalf of
+the controller.
+
+The agent runs on every node as part of a DaemonSet and replaces the
+one-pod-per-operation approach. The controller talks to it over a small
+JSON-over-HTTP protocol:
+
+    POST /v1/datasets/<action>  {"dataset": ..., "mountpoint": ..., ...}
+
+Every request is answered with a structured result that mirrors the pod
+phases used by the dataset pods, e.g.:
+
+    {"action": "create", "dataset": "tank/provisioner/x",
+     "status": "Succeeded", "duration": 0.004}
+"""
+import hmac
+import logging
+import os
+import time
+
+import aiohttp
+import aiohttp.web
+
+from . import Error
+from . import aiozfs
+from . import tracing
+from . import zfs
+
+log = logging.getLogger('zfs-provisioner')
+
+
+DEFAULT_PORT: int = 8476
+
+STATUS_SUCCEEDED: str = 'Succeeded'
+STATUS_FAILED: str = 'Failed'
+
+
+async def _exists_at(dataset, mountpoint):
+    if not await aiozfs.exists(dataset):
+        return False
+    properties = await aiozfs.get_properties(dataset, 'mountpoint')
+    return properties.get('mountpoint', None) == mountpoint
+
+
+async def create_dataset(dataset, mountpoint, quota=None, refquota=None):
+    """Non-blocking version of `node.create_dataset`.
+    """
+    # Ensure the mountpoints parent folder exists and has safe permissions.
+    mountpoint_dir = os.path.split(mountpoint)[0]
+    os.makedirs(mountpoint_dir, mode=0o700, exist_ok=True)
+    os.chmod(mountpoint_dir, 0o700)
+
+    # Ensure we have parent dataset whith mountpoint set to legacy
+    # and create our dataset.
+    try:
+        await aiozfs.create_with_parent(dataset, {'mountpoint': 'legacy'},
+            mountpoint=mountpoint, quota=quota, refquota=refquota)
+    except zfs.ZfsCommandError:
+        if not await _exists_at(dataset, mountpoint):
+            raise
+        # Created by an earlier attempt whose result got lost.
+        log.info('Dataset %s already exists at %s', dataset, mountpoint)
+
+    # Ensure the dataset is writable by the pod.
+    os.chmod(mountpoint, 0o777)
+
+
+async def destroy_dataset(dataset, mountpoint):
+    """Non-blocking version of `node.destroy_dataset`.
+    """
+    try:
+        await aiozfs.destroy(dataset)
+    except zfs.ZfsCommandError:
+        if await aiozfs.exists(dataset):
+            raise
+        log.info('Dataset %s does not exist', dataset)
+    try:
+        os.rmdir(mountpoint)
+    except FileNotFoundError:
+        pass
+
+
+ACTIONS = {
+    'create': create_dataset,
+    'delete': destroy_dataset,
+}
+
+
+class AgentError(Error):
+    """Error that happened while talking to a node agent
+    or that was reported by it.
+    """
+    pass
+
+
+def _is_below(path, directory):
+    path = os.path.normpath(path)
+    directory = os.path.normpath(directory)
+    return os.path.commonpath([path, directory]) == directory and path != directory
+
+
+def _is_below_dataset(dataset, parent):
+    """Return whether dataset is a filesystem below the parent dataset.
+    Snapshots, bookmarks and malformed names are never below.
+    """
+    if not isinstance(dataset, str) or '@' in dataset or '#' in dataset:
+        return False
+    if '' in dataset.split('/'):
+        return False
+    return dataset.startswith(parent.rstrip('/') + '/')
+
+
+def _bad_request(action, error):
+    return aiohttp.web.json_response({
+        'action': action,
+        'dataset': None,
+        'status': STATUS_FAILED,
+        'error': error,
+    }, status=400)
+
+
+class Agent():
+    """Serve dataset operations for the node this agent is running on.
+
+    Only datasets below one of allowed_parents are created or destroyed.
+    """
+
+    def __init__(self, dataset_mount_dir, token, allowed_parents):
+        if not token:
+            raise AgentError('The agent requires a token')
+        if not allowed_parents:
+            raise AgentError('The agent requires at least one allowed parent dataset')
+        self.dataset_mount_dir = dataset_mount_dir
+        self.token = token
+        self.allowed_parents = list(allowed_parents)
+
+    def _authorized(self, request):
+        return hmac.compare_digest(request.headers.get('Authorization', ''),
+            f'Bearer {self.token}')
+
+    def _allowed(self, dataset):
+        return any(_is_below_dataset(dataset, parent) for parent in self.allowed_parents)
+
+    async def handle_health(self, request):
+        return aiohttp.web.json_response({'status': 'ok'})
+
+    async def handle_action(self, request):
+        action = request.match_info['action']
+        if not self._authorized(request):
+            raise aiohttp.web.HTTPUnauthorized()
+        try:
+            func = ACTIONS[action]
+        except KeyError:
+            raise aiohttp.web.HTTPNotFound(text=f'Unsupported action: {action}')
+
+        try:
+            params = await request.json()
+        except ValueError as e:
+            return _bad_request(action, f'Invalid JSON: {e}')
+        if not isinstance(params, dict):
+            return _bad_request(action, 'Request body is not a JSON object')
+        result = {
+            'action': action,
+            'dataset': params.get('dataset', None),
+        }
+        mountpoint = params.get('mountpoint', None)
+        if (not isinstance(mountpoint, str) or not mountpoint
+                or not _is_below(mountpoint, self.dataset_mount_dir)):
+            result['status'] = STATUS_FAILED
+            result['error'] = f'Mountpoint not below {self.dataset_mount_dir}: {mountpoint}'
+            return aiohttp.web.json_response(result, status=400)
+        if not self._allowed(result['dataset']):
+            result['status'] = STATUS_FAILED
+            result['error'] = (f'Dataset not below {", ".join(self.allowed_parents)}: '
+                f'{result["dataset"]}')
+            return aiohttp.web.json_response(result, status=403)
+
+        log.debug('agent.%s: %s', action, params)
+        start = time.monotonic()
+        try:
+            with tracing.remote(request.headers.get(tracing.TRACEPARENT_HEADER, None)), \
+                    tracing.span(f'agent.{action}', dataset=result['dataset']):
+                await func(**params)
+        except (zfs.ZfsCommandError, OSError, TypeError) as e:
+            log.error('agent.%s: %s', action, e)
+            result['status'] = STATUS_FAILED
+            result['error'] = str(e)
+        else:
+            result['status'] = STATUS_SUCCEEDED
+        result['duration'] = time.monotonic() - start
+
+        status = 200 if result['status'] == STATUS_SUCCEEDED else 500
+        return aiohttp.web.json_response(result, status=status)
+
+    def make_app(self):
+        app = aiohttp.web.Application()
+        app.router.add_get('/healthz', self.handle_health)
+        app.router.add_post('/v1/datasets/{action}', self.handle_action)
+        return app
+
+
+def run(host, port, dataset_mount_dir, token, allowed_parents):
+    """Run the node agent until interrupted.
+    """
+    agent = Agent(dataset_mount_dir, token, allowed_parents)
+    log.info('Agent listening on %s:%s', host, port)
+    aiohttp.web.run_app(agent.make_app(), host=host, port=port, print=None)
+
+
+class Client():
+    """Client used by the controller to talk to the node agents.
+    """
+
+    def __init__(self, port=DEFAULT_PORT, token=None):
+        self.port = port
+        self.token = token
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            headers = {}
+            if self.token:
+                headers['Authorization'] = f'Bearer {self.token}'
+            self._session = aiohttp.ClientSession(headers=headers)
+        return self._session
+
+    async def call(self, address, action, **params):
+        """Run the given action on the agent listening on address
+        and return its result.
+        """
+        url = f'http://{address}:{self.port}/v1/datasets/{action}'
+        log.debug('agent.call: %s: %s', url, params)
+        headers = {}
+        traceparent = tracing.current_traceparent()
+        if traceparent is not None:
+            headers[tracing.TRACEPARENT_HEADER] = traceparent
+        try:
+            async with self.session.post(url, json=params, headers=headers) as response:
+                if response.content_type == 'application/json':
+                    result = await response.json()
+                else:
+                    result = {
+                        'action': action,
+                        'status': STATUS_FAILED,
+                        'error': f'{response.status}: {await response.text()}',
+                    }
+        except aiohttp.ClientError as e:
+            raise AgentError(f'Failed to call agent at {url}: {e}') from e
+
+        if result.get('status', None) != STATUS_SUCCEEDED:
+            raise AgentError(f'Agent at {address} failed to {action} dataset '
+                f'"{params.get("dataset", None)}": {result.get("error", None)}')
+        return result
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
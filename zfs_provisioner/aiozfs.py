@@ -0,0 +1,346 @@
+"""Asyncio counterpart of the `zfs` module.
+
+Provides the same functions as `zfs` but runs the `zfs` commands as
+non-blocking subprocesses. The number of concurrently running commands is
+bounded and every command is subject to a timeout.
+"""
+import asyncio
+import logging
+import os
+
+from . import tracing
+from .zfs import ZfsCommandError
+from .zfs import find_inventory
+from .zfs import _probe_command, _parse_probe_output, _changed_properties
+from .zfs import Property, parse_property
+from .zfs import _list_properties_command, _parse_line
+from .zfs import _get_properties_many_command, _property_record
+from .zfs import _parse_get_properties_output
+
+log = logging.getLogger('zfs-provisioner')
+
+
+# Maximum number of concurrently running zfs commands.
+MAX_CONCURRENCY: int = 16
+
+# Seconds after which a running zfs command is killed.
+TIMEOUT: float = 60
+
+# Whether `create_with_parent` inspects the parent with a channel program.
+CHANNEL_PROGRAM: bool = False
+
+_semaphore = None
+
+# Locks that prevent concurrent refreshes of the same inventory.
+_inventory_locks = {}
+
+# Locks that prevent concurrent creates of the same parent dataset.
+_parent_locks = {}
+
+
+def configure(max_concurrency=None, timeout=None, channel_program=None):
+    """Configure the concurrency limit, command timeout
+    and use of channel programs.
+    """
+    global MAX_CONCURRENCY, TIMEOUT, CHANNEL_PROGRAM, _semaphore
+    if max_concurrency is not None:
+        MAX_CONCURRENCY = max_concurrency
+        _semaphore = None
+    if timeout is not None:
+        TIMEOUT = timeout
+    if channel_program is not None:
+        CHANNEL_PROGRAM = channel_program
+
+
+def _get_semaphore():
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    return _semaphore
+
+
+async def _run(cmd, timeout=None):
+    """Run the given command and return its output.
+
+    Raise ZfsCommandError if the command fails or does not finish in time.
+    The raised error has the commands combined stdout and stderr
+    in its `output` attribute.
+    """
+    if timeout is None:
+        timeout = TIMEOUT
+    async with _get_semaphore():
+        process = await asyncio.create_subprocess_exec(*cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+        )
+        try:
+            output, _ = await asyncio.wait_for(process.communicate(), timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            error = ZfsCommandError(f'Timeout after {timeout}s running command: {cmd}')
+            error.output = None
+            raise error
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            raise
+
+    if process.returncode != 0:
+        error = ZfsCommandError(f'Command {cmd} returned non-zero exit status {process.returncode}')
+        error.output = output
+        raise error
+    return output
+
+
+async def _get_inventory(dataset):
+    inventory = find_inventory(dataset)
+    if inventory is None or not inventory.expired:
+        return inventory
+    lock = _inventory_locks.setdefault(inventory.root, asyncio.Lock())
+    async with lock:
+        if inventory.expired:
+            cmd = _list_properties_command(inventory.root, inventory.keys, recursive=True)
+            log.debug('aiozfs.inventory: %s', cmd)
+            datasets = {}
+            try:
+                async for line in _iter_output(cmd):
+                    parts = _parse_line(line)
+                    datasets[parts[0]] = dict(zip(inventory.keys, parts[1:]))
+            except ZfsCommandError as e:
+                if not (e.output and b'dataset does not exist' in e.output):
+                    raise ZfsCommandError(f'Failed to list dataset "{inventory.root}" running command: {cmd}') from e
+                datasets = {}
+            inventory.replace(datasets)
+    return inventory
+
+
+async def _iter_output(cmd, timeout=None):
+    """Run the given command and yield the lines of its output as they
+    are produced, so the output never has to be held in memory at once.
+
+    The timeout applies to the wait for each line. Raise ZfsCommandError,
+    with stderr in its `output` attribute, if the command fails.
+    """
+    if timeout is None:
+        timeout = TIMEOUT
+    async with _get_semaphore():
+        process = await asyncio.create_subprocess_exec(*cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stderr = asyncio.ensure_future(process.stderr.read())
+        finished = False
+        try:
+            while True:
+                try:
+                    line = await asyncio.wait_for(process.stdout.readline(), timeout)
+                except asyncio.TimeoutError:
+                    error = ZfsCommandError(f'Timeout after {timeout}s running command: {cmd}')
+                    error.output = None
+                    raise error
+                if not line:
+                    break
+                yield line
+            finished = True
+        finally:
+            if not finished and process.returncode is None:
+                process.kill()
+            await process.wait()
+            output = await stderr
+
+    if process.returncode != 0:
+        error = ZfsCommandError(f'Command {cmd} returned non-zero exit status {process.returncode}')
+        error.output = output
+        raise error
+
+
+@tracing.traced('zfs.exists')
+async def exists(dataset):
+    """Return True if the given dataset exists.
+    """
+    cmd = ['zfs', 'list', '-Hp', dataset]
+    try:
+        await _run(cmd)
+    except ZfsCommandError as e:
+        if e.output and b'dataset does not exist' in e.output:
+            return False
+        raise ZfsCommandError(f'Failed to list dataset "{dataset}" running command: {cmd}') from e
+    return True
+
+
+@tracing.traced('zfs.create')
+async def create(dataset, *args, **properties):
+    """Create the given dataset with the given properties.
+    """
+    properties = {k:v for k,v in properties.items() if v is not None}
+    cmd = ['zfs', 'create']
+    cmd.extend(args)
+    for k,v in properties.items():
+        cmd.extend(['-o', f'{k}={v}'])
+    cmd.append(dataset)
+    log.debug('aiozfs.create: %s', cmd)
+
+    inventory = find_inventory(dataset)
+    try:
+        await _run(cmd)
+    except ZfsCommandError as e:
+        log.error(e)
+        if inventory is not None:
+            inventory.invalidate()
+        raise ZfsCommandError(f'Failed to create dataset "{dataset}" running command: {cmd}') from e
+    if inventory is not None:
+        inventory.add(dataset, properties)
+
+
+@tracing.traced('zfs.ensure')
+async def ensure(dataset, *args, **properties):
+    """Ensure the given dataset exists
+    with the given properties.
+    """
+    inventory = await _get_inventory(dataset)
+    if inventory is not None:
+        current = inventory.lookup(dataset)
+        if current is None:
+            return await create(dataset, *args, **properties)
+        # Dataset exists, only set the properties that differ.
+        changed = _changed_properties(current, properties)
+        if changed:
+            await set_properties(dataset, **changed)
+        return
+
+    if not await exists(dataset):
+        return await create(dataset, *args, **properties)
+    # Dataset exists, ensure properties are correct.
+    await set_properties(dataset, **properties)
+
+
+@tracing.traced('zfs.probe')
+async def probe(dataset, *keys):
+    """Return the given properties of the given dataset
+    or None if it does not exist.
+    """
+    cmd = _probe_command(dataset, keys)
+    log.debug('aiozfs.probe: %s', cmd)
+    try:
+        output = await _run(cmd)
+    except ZfsCommandError as e:
+        raise ZfsCommandError(f'Failed to probe dataset "{dataset}" running command: {cmd}') from e
+    return _parse_probe_output(output)
+
+
+@tracing.traced('zfs.create_with_parent')
+async def create_with_parent(dataset, parent_properties, **properties):
+    """Ensure the parent of the given dataset exists with the given
+    parent_properties and create the dataset with the given properties.
+    """
+    parent = os.path.split(dataset)[0]
+    async with _parent_locks.setdefault(parent, asyncio.Lock()):
+        if not CHANNEL_PROGRAM or find_inventory(parent) is not None:
+            await ensure(parent, **parent_properties)
+        else:
+            current = await probe(parent, *parent_properties)
+            if current is None:
+                await create(parent, **parent_properties)
+            else:
+                changed = _changed_properties(current, parent_properties)
+                if changed:
+                    await set_properties(parent, **changed)
+    await create(dataset, **properties)
+
+
+@tracing.traced('zfs.destroy')
+async def destroy(dataset, *args):
+    """Destroy the given dataset.
+    """
+    cmd = ['zfs', 'destroy']
+    cmd.extend(args)
+    cmd.append(dataset)
+    log.debug('aiozfs.destroy: %s', cmd)
+
+    inventory = find_inventory(dataset)
+    try:
+        await _run(cmd)
+    except ZfsCommandError as e:
+        log.error(e)
+        if inventory is not None:
+            inventory.invalidate()
+        raise ZfsCommandError(f'Failed to destroy dataset "{dataset}" running command: {cmd}') from e
+    if inventory is not None:
+        inventory.remove(dataset)
+
+
+@tracing.traced('zfs.set_properties')
+async def set_properties(dataset, **properties):
+    """Set the given properties on the given dataset.
+    """
+    cmd = ['zfs', 'set']
+    for k,v in properties.items():
+        cmd.append(f'{k}={v}')
+    cmd.append(dataset)
+    log.debug('aiozfs.set_properties: %s', cmd)
+    try:
+        await _run(cmd)
+    except ZfsCommandError as e:
+        raise ZfsCommandError(f'Failed to set properties on dataset "{dataset}" running command: {cmd}') from e
+    inventory = find_inventory(dataset)
+    if inventory is not None:
+        inventory.update(dataset, properties)
+
+
+@tracing.traced('zfs.get_properties')
+async def get_properties(dataset, *keys):
+    """Get the current properties of the given dataset.
+
+    Served from the inventory if it covers the dataset and the keys.
+    """
+    if keys and find_inventory(dataset) is not None:
+        inventory = await _get_inventory(dataset)
+        current = inventory.lookup(dataset)
+        if current is not None and all(k in current for k in keys):
+            return {k:current[k] for k in keys}
+
+    cmd = ['zfs', 'get', '-Hp']
+    cmd.append(','.join(keys))
+    cmd.append(dataset)
+    log.debug('aiozfs.get_properties: %s', cmd)
+    try:
+        output = await _run(cmd)
+    except ZfsCommandError as e:
+        raise ZfsCommandError(f'Failed to get properties for dataset "{dataset}" running command: {cmd}') from e
+
+    return _parse_get_properties_output(output.splitlines())
+
+
+@tracing.traced('zfs.get_properties_many')
+async def get_properties_many(datasets, *keys, recursive=False, depth=None):
+    """Get the given properties of many datasets at once.
+
+    Return a dict mapping the given datasets and, if recursive is True,
+    their descendants up to depth levels deep to a dict of their properties.
+    Values of numeric properties are converted to numbers.
+    """
+    result = {}
+    async for record in iter_properties(datasets, *keys, recursive=recursive, depth=depth):
+        result.setdefault(record.name, {})[record.property] = record.value
+    return result
+
+
+async def iter_properties(datasets, *keys, recursive=False, depth=None):
+    """Like `get_properties_many` but yield a Property record per
+    dataset and property while the output of zfs is being read.
+
+    Memory use is constant regardless of the number of datasets.
+    """
+    if isinstance(datasets, str):
+        datasets = [datasets]
+    if depth is not None:
+        recursive = True
+    cmd = _get_properties_many_command(datasets, keys, recursive=recursive, depth=depth)
+    log.debug('aiozfs.iter_properties: %s', cmd)
+    try:
+        async for line in _iter_output(cmd):
+            record = _property_record(line)
+            yield Property(record.name, record.property, parse_property(record.property, record.value))
+    except ZfsCommandError as e:
+        raise ZfsCommandError(f'Failed to get properties for datasets {datasets} running command: {cmd}') from e
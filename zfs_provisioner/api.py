@@ -0,0 +1,133 @@
+"""Process-wide kubernetes_asyncio ApiClient shared by all handlers.
+
+Sharing a single client keeps its connections to the API server alive
+instead of paying for a new session and TLS handshake per API call.
+"""
+import logging
+import ssl
+
+from typing import Optional
+
+import aiohttp
+import kubernetes_asyncio
+
+from . import Error
+from . import metrics
+
+log = logging.getLogger('zfs-provisioner')
+
+
+CLIENT: Optional[kubernetes_asyncio.client.ApiClient] = None
+
+
+class ApiClientError(Error):
+    """Error raised when the shared ApiClient is used before it is opened.
+    """
+    pass
+
+
+def _ssl_context(configuration):
+    ssl_context = ssl.create_default_context(cafile=configuration.ssl_ca_cert)
+    if configuration.cert_file:
+        ssl_context.load_cert_chain(configuration.cert_file, keyfile=configuration.key_file)
+    if not configuration.verify_ssl:
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+    if getattr(configuration, 'disable_strict_ssl_verification', False):
+        ssl_context.verify_flags &= ~ssl.VERIFY_X509_STRICT
+    return ssl_context
+
+
+async def _on_request_start(session, context, params):
+    metrics.API_REQUESTS_IN_FLIGHT.inc()
+
+
+async def _on_request_end(session, context, params):
+    metrics.API_REQUESTS_IN_FLIGHT.dec()
+
+
+async def _on_connection_create_end(session, context, params):
+    metrics.API_CONNECTIONS.labels('created').inc()
+
+
+async def _on_connection_reuseconn(session, context, params):
+    metrics.API_CONNECTIONS.labels('reused').inc()
+
+
+def _trace_config():
+    """Return a TraceConfig that reports the use of the connection pool.
+    """
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(_on_request_start)
+    trace_config.on_request_end.append(_on_request_end)
+    trace_config.on_request_exception.append(_on_request_end)
+    trace_config.on_connection_create_end.append(_on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(_on_connection_reuseconn)
+    return trace_config
+
+
+class RESTClientObject(kubernetes_asyncio.client.rest.RESTClientObject):
+    """RESTClientObject whose session reports the use of its connection
+    pool and whose connector optionally keeps idle connections alive for
+    keepalive seconds, neither of which the one of kubernetes_asyncio allows.
+    """
+
+    def __init__(self, configuration, keepalive=None):
+        self.server_hostname = getattr(configuration, 'tls_server_name', None)
+        self.proxy = configuration.proxy
+        self.proxy_headers = configuration.proxy_headers
+        connector_args = {}
+        if keepalive is not None:
+            connector_args['keepalive_timeout'] = keepalive
+        connector = aiohttp.TCPConnector(
+            limit=configuration.connection_pool_maxsize,
+            ssl=_ssl_context(configuration),
+            **connector_args,
+        )
+        self.pool_manager = aiohttp.ClientSession(
+            connector=connector,
+            trust_env=True,
+            trace_configs=[_trace_config()],
+            # Like kubernetes_asyncio, for watch events of large objects.
+            read_bufsize=2**21,
+        )
+
+
+async def open_client(pool_size=100, keepalive=None):
+    """Create the shared ApiClient with a connection pool of the given size.
+
+    Idle connections are kept alive for keepalive seconds.
+    """
+    global CLIENT
+    configuration = kubernetes_asyncio.client.Configuration.get_default_copy()
+    configuration.connection_pool_maxsize = pool_size
+    CLIENT = kubernetes_asyncio.client.ApiClient(configuration)
+    # Replace the still unused default session.
+    await CLIENT.rest_client.close()
+    CLIENT.rest_client = RESTClientObject(configuration, keepalive)
+    log.debug('api.open_client: pool_size: %s, keepalive: %s', pool_size, keepalive)
+    metrics.API_POOL_SIZE.set(pool_size)
+    return CLIENT
+
+
+def get_client():
+    """Return the shared ApiClient.
+    """
+    if CLIENT is None:
+        raise ApiClientError('The shared ApiClient has not been opened')
+    return CLIENT
+
+
+def core_v1():
+    """Return a CoreV1Api using the shared ApiClient.
+    """
+    return kubernetes_asyncio.client.CoreV1Api(get_client())
+
+
+async def close_client():
+    """Close the shared ApiClient and its connections.
+    """
+    global CLIENT
+    if CLIENT is not None:
+        await CLIENT.close()
+        CLIENT = None
@@ -0,0 +1,185 @@
+"""Local cache of the PVCs, PVs and StorageClasses of the cluster.
+
+The PVs and StorageClasses are kept current from the events of the watches
+kopf runs for the handlers, like an informer. Besides by name, objects can
+be looked up by secondary indexes, so questions like "which PVs are on this
+node" are answered from memory instead of with LIST calls to the API server.
+
+The stores are only updated on the event loop. The objects are the bodies
+as received from the API server and must not be modified. PVCs are only
+cached with labelled PVCs, by the label selected watches of `pvcwatch`:
+`PVCS` holds the PVCs labelled as ours and `UNLABELLED_PVCS` the name and
+storage class of the PVCs still to label.
+"""
+import kopf
+import prometheus_client.core
+
+from . import metrics
+from .handlers import CONFIG
+
+
+class Store():
+    """Objects of one resource by key with secondary indexes.
+
+    `indexes` maps the name of each index to a function that returns the
+    values an object is indexed by.
+    """
+
+    def __init__(self, resource, indexes):
+        self.resource = resource
+        self.objects = {}
+        self._index_funcs = indexes
+        # Map of index name to a map of value to a map of key to object.
+        self._indexes = {index:{} for index in indexes}
+        # Map of key to the values of each index the object is indexed by.
+        self._indexed = {}
+
+    @staticmethod
+    def key(name, namespace=None):
+        return f'{namespace}/{name}' if namespace else name
+
+    def _key(self, obj):
+        metadata = obj['metadata']
+        return self.key(metadata['name'], metadata.get('namespace', None))
+
+    def _unindex(self, key):
+        for index,values in self._indexed.pop(key, {}).items():
+            entries = self._indexes[index]
+            for value in values:
+                objects = entries[value]
+                del objects[key]
+                if not objects:
+                    del entries[value]
+
+    def update(self, obj):
+        key = self._key(obj)
+        self._unindex(key)
+        self.objects[key] = obj
+        indexed = {}
+        for index,func in self._index_funcs.items():
+            values = indexed[index] = tuple(value for value in func(obj) if value is not None)
+            entries = self._indexes[index]
+            for value in values:
+                entries.setdefault(value, {})[key] = obj
+        self._indexed[key] = indexed
+
+    def delete(self, obj):
+        key = self._key(obj)
+        self._unindex(key)
+        self.objects.pop(key, None)
+
+    def replace(self, objects):
+        """Replace all objects, e.g. with the result of a LIST.
+        """
+        for obj in list(self.objects.values()):
+            self.delete(obj)
+        for obj in objects:
+            self.update(obj)
+
+    def apply(self, event):
+        """Apply a watch event as passed to kopf event handlers.
+        """
+        if event['type'] == 'DELETED':
+            self.delete(event['object'])
+        else:
+            self.update(event['object'])
+
+    def get(self, name, namespace=None):
+        return self.objects.get(self.key(name, namespace), None)
+
+    def by_index(self, index, value):
+        """Return the objects whose index has the given value.
+        """
+        return list(self._indexes[index].get(value, {}).values())
+
+    def index_values(self, index):
+        return list(self._indexes[index])
+
+    def __len__(self):
+        return len(self.objects)
+
+
+def _pv_nodes(pv):
+    affinity = pv['spec'].get('nodeAffinity', None) or {}
+    for term in affinity.get('required', {}).get('nodeSelectorTerms', None) or []:
+        for expression in term.get('matchExpressions', None) or []:
+            if expression['key'] == 'kubernetes.io/hostname' and expression['operator'] == 'In':
+                yield from expression.get('values', None) or []
+
+
+def _pv_claim(pv):
+    claim = pv['spec'].get('claimRef', None)
+    if claim:
+        yield Store.key(claim['name'], claim.get('namespace', None))
+
+
+def _pvc_storage_class(pvc):
+    return (pvc['spec'].get('storageClassName', None),)
+
+
+PVCS = Store('persistentvolumeclaims', {
+    'storage_class': _pvc_storage_class,
+})
+PVS = Store('persistentvolumes', {
+    'node': _pv_nodes,
+    'claim': _pv_claim,
+})
+# Kept current by handlers.cache_storage_class.
+STORAGE_CLASSES = Store('storageclasses', {
+    'provisioner': lambda storage_class: (storage_class.get('provisioner', None),),
+})
+UNLABELLED_PVCS = Store('persistentvolumeclaims', {
+    'storage_class': _pvc_storage_class,
+})
+
+for _store in (PVCS, PVS, STORAGE_CLASSES):
+    metrics.CACHED_OBJECTS.labels(_store.resource).set_function(_store.__len__)
+
+
+def pvcs_by_storage_class(storage_class_name):
+    return PVCS.by_index('storage_class', storage_class_name)
+
+
+def pvs_by_node(node_name):
+    return PVS.by_index('node', node_name)
+
+
+def pv_by_claim(namespace, name):
+    pvs = PVS.by_index('claim', Store.key(name, namespace))
+    return pvs[0] if pvs else None
+
+
+def storage_classes_by_provisioner(provisioner_name):
+    return STORAGE_CLASSES.by_index('provisioner', provisioner_name)
+
+
+def unlabelled_pvcs_by_storage_class(storage_class_name):
+    return UNLABELLED_PVCS.by_index('storage_class', storage_class_name)
+
+
+class VolumesCollector():
+    """Report the number of PVs provisioned by us on each node.
+
+    Collected from the thread of the metrics server, so only reads copies
+    of the store.
+    """
+
+    def collect(self):
+        family = prometheus_client.core.GaugeMetricFamily('zfs_provisioner_volumes',
+            'Number of persistent volumes provisioned by this provisioner by node.',
+            labels=('node',))
+        for node_name in PVS.index_values('node'):
+            count = sum(1 for pv in pvs_by_node(node_name)
+                if (pv['metadata'].get('annotations', None) or {}).get(
+                    'pv.kubernetes.io/provisioned-by', None) == CONFIG.provisioner_name)
+            if count:
+                family.add_metric((node_name,), count)
+        yield family
+
+
+prometheus_client.REGISTRY.register(VolumesCollector())
+
+
+@kopf.on.event('', 'v1', 'persistentvolumes')
+async def on_pv_event(event, **_):
+    PVS.apply(event)
@@ -1,17 +1,23 @@
 import logging
-import os
 import sys
 
 import click
 
+from . import node
 from . import zfs
 
 
 @click.group(name='zfs-provisioner')
 @click.option('--verbose', '-v', 'log_level', flag_value='info', help='set log level to info', envvar='ZFS_PROVISIONER_LOG_LEVEL')
 @click.option('--debug', '-d', 'log_level', flag_value='debug', help='set log level to debug', envvar='ZFS_PROVISIONER_LOG_LEVEL')
+@click.option('--zfs-backend', help='Backend used to run zfs operations.',
+    type=click.Choice(sorted(zfs.BACKENDS)), envvar='ZFS_PROVISIONER_ZFS_BACKEND',
+    default='cli', show_default=True)
+@click.option('--zfs-channel-program/--no-zfs-channel-program', help='Inspect parent datasets with '
+    'a single read-only channel program before creating datasets (cli backend only).',
+    envvar='ZFS_PROVISIONER_ZFS_CHANNEL_PROGRAM', default=False, show_default=True)
 @click.pass_context
-def main(ctx, log_level):
+def main(ctx, log_level, zfs_backend, zfs_channel_program):
     """ZFS volume provisoner for kubernetes.
     """
     setattr(ctx, 'obj', {})
@@ -24,6 +30,14 @@ def main(ctx, log_level):
     ctx.obj['log_level'] = log_level
     ctx.obj['log'] = log
 
+    ctx.obj['zfs_backend'] = zfs_backend
+    ctx.obj['zfs_channel_program'] = zfs_channel_program
+
+    if zfs_backend == zfs.CliBackend.name:
+        zfs.set_backend(zfs_backend, channel_program=zfs_channel_program)
+    else:
+        zfs.set_backend(zfs_backend)
+
 
 @main.command(name='controller', short_help='start controller')
 @click.option('--provisioner', 'provisioner_name', help='Specify Provisioner name.',
@@ -31,6 +45,12 @@ def main(ctx, log_level):
 @click.option('--namespace', help='The namespace the Provisioner is running in.',
     envvar='NAMESPACE')
 @click.option('--config', help='Provisioner configuration file.', envvar='CONFIG')
+@click.option('--config-reload-delay', help='Seconds to wait for further changes of the '
+    'configuration file before reloading it.', type=float, envvar='CONFIG_RELOAD_DELAY')
+@click.option('--config-map', help='Watch this ConfigMap in the namespace of the provisioner '
+    'for the configuration through the API instead of reading --config.', envvar='CONFIG_MAP')
+@click.option('--config-map-key', help='Key of the configuration in the ConfigMap.',
+    envvar='CONFIG_MAP_KEY')
 @click.option('--parent-dataset', help='Name of the parent dataset under which to create the datasets.',
     envvar='PARENT_DATASET')
 @click.option('--dataset-mount-dir', help='Directory under which to mount the created persistent volumes.',
@@ -39,19 +59,72 @@ def main(ctx, log_level):
     envvar='CONTAINER_IMAGE')
 @click.option('--node-name', help='The name of the node on which the provisioner is running.',
     envvar='NODE_NAME')
+@click.option('--agent-port', help='Port of the node agents. Use node agents instead of pods if given.',
+    type=int, envvar='AGENT_PORT')
+@click.option('--agent-token', help='Shared secret to present to the node agents, required with --agent-port.',
+    envvar='AGENT_TOKEN')
+@click.option('--create-timeout', help='Seconds after which creating a dataset is aborted and retried.',
+    type=float, envvar='CREATE_TIMEOUT')
+@click.option('--delete-timeout', help='Seconds after which deleting a dataset is aborted and retried.',
+    type=float, envvar='DELETE_TIMEOUT')
+@click.option('--retry-delay', help='Seconds to wait before retrying a failed dataset action.',
+    type=float, envvar='RETRY_DELAY')
+@click.option('--max-retries', help='Number of retries after which a failed dataset action is given up.',
+    type=int, envvar='MAX_RETRIES')
+@click.option('--max-concurrent-actions', help='Maximum number of concurrently running dataset actions.',
+    type=int, envvar='MAX_CONCURRENT_ACTIONS')
+@click.option('--max-concurrent-actions-per-node', help='Maximum number of concurrently running '
+    'dataset actions per node.', type=int, envvar='MAX_CONCURRENT_ACTIONS_PER_NODE')
+@click.option('--api-pool-size', help='Maximum number of connections to the API server.',
+    type=int, envvar='API_POOL_SIZE')
+@click.option('--api-keepalive', help='Seconds idle connections to the API server are kept alive.',
+    type=float, envvar='API_KEEPALIVE')
+@click.option('--metrics-address', help='Address to serve the prometheus metrics on.',
+    envvar='METRICS_ADDRESS')
+@click.option('--metrics-port', help='Port to serve the prometheus metrics on, 0 to disable them.',
+    type=int, envvar='METRICS_PORT')
+@click.option('--trace-file', help='Append trace spans as JSON lines to this file.',
+    envvar='TRACE_FILE')
+@click.option('--worker-trace-file', help='File below the dataset mount dir that the dataset pods '
+    'append their trace spans to.', envvar='WORKER_TRACE_FILE')
+@click.option('--profile-dir', help='Directory to write profiles to.', envvar='PROFILE_DIR')
+@click.option('--profile-seconds', help='Default duration of a profiling session.',
+    type=float, envvar='PROFILE_SECONDS')
+@click.option('--admin-address', help='Address of the admin endpoint.', envvar='ADMIN_ADDRESS')
+@click.option('--admin-port', help='Port of the admin endpoint that starts profiling sessions, '
+    '0 to disable it.', type=int, envvar='ADMIN_PORT')
+@click.option('--label-pvcs/--no-label-pvcs', help='Label the PVCs of our storage classes and only '
+    'handle the labelled ones.', default=None, envvar='LABEL_PVCS')
+@click.option('--managed-label', help='Key of the label the PVCs of our storage classes get, '
+    'its value is the provisioner name.', envvar='MANAGED_LABEL')
+@click.option('--loop-lag-interval', help='Seconds between measurements of the event loop lag.',
+    type=float, envvar='LOOP_LAG_INTERVAL')
+@click.option('--slow-callback-threshold', help='Log the stack of callbacks that block the event '
+    'loop for longer than this many seconds, 0 to disable it.', type=float,
+    envvar='SLOW_CALLBACK_THRESHOLD')
 @click.option('--kl', 'set_kopf_log_level', help='also set kopf\'s log level',
     is_flag=True, default=False)
 @click.pass_context
-def controller(ctx, provisioner_name, namespace, config, container_image,
-        node_name, parent_dataset, dataset_mount_dir, set_kopf_log_level):
+def controller(ctx, provisioner_name, namespace, config, config_reload_delay, config_map,
+        config_map_key, container_image, node_name, parent_dataset, dataset_mount_dir,
+        agent_port, agent_token, create_timeout, delete_timeout, retry_delay, max_retries,
+        max_concurrent_actions, max_concurrent_actions_per_node, api_pool_size, api_keepalive,
+        metrics_address, metrics_port, trace_file, worker_trace_file, profile_dir,
+        profile_seconds, admin_address, admin_port, label_pvcs, managed_label,
+        loop_lag_interval, slow_callback_threshold, set_kopf_log_level):
     log = ctx.obj['log']
     log.debug('controller: provisioner_name: %s', provisioner_name)
     log.debug('controller: namespace: %s', namespace)
     log.debug('controller: config: %s', config)
+    log.debug('controller: config_map: %s', config_map)
     log.debug('controller: container_image: %s', container_image)
     log.debug('controller: node_name: %s', node_name)
     log.debug('controller: parent_dataset: %s', parent_dataset)
     log.debug('controller: dataset_mount_dir: %s', dataset_mount_dir)
+    log.debug('controller: agent_port: %s', agent_port)
+
+    if agent_port and not agent_token:
+        raise click.UsageError('--agent-token is required with --agent-port')
 
     if set_kopf_log_level:
         logging.getLogger('kopf').setLevel(log.getEffectiveLevel())
@@ -64,16 +137,102 @@ def controller(ctx, provisioner_name, namespace, config, container_image,
         namespace=namespace,
         parent_dataset=parent_dataset,
         config=config,
+        config_reload_delay=config_reload_delay,
+        config_map=config_map,
+        config_map_key=config_map_key,
         container_image=container_image,
         node_name=node_name,
         dataset_mount_dir=dataset_mount_dir,
+        agent_port=agent_port,
+        agent_token=agent_token,
+        action_timeouts={'create': create_timeout, 'delete': delete_timeout},
+        retry_delay=retry_delay,
+        max_retries=max_retries,
+        max_concurrent_actions=max_concurrent_actions,
+        max_concurrent_actions_per_node=max_concurrent_actions_per_node,
+        api_pool_size=api_pool_size,
+        api_keepalive=api_keepalive,
+        metrics_address=metrics_address,
+        metrics_port=metrics_port,
+        trace_file=trace_file,
+        worker_trace_file=worker_trace_file,
+        profile_dir=profile_dir,
+        profile_seconds=profile_seconds,
+        admin_address=admin_address,
+        admin_port=admin_port,
+        label_pvcs=label_pvcs,
+        managed_label=managed_label,
+        loop_lag_interval=loop_lag_interval,
+        slow_callback_threshold=slow_callback_threshold,
     )
 
+    # With labelled PVCs only the labelled ones are watched, by handlers.startup.
+    if not handlers.CONFIG.label_pvcs:
+        handlers.register_pvc_handlers()
+
     log.info('Starting controller ...')
     from kopf.reactor import running
     running.run()
 
 
+@main.command(name='agent', short_help='start node agent')
+@click.option('--listen-address', help='Address the agent listens on.',
+    envvar='AGENT_LISTEN_ADDRESS', default='0.0.0.0', show_default=True)
+@click.option('--port', help='Port the agent listens on.', type=int,
+    envvar='AGENT_PORT', default=8476, show_default=True)
+@click.option('--token', help='Shared secret the controller has to present.',
+    envvar='AGENT_TOKEN', required=True)
+@click.option('--dataset-mount-dir', help='Directory under which the persistent volumes are mounted.',
+    envvar='DATASET_MOUNT_DIR', required=True)
+@click.option('--allowed-parent', 'allowed_parents', multiple=True, required=True,
+    help='Only create and destroy datasets below this dataset. Can be given multiple times.',
+    envvar='AGENT_ALLOWED_PARENTS')
+@click.option('--max-concurrency', help='Maximum number of concurrently running zfs commands.',
+    type=int, envvar='AGENT_MAX_CONCURRENCY', default=16, show_default=True)
+@click.option('--zfs-timeout', help='Seconds after which a running zfs command is killed.',
+    type=float, envvar='AGENT_ZFS_TIMEOUT', default=60, show_default=True)
+@click.option('--inventory-root', 'inventory_roots', multiple=True,
+    help='Cache the datasets below this dataset in memory. Can be given multiple times.',
+    envvar='AGENT_INVENTORY_ROOTS')
+@click.option('--inventory-ttl', help='Seconds after which the dataset cache is refreshed.',
+    type=float, envvar='AGENT_INVENTORY_TTL', default=60, show_default=True)
+@click.option('--trace-file', help='Append trace spans as JSON lines to this file.',
+    envvar='AGENT_TRACE_FILE')
+@click.pass_context
+def agent(ctx, listen_address, port, token, dataset_mount_dir, allowed_parents, max_concurrency,
+        zfs_timeout, inventory_roots, inventory_ttl, trace_file):
+    """Run the node agent that creates and destroys datasets
+    on behalf of the controller.
+    """
+    log = ctx.obj['log']
+    if ctx.obj['zfs_backend'] != zfs.CliBackend.name:
+        # The agent runs the zfs commands asynchronously through aiozfs.
+        raise click.UsageError(f'The agent only supports the {zfs.CliBackend.name} zfs backend')
+    log.debug('agent: listen_address: %s', listen_address)
+    log.debug('agent: port: %s', port)
+    log.debug('agent: dataset_mount_dir: %s', dataset_mount_dir)
+    log.debug('agent: allowed_parents: %s', allowed_parents)
+
+    log.debug('agent: max_concurrency: %s', max_concurrency)
+    log.debug('agent: zfs_timeout: %s', zfs_timeout)
+
+    log.debug('agent: inventory_roots: %s', inventory_roots)
+
+    for root in inventory_roots:
+        zfs.enable_inventory(root, ttl=inventory_ttl)
+
+    from . import tracing
+    tracing.configure(trace_file)
+
+    from . import aiozfs
+    aiozfs.configure(max_concurrency=max_concurrency, timeout=zfs_timeout,
+        channel_program=ctx.obj['zfs_channel_program'])
+
+    log.info('Starting agent ...')
+    from . import agent as node_agent
+    node_agent.run(listen_address, port, dataset_mount_dir, token, allowed_parents)
+
+
 @main.group(name='dataset', short_help='manage datasets')
 @click.pass_context
 def dataset(ctx):
@@ -96,18 +255,7 @@ def dataset_create(ctx, dataset, mountpoint, quota, refquota):
     log = ctx.obj['log']
     log.debug('%s: %s', ctx.info_name, ctx.params)
 
-    # Ensure we have parent dataset whith mountpoint set to legacy.
-    parent = os.path.split(dataset)[0]
-    zfs.ensure(parent, mountpoint='legacy')
-
-    # Ensure the mountpoints parent folder exists and has safe permissions.
-    mountpoint_dir = os.path.split(mountpoint)[0]
-    os.makedirs(mountpoint_dir, mode=0o700, exist_ok=True)
-    os.chmod(mountpoint_dir, 0o700)
-
-    # Create our dataset and ensure it is writable by the pod.
-    zfs.create(dataset, mountpoint=mountpoint, quota=quota, refquota=refquota)
-    os.chmod(mountpoint, 0o777)
+    node.create_dataset(dataset, mountpoint, quota=quota, refquota=refquota)
 
 
 @dataset.command(name='destroy', short_help='destroy dataset')
@@ -120,11 +268,7 @@ def dataset_destroy(ctx, dataset, mountpoint):
     log = ctx.obj['log']
     log.debug('%s: %s', ctx.info_name, ctx.params)
 
-    # Destroy the dataset.
-    zfs.destroy(dataset)
-
-    # Delete the mountpint.
-    os.rmdir(mountpoint)
+    node.destroy_dataset(dataset, mountpoint)
 
 
 if __name__ == '__main__':
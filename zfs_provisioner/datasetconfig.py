@@ -0,0 +1,250 @@
+"""The dataset config of the controller, read from a json file.
+
+The content is validated and turned into an immutable `DatasetConfig`
+snapshot. A reload replaces the snapshot as a whole, so handlers that hold
+a reference to it never see a half updated config.
+
+The parent dataset of a node is looked up in this order:
+
+1. exact node names in `node_dataset_map` or `node` rules without wildcards
+2. glob patterns in `node_dataset_map` or `node` rules, the pattern with the
+   longest literal prefix wins, ties are broken by their order
+3. `regex` rules in their order, matched against the whole node name
+4. `labels` rules in their order, all labels have to match
+5. `__default__` in `node_dataset_map`
+
+The rules are compiled once per snapshot and the result for each node is
+cached until the next reload, including the ones of label rules.
+"""
+import dataclasses
+import fnmatch
+import hashlib
+import json
+import re
+import types
+
+from typing import Dict, Mapping, Optional, Tuple
+
+from . import Error
+
+
+# Key of the node_dataset_map entry used for nodes that are not listed.
+DEFAULT_NODE = '__default__'
+
+# Characters that make a node name a glob pattern.
+GLOB_CHARS = re.compile(r'[*?\[]')
+
+
+class ConfigError(Error):
+    """Error raised for an invalid dataset config.
+    """
+    pass
+
+
+@dataclasses.dataclass(frozen=True)
+class Rule:
+    """A rule of node_dataset_rules, matches by exactly one of node, regex or labels.
+    """
+    dataset: str
+    node: Optional[str] = None
+    regex: Optional[str] = None
+    labels: Optional[Mapping[str, str]] = None
+
+
+class PrefixTrie():
+    """Map of glob patterns indexed by their literal prefix.
+    """
+
+    def __init__(self):
+        self.root = {}
+
+    def insert(self, pattern, value):
+        prefix = GLOB_CHARS.split(pattern, 1)[0]
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        matches = re.compile(fnmatch.translate(pattern)).match
+        node.setdefault(None, []).append((matches, value))
+
+    def lookup(self, name):
+        """Return the value of the first matching pattern with the longest prefix.
+        """
+        found = []
+        node = self.root
+        for char in name:
+            if None in node:
+                found.append(node[None])
+            node = node.get(char, None)
+            if node is None:
+                break
+        else:
+            if None in node:
+                found.append(node[None])
+        for patterns in reversed(found):
+            for matches,value in patterns:
+                if matches(name):
+                    return value
+        return None
+
+
+class NodeDatasetMatcher():
+    """Compiled node_dataset_map and node_dataset_rules.
+    """
+
+    def __init__(self, node_dataset_map, rules):
+        self.exact = {}
+        self.globs = PrefixTrie()
+        self.regexes = []
+        self.selectors = []
+        for node,dataset in node_dataset_map.items():
+            if node != DEFAULT_NODE:
+                self._add_node(node, dataset)
+        for rule in rules:
+            if rule.node is not None:
+                self._add_node(rule.node, rule.dataset)
+            elif rule.regex is not None:
+                self.regexes.append((re.compile(rule.regex).fullmatch, rule.dataset))
+            else:
+                self.selectors.append((tuple(rule.labels.items()), rule.dataset))
+        self.default = node_dataset_map.get(DEFAULT_NODE, None)
+
+    def _add_node(self, node, dataset):
+        if GLOB_CHARS.search(node):
+            self.globs.insert(node, dataset)
+        else:
+            # The first entry for a node wins, like for patterns.
+            self.exact.setdefault(node, dataset)
+
+    def match(self, node, labels=None):
+        try:
+            return self.exact[node]
+        except KeyError:
+            pass
+        dataset = self.globs.lookup(node)
+        if dataset is not None:
+            return dataset
+        for matches,dataset in self.regexes:
+            if matches(node):
+                return dataset
+        if labels:
+            for selector,dataset in self.selectors:
+                if all(labels.get(key, None) == value for key,value in selector):
+                    return dataset
+        return self.default
+
+
+@dataclasses.dataclass(frozen=True)
+class DatasetConfig:
+    # Map of node names or glob patterns to the parent dataset to create datasets in.
+    node_dataset_map: Mapping[str, str] = dataclasses.field(
+        default_factory=lambda: types.MappingProxyType({}))
+    # Ordered rules matching nodes by glob pattern, regex or labels.
+    node_dataset_rules: Tuple[Rule, ...] = ()
+    # sha256 of the content the config was parsed from.
+    digest: Optional[str] = None
+
+    matcher: NodeDatasetMatcher = dataclasses.field(init=False, repr=False, compare=False)
+    _cache: Dict[str, Optional[str]] = dataclasses.field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, 'matcher',
+            NodeDatasetMatcher(self.node_dataset_map, self.node_dataset_rules))
+        object.__setattr__(self, '_cache', {})
+
+    @property
+    def uses_labels(self):
+        return bool(self.matcher.selectors)
+
+    def is_cached(self, node):
+        return node in self._cache
+
+    def parent_dataset(self, node, default, labels=None):
+        """Return the parent dataset for the given node, or default if no rule matches.
+        The labels of the node are only needed if `uses_labels` is true.
+        """
+        try:
+            dataset = self._cache[node]
+        except KeyError:
+            dataset = self._cache[node] = self.matcher.match(node, labels)
+        return default if dataset is None else dataset
+
+
+def get_digest(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def _reject_duplicates(pairs):
+    result = {}
+    for key,value in pairs:
+        if key in result:
+            raise ConfigError(f'Duplicate key: {key}')
+        result[key] = value
+    return result
+
+
+def _validate_dataset(owner, dataset):
+    if not isinstance(dataset, str) or not dataset:
+        raise ConfigError(f'Dataset of {owner} has to be a non-empty string')
+    if dataset.startswith('/') or dataset.endswith('/'):
+        raise ConfigError(f'Dataset of {owner} can not start or end with /: {dataset}')
+
+
+def _validate_node_dataset_map(node_dataset_map):
+    if not isinstance(node_dataset_map, dict):
+        raise ConfigError('node_dataset_map has to be an object')
+    for node,dataset in node_dataset_map.items():
+        _validate_dataset(f'node {node}', dataset)
+
+
+def _parse_rule(index, data):
+    if not isinstance(data, dict):
+        raise ConfigError(f'Rule {index} of node_dataset_rules has to be an object')
+    unknown = set(data) - {field.name for field in dataclasses.fields(Rule)}
+    if unknown:
+        raise ConfigError(f'Unknown keys in rule {index}: {", ".join(sorted(unknown))}')
+    matchers = [key for key in ('node', 'regex', 'labels') if key in data]
+    if len(matchers) != 1:
+        raise ConfigError(f'Rule {index} needs exactly one of node, regex or labels')
+    key = matchers[0]
+    value = data[key]
+    _validate_dataset(f'rule {index}', data.get('dataset', None))
+    if key == 'labels':
+        if not isinstance(value, dict) or not value or not all(
+                isinstance(v, str) for v in value.values()):
+            raise ConfigError(f'Labels of rule {index} have to be a non-empty object of strings')
+        value = types.MappingProxyType(value)
+    elif not isinstance(value, str) or not value:
+        raise ConfigError(f'{key} of rule {index} has to be a non-empty string')
+    elif key == 'regex':
+        try:
+            re.compile(value)
+        except re.error as e:
+            raise ConfigError(f'Invalid regex in rule {index}: {e}') from e
+    return Rule(**{'dataset': data['dataset'], key: value})
+
+
+def _parse_node_dataset_rules(rules):
+    if not isinstance(rules, list):
+        raise ConfigError('node_dataset_rules has to be a list')
+    return tuple(_parse_rule(index, rule) for index,rule in enumerate(rules))
+
+
+def parse(content: bytes) -> DatasetConfig:
+    """Parse and validate the content of a config file.
+    """
+    try:
+        data = json.loads(content, object_pairs_hook=_reject_duplicates)
+    except ValueError as e:
+        raise ConfigError(f'Invalid json: {e}') from e
+    if not isinstance(data, dict):
+        raise ConfigError('The config has to be a json object')
+    unknown = set(data) - {'node_dataset_map', 'node_dataset_rules'}
+    if unknown:
+        raise ConfigError(f'Unknown keys: {", ".join(sorted(unknown))}')
+    node_dataset_map = data.get('node_dataset_map', {})
+    _validate_node_dataset_map(node_dataset_map)
+    return DatasetConfig(
+        node_dataset_map=types.MappingProxyType(node_dataset_map),
+        node_dataset_rules=_parse_node_dataset_rules(data.get('node_dataset_rules', [])),
+        digest=get_digest(content),
+    )
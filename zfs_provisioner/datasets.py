@@ -1,15 +1,20 @@
 import asyncio
 import dataclasses
 import logging
+import time
 
 from typing import Optional, Dict, List
 
-import bitmath
 import kopf
 import kubernetes_asyncio
-import yaml
 
-from . import get_template
+from . import agent
+from . import api
+from . import manifests
+from . import metrics
+from . import quantity
+from . import scheduler
+from . import tracing
 from .handlers import CONFIG
 
 log = logging.getLogger('zfs-provisioner')
@@ -20,10 +25,28 @@ EVENTS: Dict = {
     'delete': {},
 }
 
-POD_TEMPLATE: str = get_template('dataset-pod.yaml')
+for _action in EVENTS:
+    metrics.POD_EVENTS.labels(_action).set_function(
+        lambda action=_action: len(EVENTS[action]))
+
+# Monotonic time the dataset pods, by uid, have been seen running.
+POD_STARTED: Dict[str, float] = {}
+
+# Name of the latest failed pod of each dataset operation, by namespace and
+# base pod name. Only that one is kept for inspection.
+FAILED_PODS: Dict[str, str] = {}
 
 ACTION_ANNOTATION = 'zfs-provisioner/action-test'
 
+# Client used to talk to the node agents, created on first use.
+AGENT_CLIENT: Optional[agent.Client] = None
+
+# Cache of node name to the address its agent is reachable at.
+NODE_ADDRESSES: Dict[str, str] = {}
+
+# Limits the concurrently running dataset operations, created on first use.
+SCHEDULER: Optional[scheduler.Scheduler] = None
+
 
 @dataclasses.dataclass
 class Dataset():
@@ -45,43 +68,144 @@ class Dataset():
 
 
 def size_in_bytes(size):
-    if size[-1:] == 'i':
-        # Turn e.g. Gi into GiB so that bitmath understands it.
-        size = size + 'B'
-    return int(bitmath.parse_string(size).bytes)
+    return quantity.to_bytes(size)
 
 
 def _get_pod(pod_name, node_name, image, dataset_mount_dir, pod_args):
-    text = POD_TEMPLATE.format(
+    data = manifests.DATASET_POD.render(
         pod_name=pod_name,
         node_name=node_name,
         image=image,
         dataset_mount_dir=dataset_mount_dir,
         log_level=logging.getLevelName(log.getEffectiveLevel()),
     )
-    data = yaml.safe_load(text)
-    data['spec']['containers'][0]['args'] = pod_args
+    container = data['spec']['containers'][0]
+    container['args'] = pod_args
+    # Let the worker continue the trace of the current operation.
+    traceparent = tracing.current_traceparent()
+    if traceparent is not None:
+        container['env'].append({'name': tracing.TRACEPARENT_ENV, 'value': traceparent})
+        if CONFIG.worker_trace_file:
+            container['env'].append({'name': tracing.TRACE_FILE_ENV, 'value': CONFIG.worker_trace_file})
     return data
 
 
+async def _get_node_address(node_name):
+    try:
+        return NODE_ADDRESSES[node_name]
+    except KeyError:
+        pass
+    v1 = api.core_v1()
+    obj = await v1.read_node(node_name)
+    addresses = {a.type: a.address for a in obj.status.addresses or []}
+    # The agents use the host network, prefer the internal address.
+    address = addresses.get('InternalIP', addresses.get('Hostname', node_name))
+    NODE_ADDRESSES[node_name] = address
+    return address
+
+
+async def _call_agent(action, node_name, **params):
+    global AGENT_CLIENT
+    if AGENT_CLIENT is None:
+        AGENT_CLIENT = agent.Client(port=CONFIG.agent_port, token=CONFIG.agent_token)
+    address = await _get_node_address(node_name)
+    timeout = CONFIG.action_timeouts[action]
+    log.debug('calling agent on %s (%s): %s %s', node_name, address, action, params)
+    try:
+        with tracing.span('agent.call', node=node_name, address=address):
+            result = await asyncio.wait_for(AGENT_CLIENT.call(address, action, **params), timeout)
+    except asyncio.TimeoutError:
+        raise kopf.TemporaryError(f'Agent on {node_name} did not {action} dataset '
+            f'"{params["dataset"]}" within {timeout}s', delay=CONFIG.retry_delay)
+    except agent.AgentError as e:
+        # The node may have changed its address, look it up again next time.
+        NODE_ADDRESSES.pop(node_name, None)
+        raise kopf.TemporaryError(str(e), delay=CONFIG.retry_delay) from e
+    metrics.observe_stage(action, 'zfs', result['duration'])
+    return result
+
+
+def _get_scheduler():
+    global SCHEDULER
+    if SCHEDULER is None:
+        SCHEDULER = scheduler.Scheduler(
+            limit=CONFIG.max_concurrent_actions,
+            node_limit=CONFIG.max_concurrent_actions_per_node,
+        )
+    return SCHEDULER
+
+
+async def close():
+    """Release the resources held for talking to the node agents.
+    """
+    global AGENT_CLIENT
+    if AGENT_CLIENT is not None:
+        await AGENT_CLIENT.close()
+        AGENT_CLIENT = None
+
+
+async def _delete_pod(name, namespace):
+    v1 = api.core_v1()
+    log.debug('deleting dataset handling pod: %s', name)
+    try:
+        await v1.delete_namespaced_pod(name, namespace)
+    except kubernetes_asyncio.client.exceptions.ApiException as e:
+        if e.status != 404:
+            raise
+
+
 async def _run_pod(action, pod_name, body, namespace):
+    operation = f'{namespace}/{pod_name}'
     # Label the pod for filtering in the on.event handler.
     kopf.label(body, {ACTION_ANNOTATION: action})
-    event = asyncio.Event()
+    # The latest failed pod is kept for inspection, let retries use a new name.
+    del body['metadata']['name']
+    body['metadata']['generateName'] = f'{pod_name}-'
+    pod_event = asyncio.get_running_loop().create_future()
 
-    obj = None
-    async with kubernetes_asyncio.client.ApiClient() as api:
-        v1 = kubernetes_asyncio.client.CoreV1Api(api)
+    v1 = api.core_v1()
+    with metrics.time_stage(action, 'pod_create'), tracing.span('pod.create'):
         obj = await v1.create_namespaced_pod(
             body=body,
             namespace=namespace,
         )
-        EVENTS[action][obj.metadata.uid] = event
+    created = time.monotonic()
+    uid = obj.metadata.uid
+    pod_name = obj.metadata.name
+    EVENTS[action][uid] = pod_event
 
-    # TODO: handle timeout and error
+    timeout = CONFIG.action_timeouts[action]
     log.debug('waiting for pod_event: %s', pod_name)
-    await event.wait()
-    log.debug('pod_event has been set: %s', pod_name)
+    try:
+        with tracing.span('pod.wait', pod=pod_name) as span:
+            phase = await asyncio.wait_for(pod_event, timeout)
+            span.set_attribute('phase', phase)
+    except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+        # Do not leave the pod and the event behind. Shield the cleanup
+        # so it also completes if we were cancelled.
+        EVENTS[action].pop(uid, None)
+        POD_STARTED.pop(uid, None)
+        await asyncio.shield(_delete_pod(pod_name, namespace))
+        if isinstance(e, asyncio.TimeoutError):
+            raise kopf.TemporaryError(f'Pod {pod_name} did not {action} dataset within {timeout}s',
+                delay=CONFIG.retry_delay)
+        raise
+    log.debug('pod_event has been set: %s: %s', pod_name, phase)
+    # Pods that finish quickly may never be seen running,
+    # attribute all of their time to the zfs stage then.
+    started = POD_STARTED.pop(uid, created)
+    metrics.observe_stage(action, 'pod_running', started - created)
+    metrics.observe_stage(action, 'zfs', time.monotonic() - started)
+
+    # The pod of an earlier attempt is no longer of interest.
+    previous = FAILED_PODS.pop(operation, None)
+    if previous is not None:
+        await _delete_pod(previous, namespace)
+
+    if phase == 'Failed':
+        FAILED_PODS[operation] = pod_name
+        raise kopf.TemporaryError(f'Pod {pod_name} failed to {action} dataset',
+            delay=CONFIG.retry_delay)
     return obj
 
 
@@ -94,36 +218,58 @@ async def on_event(event, name, namespace, meta, status, **_):
 
         phase = status['phase']
 
-        if phase in ('Succeeded', 'Failed'):
+        if phase == 'Running':
+            if meta.uid in EVENTS[meta.labels[ACTION_ANNOTATION]]:
+                POD_STARTED.setdefault(meta.uid, time.monotonic())
+
+        elif phase in ('Succeeded', 'Failed'):
             action = meta.labels[ACTION_ANNOTATION]
             log.debug('dataset %s: %s -> %s', name, action, phase)
 
-            # Mark this event as done.
-            pod_event = EVENTS[action].pop(meta.uid)
-            pod_event.set()
+            # Mark this event as done, unless its waiter already gave up.
+            pod_event = EVENTS[action].pop(meta.uid, None)
+            if pod_event is not None and not pod_event.done():
+                pod_event.set_result(phase)
 
             # All done. Delete the pod.
             # TODO: in case of failure get errors and store them somewhere?
             if phase == 'Succeeded':
-                # For now keep failed pods around for inspection.
-                async with kubernetes_asyncio.client.ApiClient() as api:
-                    v1 = kubernetes_asyncio.client.CoreV1Api(api)
-                    log.debug('deleting dataset handling pod: %s', name)
-                    await v1.delete_namespaced_pod(name, namespace)
+                # The latest failed pod of each operation is kept around
+                # for inspection, see _run_pod.
+                await _delete_pod(name, namespace)
 
 
 async def create(dataset: Dataset, namespace: str):
     """
-    - run pod that creates the dataset
+    - wait until the scheduler allows the operation to run
+    - run pod, or call the node agent, that creates the dataset
     - wait for it to complete
     - return success or error message
     """
+    with tracing.span('dataset.create', dataset=dataset.full_name, node=dataset.selected_node) as span:
+        enqueued = time.monotonic()
+        async with _get_scheduler().slot(namespace, dataset.selected_node):
+            waited = time.monotonic() - enqueued
+            metrics.observe_stage('create', 'queue', waited)
+            span.set_attribute('queue_wait', waited)
+            return await _create(dataset, namespace)
+
+
+async def _create(dataset, namespace):
     log.debug('dataset.create: %s in namespace: %s', dataset, namespace)
 
     action = 'create'
+    if CONFIG.agent_port:
+        refquota = None
+        if dataset.size:
+            refquota = str(size_in_bytes(dataset.size))
+        return await _call_agent(action, dataset.selected_node,
+            dataset=dataset.full_name, mountpoint=dataset.mount_point,
+            refquota=refquota)
+
     pod_name = f'{dataset.name}-{action}'
 
-    pod_args = ['dataset', 'create']
+    pod_args = ['create']
     if dataset.size:
         size = size_in_bytes(dataset.size)
         pod_args.extend(['--refquota', str(size)])
@@ -141,16 +287,31 @@ async def create(dataset: Dataset, namespace: str):
 
 async def delete(dataset, namespace):
     """
-    - run pod that destroys the dataset
+    - wait until the scheduler allows the operation to run
+    - run pod, or call the node agent, that destroys the dataset
     - wait for it to complete
     - return success or error message
     """
+    with tracing.span('dataset.delete', dataset=dataset.full_name, node=dataset.selected_node) as span:
+        enqueued = time.monotonic()
+        async with _get_scheduler().slot(namespace, dataset.selected_node):
+            waited = time.monotonic() - enqueued
+            metrics.observe_stage('delete', 'queue', waited)
+            span.set_attribute('queue_wait', waited)
+            return await _delete(dataset, namespace)
+
+
+async def _delete(dataset, namespace):
     log.debug('dataset.delete: %s in namespace: %s', dataset, namespace)
 
     action = 'delete'
+    if CONFIG.agent_port:
+        return await _call_agent(action, dataset.selected_node,
+            dataset=dataset.full_name, mountpoint=dataset.mount_point)
+
     pod_name = f'{dataset.name}-{action}'
 
-    pod_args = ['dataset', 'destroy']
+    pod_args = ['destroy']
     pod_args.append(dataset.full_name)
     pod_args.append(dataset.mount_point)
 
@@ -0,0 +1,584 @@
+"""Simulator of the zfs command line tool for load tests and benchmarks.
+
+The simulator models a tree of datasets with their properties, property
+inheritance, quotas and the error messages of the real `zfs` command that
+the provisioner depends on, e.g. "dataset does not exist". It runs in
+process behind `zfs.FakeBackend` or as a fake `zfs` executable:
+
+    python -m zfs_provisioner.fakezfs create -p -o mountpoint=legacy tank/a/b
+
+`benchmarks/bin/zfs` wraps the latter, put that directory first in PATH to
+run the provisioner, the worker or the agent against the simulator. The
+executable keeps its state in the JSON file FAKEZFS_STATE.
+
+Latency and failures are injected per operation as configured in the
+environment variables:
+
+    FAKEZFS_POOLS=tank=1T,fast=100G
+    FAKEZFS_LATENCY=create=lognormal:0.05:0.5,destroy=uniform:0.01:0.1,*=const:0.002
+    FAKEZFS_FAILURES=create=0.05,*=0.001
+    FAKEZFS_SEED=42
+
+Latency distributions are `const:SECONDS`, `uniform:MIN:MAX`,
+`lognormal:MEDIAN:SIGMA` and `exp:MEAN`. Failures are probabilities, a
+failed operation reports the pool as suspended like a real pool with
+I/O errors does. FAKEZFS_SEED makes the in-process simulator deterministic,
+the executable combines it with its process id so its commands differ.
+"""
+import os
+import re
+import sys
+import time
+
+from .zfs import ZfsCommandError
+
+
+POOLS_ENV = 'FAKEZFS_POOLS'
+LATENCY_ENV = 'FAKEZFS_LATENCY'
+FAILURES_ENV = 'FAKEZFS_FAILURES'
+SEED_ENV = 'FAKEZFS_SEED'
+STATE_ENV = 'FAKEZFS_STATE'
+
+DEFAULT_POOL_SIZE = 1024 ** 4
+
+# Space used by an empty filesystem.
+EMPTY_REFERENCED = 98304
+
+# Operations that latency and failures can be configured for.
+OPERATIONS = ('create', 'destroy', 'set', 'get', 'list', 'program')
+
+READONLY_PROPERTIES = frozenset((
+    'name', 'type', 'creation', 'used', 'available', 'referenced',
+))
+
+SIZE_PROPERTIES = frozenset((
+    'quota', 'refquota', 'reservation', 'refreservation',
+))
+
+# Defaults of the inheritable native properties that are modelled.
+INHERITABLE_DEFAULTS = {
+    'atime': 'on',
+    'canmount': 'on',
+    'compression': 'off',
+    'readonly': 'off',
+    'recordsize': '131072',
+}
+
+ALL_PROPERTIES = tuple(sorted(READONLY_PROPERTIES)) + ('mountpoint',) + \
+    tuple(sorted(SIZE_PROPERTIES)) + tuple(sorted(INHERITABLE_DEFAULTS))
+
+SIZE_SUFFIXES = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3,
+    'T': 1024 ** 4, 'P': 1024 ** 5, 'E': 1024 ** 6}
+
+SIZE_PATTERN = re.compile(r'([0-9]+(?:\.[0-9]*)?)([KMGTPE]?)(?:i?B)?', re.IGNORECASE)
+
+
+class FakeZfsError(ZfsCommandError):
+    """Error reported by the simulator, its message is the one `zfs` prints.
+    """
+    pass
+
+
+def parse_size(value):
+    """Parse a size as accepted by zfs, e.g. `1048576`, `10G` or `none`.
+    """
+    if value in ('none', '0'):
+        return 0
+    match = SIZE_PATTERN.fullmatch(str(value))
+    if match is None:
+        raise ValueError(f"bad numeric value '{value}'")
+    number, suffix = match.groups()
+    return int(float(number) * SIZE_SUFFIXES[suffix.upper()])
+
+
+def distribution(spec):
+    """Return a function that draws from the latency distribution spec
+    using the given random.Random.
+    """
+    kind, *args = spec.split(':')
+    args = [float(a) for a in args]
+    if kind == 'const':
+        return lambda rng: args[0]
+    if kind == 'uniform':
+        return lambda rng: rng.uniform(args[0], args[1])
+    if kind == 'lognormal':
+        import math
+        mu = math.log(args[0])
+        return lambda rng: rng.lognormvariate(mu, args[1])
+    if kind == 'exp':
+        return lambda rng: rng.expovariate(1 / args[0])
+    raise ValueError(f'Unknown latency distribution: {spec}')
+
+
+def _parse_mapping(value):
+    mapping = {}
+    for item in filter(None, (value or '').split(',')):
+        key, _, spec = item.partition('=')
+        mapping[key.strip()] = spec.strip()
+    return mapping
+
+
+class Injector():
+    """Inject latency and failures into the simulated operations.
+
+    `latency` maps operation names to distribution specs and `failures`
+    maps them to probabilities. The operation `*` configures all
+    operations that are not given explicitly.
+    """
+
+    def __init__(self, latency=None, failures=None, seed=None):
+        import random
+        self.random = random.Random(seed)
+        self.latency = {op:distribution(spec) for op,spec in (latency or {}).items()}
+        self.failures = {op:float(p) for op,p in (failures or {}).items()}
+
+    @classmethod
+    def from_environ(cls, environ=os.environ, salt=None):
+        latency = _parse_mapping(environ.get(LATENCY_ENV, None))
+        failures = _parse_mapping(environ.get(FAILURES_ENV, None))
+        if not latency and not failures:
+            return None
+        seed = environ.get(SEED_ENV, None)
+        if seed and salt is not None:
+            seed = f'{seed}:{salt}'
+        return cls(latency, failures, seed=seed or None)
+
+    def __call__(self, operation, dataset):
+        draw = self.latency.get(operation, self.latency.get('*', None))
+        if draw is not None:
+            time.sleep(max(0, draw(self.random)))
+        probability = self.failures.get(operation, self.failures.get('*', 0))
+        if probability and self.random.random() < probability:
+            pool = dataset.split('/')[0]
+            raise FakeZfsError(f"cannot {operation} '{dataset}': pool I/O is currently suspended\n"
+                f"pool '{pool}' is suspended")
+
+
+class Simulator():
+    """In-memory model of the datasets of one or more pools.
+
+    `pools` maps pool names to their size in bytes. If create_mountpoints
+    is True, the directories of mountpoints that are set explicitly are
+    created, like mounting the dataset would.
+    """
+
+    def __init__(self, pools=None, injector=None, create_mountpoints=True):
+        self.pools = {}
+        self.create_mountpoints = create_mountpoints
+        # Map of dataset name to a dict with its `properties` that are set
+        # locally, the bytes it `referenced` and its `creation` time.
+        self.datasets = {}
+        self.injector = injector
+        for pool,size in (pools or {'tank': DEFAULT_POOL_SIZE}).items():
+            self.add_pool(pool, size)
+
+    @classmethod
+    def from_environ(cls, environ=os.environ):
+        pools = {}
+        for pool,size in _parse_mapping(environ.get(POOLS_ENV, None)).items():
+            pools[pool] = parse_size(size) if size else DEFAULT_POOL_SIZE
+        return cls(pools=pools or None, injector=Injector.from_environ(environ))
+
+    def add_pool(self, pool, size=DEFAULT_POOL_SIZE):
+        self.pools[pool] = size
+        self.datasets.setdefault(pool, self._record())
+
+    @staticmethod
+    def _record(properties=None):
+        return {
+            'properties': dict(properties or {}),
+            'referenced': EMPTY_REFERENCED,
+            'creation': int(time.time()),
+        }
+
+    def _mount(self, properties):
+        mountpoint = properties.get('mountpoint', None)
+        if self.create_mountpoints and mountpoint and mountpoint.startswith('/'):
+            os.makedirs(mountpoint, exist_ok=True)
+
+    def _inject(self, operation, dataset):
+        if self.injector is not None:
+            self.injector(operation, dataset)
+
+    def _check(self, dataset):
+        if dataset not in self.datasets:
+            raise FakeZfsError(f"cannot open '{dataset}': dataset does not exist")
+
+    def _descendants(self, dataset):
+        prefix = dataset + '/'
+        return [name for name in self.datasets if name.startswith(prefix)]
+
+    def _used(self, dataset):
+        return sum(self.datasets[name]['referenced']
+            for name in [dataset] + self._descendants(dataset))
+
+    def _available(self, dataset):
+        pool = dataset.split('/')[0]
+        available = self.pools[pool] - self._used(pool)
+        record = self.datasets[dataset]
+        refquota = int(record['properties'].get('refquota', 0))
+        if refquota:
+            available = min(available, refquota - record['referenced'])
+        name = dataset
+        while name:
+            quota = int(self.datasets[name]['properties'].get('quota', 0))
+            if quota:
+                available = min(available, quota - self._used(name))
+            name = os.path.split(name)[0]
+        return max(0, available)
+
+    def _inherited(self, dataset, key):
+        """Return the value of the inheritable property and its source.
+        """
+        name = dataset
+        while name:
+            properties = self.datasets[name]['properties']
+            if key in properties:
+                source = 'local' if name == dataset else f'inherited from {name}'
+                return properties[key], source
+            name = os.path.split(name)[0]
+        return None, 'default'
+
+    def _mountpoint(self, dataset):
+        name = dataset
+        while name:
+            mountpoint = self.datasets[name]['properties'].get('mountpoint', None)
+            if mountpoint is not None:
+                break
+            name = os.path.split(name)[0]
+        if not name:
+            # The pools default mountpoint.
+            name = dataset.split('/')[0]
+            mountpoint = '/' + name
+            source = 'default'
+        else:
+            source = 'local' if name == dataset else f'inherited from {name}'
+        if mountpoint in ('legacy', 'none') or name == dataset:
+            return mountpoint, source
+        return mountpoint.rstrip('/') + dataset[len(name):], source
+
+    def get_property(self, dataset, key):
+        """Return the value of the given property and its source.
+        """
+        self._check(dataset)
+        record = self.datasets[dataset]
+        if key == 'name':
+            return dataset, '-'
+        if key == 'type':
+            return 'filesystem', '-'
+        if key == 'creation':
+            return str(record['creation']), '-'
+        if key == 'used':
+            return str(self._used(dataset)), '-'
+        if key == 'referenced':
+            return str(record['referenced']), '-'
+        if key == 'available':
+            return str(self._available(dataset)), '-'
+        if key == 'mountpoint':
+            return self._mountpoint(dataset)
+        if key in SIZE_PROPERTIES:
+            value = record['properties'].get(key, None)
+            return (value, 'local') if value is not None else ('0', 'default')
+        if key in INHERITABLE_DEFAULTS or ':' in key:
+            value, source = self._inherited(dataset, key)
+            if value is None and ':' in key:
+                # Unset user properties.
+                return '-', '-'
+            if value is None:
+                return INHERITABLE_DEFAULTS[key], source
+            return value, source
+        raise FakeZfsError(f"bad property list: invalid property '{key}'")
+
+    def _validate(self, dataset, properties, action):
+        validated = {}
+        for key,value in properties.items():
+            value = str(value)
+            if key in READONLY_PROPERTIES:
+                raise FakeZfsError(f"cannot {action} '{dataset}': '{key}' is readonly")
+            if key in SIZE_PROPERTIES:
+                try:
+                    value = str(parse_size(value))
+                except ValueError as e:
+                    raise FakeZfsError(f"cannot {action} '{dataset}': {e}")
+            elif key not in INHERITABLE_DEFAULTS and key != 'mountpoint' and ':' not in key:
+                raise FakeZfsError(f"cannot {action} '{dataset}': invalid property '{key}'")
+            validated[key] = value
+        return validated
+
+    def exists(self, dataset):
+        self._inject('list', dataset)
+        return dataset in self.datasets
+
+    def create(self, dataset, properties=None, parents=False):
+        """Create the dataset, and its missing ancestors if parents is True.
+        """
+        self._inject('create', dataset)
+        pool = dataset.split('/')[0]
+        if pool not in self.pools:
+            raise FakeZfsError(f"cannot create '{dataset}': no such pool '{pool}'")
+        if '/' not in dataset:
+            raise FakeZfsError(f"cannot create '{dataset}': missing dataset name")
+        if dataset in self.datasets:
+            if parents:
+                return
+            raise FakeZfsError(f"cannot create '{dataset}': dataset already exists")
+        properties = self._validate(dataset, properties or {}, 'create')
+        parent = os.path.split(dataset)[0]
+        missing = []
+        while parent not in self.datasets:
+            missing.append(parent)
+            parent = os.path.split(parent)[0]
+        if missing and not parents:
+            raise FakeZfsError(f"cannot create '{dataset}': parent does not exist")
+        if self._available(parent) < EMPTY_REFERENCED * (len(missing) + 1):
+            raise FakeZfsError(f"cannot create '{dataset}': out of space")
+        for name in reversed(missing):
+            self.datasets[name] = self._record()
+        self.datasets[dataset] = self._record(properties)
+        self._mount(properties)
+
+    def destroy(self, dataset, recursive=False):
+        self._inject('destroy', dataset)
+        self._check(dataset)
+        if '/' not in dataset:
+            raise FakeZfsError(f"cannot destroy '{dataset}': operation does not apply to pools")
+        children = self._descendants(dataset)
+        if children and not recursive:
+            raise FakeZfsError(f"cannot destroy '{dataset}': filesystem has children\n"
+                "use '-r' to destroy the following datasets:\n" + '\n'.join(sorted(children)))
+        for name in children + [dataset]:
+            del self.datasets[name]
+
+    def set(self, dataset, properties):
+        self._inject('set', dataset)
+        self._check(dataset)
+        properties = self._validate(dataset, properties, 'set property for')
+        record = self.datasets[dataset]
+        quota = int(properties.get('quota', 0))
+        if quota and quota < self._used(dataset):
+            raise FakeZfsError(f"cannot set property for '{dataset}': "
+                "size is less than current used or reserved space")
+        refquota = int(properties.get('refquota', 0))
+        if refquota and refquota < record['referenced']:
+            raise FakeZfsError(f"cannot set property for '{dataset}': "
+                "size is less than current used or reserved space")
+        for key,value in properties.items():
+            if key in SIZE_PROPERTIES and value == '0':
+                record['properties'].pop(key, None)
+            else:
+                record['properties'][key] = value
+        self._mount(properties)
+
+    def write(self, dataset, size):
+        """Simulate writing size bytes to the dataset, negative sizes free space.
+        """
+        self._check(dataset)
+        if size > self._available(dataset):
+            raise FakeZfsError(f"cannot write to '{dataset}': Disk quota exceeded")
+        record = self.datasets[dataset]
+        record['referenced'] = max(EMPTY_REFERENCED, record['referenced'] + size)
+
+    def iter_names(self, datasets, recursive=False, depth=None):
+        """Yield the names of the given datasets and, if recursive is True,
+        their descendants up to depth levels deep.
+        """
+        for dataset in datasets:
+            self._check(dataset)
+            yield dataset
+            if recursive or depth is not None:
+                level = dataset.count('/')
+                for name in sorted(self._descendants(dataset)):
+                    if depth is None or name.count('/') - level <= depth:
+                        yield name
+
+    def list(self, datasets, keys=('name',), recursive=False, depth=None):
+        """Return a row with the values of the given properties for the given
+        datasets and, if recursive is True, their descendants.
+        """
+        self._inject('list', datasets[0] if datasets else '')
+        return [[self.get_property(name, key)[0] for key in keys]
+            for name in self.iter_names(datasets, recursive=recursive, depth=depth)]
+
+    def get(self, datasets, keys=('all',), recursive=False, depth=None):
+        """Return a (name, property, value, source) row for each of the given
+        properties of the given datasets and, if recursive is True, their
+        descendants.
+        """
+        self._inject('get', datasets[0] if datasets else '')
+        rows = []
+        for name in self.iter_names(datasets, recursive=recursive, depth=depth):
+            names = keys
+            if 'all' in keys:
+                user = sorted(k for k in self.datasets[name]['properties'] if ':' in k)
+                names = ALL_PROPERTIES + tuple(user)
+            for key in names:
+                rows.append((name, key) + self.get_property(name, key))
+        return rows
+
+    def probe(self, dataset, keys=()):
+        """Emulate the `probe-dataset.lua` channel program.
+        """
+        self._inject('program', dataset)
+        if dataset not in self.datasets:
+            return {'exists': False}
+        return {
+            'exists': True,
+            'properties': {k:self.get_property(dataset, k)[0] for k in keys},
+        }
+
+    def to_dict(self):
+        return {'pools': self.pools, 'datasets': self.datasets}
+
+    @classmethod
+    def from_dict(cls, data, injector=None):
+        simulator = cls(pools={}, injector=injector)
+        simulator.pools = dict(data['pools'])
+        simulator.datasets = dict(data['datasets'])
+        return simulator
+
+
+class UsageError(Exception):
+    pass
+
+
+def _parse_options(args, flags='', options=''):
+    """Parse getopt style options and return the flags that are set,
+    the options with their values and the remaining arguments.
+    """
+    import getopt
+    try:
+        parsed, args = getopt.getopt(args, flags + ''.join(o + ':' for o in options))
+    except getopt.GetoptError as e:
+        raise UsageError(str(e))
+    found = set()
+    values = {}
+    for option,value in parsed:
+        name = option[1:]
+        if name in options:
+            values.setdefault(name, []).append(value)
+        else:
+            found.add(name)
+    return found, values, args
+
+
+def _properties(values):
+    properties = {}
+    for value in values:
+        key, sep, value = value.partition('=')
+        if not sep:
+            raise UsageError(f"missing '=' for property: {key}")
+        properties[key] = value
+    return properties
+
+
+def _print_rows(rows, header, scripted, out):
+    if not scripted:
+        rows = [header] + [list(row) for row in rows]
+    for row in rows:
+        out.write('\t'.join(str(v) for v in row) + '\n')
+
+
+def run(simulator, argv, out=sys.stdout):
+    """Run the zfs command line given in argv against the simulator.
+    """
+    if not argv:
+        raise UsageError('missing command')
+    command, args = argv[0], argv[1:]
+    if command == 'create':
+        found, values, args = _parse_options(args, 'p', 'o')
+        if len(args) != 1:
+            raise UsageError('wrong number of arguments')
+        simulator.create(args[0], _properties(values.get('o', ())), parents='p' in found)
+    elif command == 'destroy':
+        found, values, args = _parse_options(args, 'rRf')
+        if len(args) != 1:
+            raise UsageError('wrong number of arguments')
+        simulator.destroy(args[0], recursive=bool(found & {'r', 'R'}))
+    elif command == 'set':
+        if len(args) < 2:
+            raise UsageError('wrong number of arguments')
+        simulator.set(args[-1], _properties(args[:-1]))
+    elif command == 'list':
+        found, values, args = _parse_options(args, 'Hpr', 'od')
+        keys = ','.join(values.get('o', ['name,used,available,referenced,mountpoint'])).split(',')
+        depth = int(values['d'][-1]) if 'd' in values else None
+        rows = simulator.list(args or sorted(simulator.pools), keys,
+            recursive='r' in found or not args, depth=depth)
+        _print_rows(rows, [k.upper() for k in keys], 'H' in found, out)
+    elif command == 'get':
+        found, values, args = _parse_options(args, 'Hpr', 'od')
+        if not args:
+            raise UsageError('missing property argument')
+        fields = ','.join(values.get('o', ['name,property,value,source'])).split(',')
+        depth = int(values['d'][-1]) if 'd' in values else None
+        rows = simulator.get(args[1:] or sorted(simulator.pools), args[0].split(','),
+            recursive='r' in found or not args[1:], depth=depth)
+        columns = ('name', 'property', 'value', 'source')
+        rows = [[row[columns.index(f)] for f in fields] for row in rows]
+        _print_rows(rows, [f.upper() for f in fields], 'H' in found, out)
+    elif command == 'program':
+        found, values, args = _parse_options(args, 'nj', 'tm')
+        if len(args) < 3 or os.path.basename(args[1]) != 'probe-dataset.lua':
+            raise UsageError('only the probe-dataset.lua channel program is supported')
+        import json
+        out.write(json.dumps({'return': simulator.probe(args[2], args[3:])}) + '\n')
+    else:
+        raise UsageError(f"unrecognized command '{command}'")
+
+
+def _dataset_argument(argv):
+    """Return the dataset the command line in argv operates on.
+    """
+    if argv[0] == 'program':
+        # zfs program [options] <pool> <script> <dataset> [<property> ...]
+        scripts = [i for i,arg in enumerate(argv) if arg.endswith('.lua')]
+        if scripts and scripts[0] + 1 < len(argv):
+            return argv[scripts[0] + 1]
+    return argv[-1]
+
+
+def _state_file(environ):
+    import tempfile
+    return environ.get(STATE_ENV, None) or os.path.join(tempfile.gettempdir(), 'fakezfs.json')
+
+
+def main(argv=None, environ=os.environ):
+    """Entry point of the fake `zfs` executable.
+
+    The state is kept in the file FAKEZFS_STATE which is locked while a
+    command runs. Latency is injected before taking the lock, so slow
+    operations do not serialize the other commands.
+    """
+    import fcntl
+    import json
+    if argv is None:
+        argv = sys.argv[1:]
+    state_file = _state_file(environ)
+    injector = Injector.from_environ(environ, salt=os.getpid())
+    try:
+        if injector is not None and argv:
+            injector(argv[0], _dataset_argument(argv))
+        with open(state_file + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(state_file) as f:
+                    simulator = Simulator.from_dict(json.load(f))
+            except FileNotFoundError:
+                simulator = Simulator.from_environ(environ)
+                simulator.injector = None
+            run(simulator, argv)
+            if argv[0] in ('create', 'destroy', 'set'):
+                with open(state_file + '.tmp', 'w') as f:
+                    json.dump(simulator.to_dict(), f)
+                os.replace(state_file + '.tmp', state_file)
+    except UsageError as e:
+        print(f'invalid usage: {e}', file=sys.stderr)
+        return 2
+    except FakeZfsError as e:
+        print(e, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
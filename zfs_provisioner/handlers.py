@@ -9,14 +9,21 @@ import sys
 from typing import Optional, Dict, List
 
 import aiofiles
+import aiohttp
 import click
 import inotipy
 import kopf
 import kubernetes_asyncio
-import yaml
+import kubernetes_asyncio.watch
 
 
-from . import get_template
+from . import api
+from . import datasetconfig
+from . import loopmonitor
+from . import manifests
+from . import metrics
+from . import profiling
+from . import tracing
 
 
 log = logging.getLogger('zfs-provisioner')
@@ -30,13 +37,73 @@ class Config:
     dataset_mount_dir: str = '/tank/provisioner'
     node_name: Optional[str] = None
 
-    # Path to a config file.
+    # Port and shared secret of the node agents.
+    # If agent_port is set the node agents are used instead of pods.
+    agent_port: Optional[int] = None
+    agent_token: Optional[str] = None
+
+    # Seconds a dataset action may take before it is aborted and retried,
+    # the seconds to wait before retrying a failed action and the number of
+    # retries after which the action is given up.
+    action_timeouts: Dict[str, float] = dataclasses.field(default_factory=dict)
+    retry_delay: float = 30
+    max_retries: int = 10
+
+    # Maximum number of concurrently running dataset actions
+    # in total and per node.
+    max_concurrent_actions: int = 50
+    max_concurrent_actions_per_node: int = 5
+
+    # Size of the connection pool to the API server and the seconds
+    # idle connections are kept alive.
+    api_pool_size: int = 100
+    api_keepalive: float = 60
+
+    # Address and port to serve the prometheus metrics on, 0 disables them.
+    metrics_address: str = '0.0.0.0'
+    metrics_port: int = 9477
+
+    # JSONL files to export the trace spans of the controller and the
+    # dataset pods to. The worker trace file is written by the dataset pods
+    # and therefore has to be below dataset_mount_dir.
+    trace_file: Optional[str] = None
+    worker_trace_file: Optional[str] = None
+
+    # Directory profiles are written to and the default duration of a
+    # profiling session. Address and port of the admin endpoint that starts
+    # profiling sessions, 0 disables it.
+    profile_dir: str = '/tmp/zfs-provisioner'
+    profile_seconds: float = 30
+    admin_address: str = '127.0.0.1'
+    admin_port: int = 0
+
+    # Seconds between measurements of the event loop lag and the seconds
+    # a callback may block the event loop before its stack is logged,
+    # 0 disables the logging.
+    loop_lag_interval: float = 0.5
+    slow_callback_threshold: float = 0.25
+
+    # Path to a config file and the seconds to wait for further changes
+    # of it before reloading it.
     config: Optional[str] = None
+    config_reload_delay: float = 1
 
-    # The config loaded from `config` as a dict.
-    dataset_config: Optional[Dict] = dataclasses.field(default_factory=dict)
+    # Name of a ConfigMap in `namespace` and its key to watch for the
+    # config through the API instead of a file.
+    config_map: Optional[str] = None
+    config_map_key: str = 'config.json'
+
+    # The config loaded from `config`, replaced as a whole on reload.
+    dataset_config: datasetconfig.DatasetConfig = dataclasses.field(
+        default_factory=datasetconfig.DatasetConfig)
     dataset_phase_annotations: Dict[str, str] = dataclasses.field(default_factory=dict)
-    storage_classes: Dict[str, Dict] = dataclasses.field(default_factory=dict)
+    # Label the PVCs of our storage classes with managed_label and only
+    # handle and cache the labelled ones. The label value is provisioner_name.
+    label_pvcs: bool = False
+    managed_label: str = 'zfs-provisioner/provisioner'
+
+    # The storage classes of this provisioner by name, derived from cache.STORAGE_CLASSES.
+    storage_classes: Dict[str, 'StorageClass'] = dataclasses.field(default_factory=dict)
     dataset_annotation: str = 'zfs-provisioner/dataset'
 
 
@@ -44,18 +111,28 @@ CONFIG = Config(
     dataset_phase_annotations={
         action:f'zfs-provisioner/dataset-phase-{action}'
         for action in ('create', 'delete', 'resize')
-    }
+    },
+    action_timeouts={
+        action:300
+        for action in ('create', 'delete', 'resize')
+    },
 )
 
 
 def configure(**kwargs):
     for k,v in kwargs.items():
         if v is not None:
-            setattr(CONFIG, k, v)
+            if isinstance(v, dict):
+                getattr(CONFIG, k).update({
+                    key:value for key,value in v.items() if value is not None})
+            else:
+                setattr(CONFIG, k, v)
 
 
 # Has to be below CONFIG to prevent circular import problems.
+from . import cache
 from . import datasets
+from . import pvcwatch
 
 
 @dataclasses.dataclass
@@ -82,37 +159,138 @@ class StorageClass:
         return cls(**{k:v for k,v in items if k in class_fields})
 
 
-async def load_config(config_file, reload=False):
+async def apply_config(content, source, reload=False):
+    """Swap in the config if it changed and is valid.
+    Raise datasetconfig.ConfigError otherwise.
+    """
     if reload:
         prefix = 'Reloading'
     else:
         prefix = 'Loading'
-    log.info('%s dataset config from: %s', prefix, config_file)
-    async with aiofiles.open(config_file, mode='r') as f:
-        config_string = await f.read()
-        CONFIG.dataset_config = json.loads(config_string)
+    if datasetconfig.get_digest(content) == CONFIG.dataset_config.digest:
+        log.debug('Dataset config %s is unchanged', source)
+        metrics.CONFIG_RELOADS.labels('unchanged').inc()
+        return
+    log.info('%s dataset config from: %s', prefix, source)
+    try:
+        # Parse in a thread to not block the event loop with large configs.
+        dataset_config = await asyncio.get_running_loop().run_in_executor(None,
+            datasetconfig.parse, content)
+    except datasetconfig.ConfigError:
+        metrics.CONFIG_RELOADS.labels('invalid').inc()
+        raise
+    CONFIG.dataset_config = dataset_config
+    metrics.CONFIG_RELOADS.labels('loaded').inc()
+    log.debug('Loaded dataset config %s: %s', dataset_config.digest,
+        dict(dataset_config.node_dataset_map))
+
+
+async def load_config(config_file, reload=False):
+    """Load the config file and swap it in if it changed and is valid.
+    Raise OSError or datasetconfig.ConfigError otherwise.
+    """
+    async with aiofiles.open(config_file, mode='rb') as f:
+        content = await f.read()
+    await apply_config(content, config_file, reload=reload)
+
+
+# Events in the directory of the config file that may change it. A ConfigMap
+# volume replaces its files by creating a new directory and swapping a
+# symlink to it, which removes the file a watch on it would be bound to.
+CONFIG_FILE_EVENTS = inotipy.IN.CLOSE_WRITE | inotipy.IN.MOVED_TO | inotipy.IN.CREATE
 
 
 async def watch_config_file(config_file):
     """Monitor the config file and reload it on change.
     """
-    # Load initial config.
-    await load_config(config_file)
-
     watcher = inotipy.Watcher.create()
-    watcher.watch(config_file, inotipy.IN.MODIFY)
+    watcher.watch(os.path.dirname(os.path.abspath(config_file)), CONFIG_FILE_EVENTS)
 
     while True:
         event = await watcher.get()
-        log.debug(event)
-        await load_config(config_file, reload=True)
-        if event.mask & inotipy.EVENT_BIT.IGNORED.mask != 0:
-            # Re-create the watch if the file was removed/re-created.
-            event.watch.remove()
-            watcher.watch(config_file, inotipy.IN.MODIFY)
+        # Changes come in bursts, wait until they settle.
+        while event is not None:
+            log.debug(event)
+            event = await watcher.get(timeout=CONFIG.config_reload_delay)
+        try:
+            await load_config(config_file, reload=True)
+        except (OSError, datasetconfig.ConfigError) as e:
+            log.error('Keeping the current dataset config, reloading %s failed: %s',
+                config_file, e)
+
+
+async def apply_config_map(obj, key, reload=False):
+    source = f'configmap {obj.metadata.namespace}/{obj.metadata.name}'
+    try:
+        content = (obj.data or {})[key]
+    except KeyError:
+        raise datasetconfig.ConfigError(f'{source} has no key {key}')
+    await apply_config(content.encode('utf-8'), f'{source} version {obj.metadata.resource_version}',
+        reload=reload)
+
+
+async def load_config_map(namespace, name, key):
+    """Load the config from the ConfigMap and return its resourceVersion.
+    """
+    v1 = api.core_v1()
+    obj = await v1.read_namespaced_config_map(name, namespace)
+    await apply_config_map(obj, key)
+    return obj.metadata.resource_version
+
+
+# Seconds after which the API server ends a ConfigMap watch, it is then
+# resumed from the last seen resourceVersion.
+CONFIG_MAP_WATCH_TIMEOUT = 300
+
+
+async def watch_config_map(namespace, name, key, resource_version):
+    """Watch the ConfigMap through the API and reload the config on change.
+    """
+    v1 = api.core_v1()
+    while True:
+        try:
+            if resource_version is None:
+                # Our resourceVersion expired, start over from the current state.
+                obj = await v1.read_namespaced_config_map(name, namespace)
+                resource_version = obj.metadata.resource_version
+                await apply_config_map(obj, key, reload=True)
+            stream = kubernetes_asyncio.watch.Watch().stream(v1.list_namespaced_config_map,
+                namespace, field_selector=f'metadata.name={name}',
+                resource_version=resource_version, timeout_seconds=CONFIG_MAP_WATCH_TIMEOUT)
+            async for event in stream:
+                log.debug('configmap %s/%s: %s', namespace, name, event['type'])
+                if event['type'] == 'ERROR':
+                    # Expired resourceVersion of older kubernetes_asyncio versions.
+                    resource_version = None
+                    break
+                obj = event['object']
+                if obj.metadata.name != name:
+                    continue
+                resource_version = obj.metadata.resource_version
+                if event['type'] == 'DELETED':
+                    log.error('Keeping the current dataset config, configmap %s/%s was deleted',
+                        namespace, name)
+                    continue
+                try:
+                    await apply_config_map(obj, key, reload=True)
+                except datasetconfig.ConfigError as e:
+                    log.error('Keeping the current dataset config, reloading failed: %s', e)
+        except kubernetes_asyncio.client.exceptions.ApiException as e:
+            if e.status != 410:
+                log.error('Watching configmap %s/%s failed, retrying in %ss: %s',
+                    namespace, name, CONFIG.retry_delay, e)
+                await asyncio.sleep(CONFIG.retry_delay)
+            resource_version = None
+        except datasetconfig.ConfigError as e:
+            log.error('Keeping the current dataset config, reloading failed: %s', e)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log.error('Watching configmap %s/%s failed, retrying in %ss: %s',
+                namespace, name, CONFIG.retry_delay, e)
+            await asyncio.sleep(CONFIG.retry_delay)
 
 
 config_watcher_task = None
+loop_monitor = None
 
 @kopf.on.startup()
 async def startup(**_):
@@ -124,34 +302,95 @@ async def startup(**_):
         # Fall back to regular config.
         await kubernetes_asyncio.config.load_kube_config()
 
-    # Monitor config file for changes.
-    if CONFIG.config:
-        global config_watcher_task
+    # Share one ApiClient, and its connections, between all handlers.
+    await api.open_client(pool_size=CONFIG.api_pool_size, keepalive=CONFIG.api_keepalive)
+
+    tracing.configure(CONFIG.trace_file)
+
+    global loop_monitor
+    loop_monitor = loopmonitor.LoopMonitor(CONFIG.loop_lag_interval,
+        CONFIG.slow_callback_threshold)
+    loop_monitor.start()
+
+    if CONFIG.metrics_port:
+        log.info('Serving metrics on %s:%s', CONFIG.metrics_address, CONFIG.metrics_port)
+        metrics.start_server(CONFIG.metrics_port, CONFIG.metrics_address)
+
+    profiling.install_signal_handler(CONFIG.profile_dir, CONFIG.profile_seconds)
+    if CONFIG.admin_port:
+        await profiling.start_server(CONFIG.admin_address, CONFIG.admin_port,
+            CONFIG.profile_dir, CONFIG.profile_seconds)
+
+    # Monitor config file or ConfigMap for changes.
+    global config_watcher_task
+    if CONFIG.config_map:
+        try:
+            resource_version = await load_config_map(CONFIG.namespace, CONFIG.config_map,
+                CONFIG.config_map_key)
+        except (kubernetes_asyncio.client.exceptions.ApiException,
+                datasetconfig.ConfigError) as e:
+            raise kopf.HandlerFatalError(f'Failed to load dataset config: {e}')
+        config_watcher_task = asyncio.create_task(watch_config_map(CONFIG.namespace,
+            CONFIG.config_map, CONFIG.config_map_key, resource_version))
+    elif CONFIG.config:
+        try:
+            await load_config(CONFIG.config)
+        except (OSError, datasetconfig.ConfigError) as e:
+            raise kopf.HandlerFatalError(f'Failed to load dataset config: {e}')
         config_watcher_task = asyncio.create_task(watch_config_file(CONFIG.config))
 
+    if CONFIG.label_pvcs:
+        # Only labelled PVCs are handled, see register_pvc_handlers.
+        for watch in (pvcwatch.watch_managed_pvcs, pvcwatch.watch_unlabelled_pvcs):
+            _spawn(watch())
+
 
 @kopf.on.cleanup()
 async def cleanup(**_):
     global config_watcher_task
     if config_watcher_task:
         config_watcher_task.cancel()
-
-
-def filter_provisioner(body, **_):
-    return body.get('provisioner', None) == CONFIG.provisioner_name
-
-
-@kopf.on.resume('storage.k8s.io', 'v1', 'storageclasses',
-    when=filter_provisioner)
-@kopf.on.create('storage.k8s.io', 'v1', 'storageclasses',
-    when=filter_provisioner)
-def cache_storage_class(name, body, meta, logger, **kwargs):
-    """Load storage class properties and parameters from API server.
+    for task in list(pvc_tasks):
+        task.cancel()
+    await datasets.close()
+    await api.close_client()
+    await profiling.stop_server()
+    if loop_monitor:
+        loop_monitor.stop()
+
+
+@kopf.on.event('storage.k8s.io', 'v1', 'storageclasses')
+@metrics.timed_handler
+async def cache_storage_class(event, name, **_):
+    """Keep the properties and parameters of our storage classes current.
     """
-    log.info('Watching for PVCs with storage class: %s', name)
-    storage_class = StorageClass.from_dicts(meta, body)
-    CONFIG.storage_classes[name] = storage_class
-    log.debug('Caching storage class %s as: %s', name, storage_class)
+    cache.STORAGE_CLASSES.apply(event)
+    storage_classes = {}
+    for obj in cache.storage_classes_by_provisioner(CONFIG.provisioner_name):
+        storage_class = StorageClass.from_dicts(obj['metadata'], obj)
+        storage_classes[storage_class.name] = storage_class
+    if name in storage_classes:
+        log.debug('Caching storage class %s as: %s', name, storage_classes[name])
+    is_new = name in storage_classes and name not in CONFIG.storage_classes
+    if name in CONFIG.storage_classes and name not in storage_classes:
+        # Deleted, or handed over to another provisioner.
+        log.info('Stopped watching for PVCs with storage class: %s', name)
+    CONFIG.storage_classes = storage_classes
+    if is_new:
+        log.info('Watching for PVCs with storage class: %s', name)
+        if CONFIG.label_pvcs:
+            # PVCs seen before the storage class was known were skipped.
+            _spawn(pvcwatch.on_storage_class(name))
+
+
+# The PVC watches of pvcwatch and the tasks they spawned.
+pvc_tasks = set()
+
+
+def _spawn(coro):
+    task = asyncio.create_task(coro)
+    pvc_tasks.add(task)
+    task.add_done_callback(pvc_tasks.discard)
 
 
 def filter_create_dataset(body, meta, spec, status, **_):
@@ -182,16 +421,43 @@ def filter_create_dataset(body, meta, spec, status, **_):
     return handle_it
 
 
-@kopf.on.resume('', 'v1', 'persistentvolumeclaims',
-    when=filter_create_dataset)
-@kopf.on.create('', 'v1', 'persistentvolumeclaims',
-    when=filter_create_dataset)
-@kopf.on.update('', 'v1', 'persistentvolumeclaims',
-    when=filter_create_dataset)
-async def create_dataset(name, namespace, body, meta, spec, patch, logger, **_):
+@metrics.timed_handler
+async def create_dataset(name, namespace, body, meta, spec, patch, logger, retry=0, **_):
     """Schedule a pod that creates the zfs dataset.
     Create the persistent volume to fullfill this claim.
     """
+    selected_node = meta.annotations.get('volume.kubernetes.io/selected-node', None)
+    with tracing.span('create_dataset', pvc=f'{namespace}/{name}', node=selected_node) as span, \
+            metrics.track_operation('create', spec['storageClassName'], selected_node):
+        log.debug('%s: trace_id: %s', name, span.trace_id)
+        try:
+            await _create_dataset(name, namespace, body, meta, spec, patch)
+        except kopf.TemporaryError as e:
+            _check_retries('create', retry, e)
+            raise
+
+
+def _check_retries(action, retry, error):
+    """Give up the dataset action once it has been retried max_retries times.
+    """
+    if retry >= CONFIG.max_retries:
+        raise kopf.HandlerFatalError(f'Giving up to {action} dataset '
+            f'after {retry + 1} attempts: {error}') from error
+
+
+async def get_parent_dataset(node_name):
+    """Return the parent dataset to create the datasets of the given node in.
+    """
+    dataset_config = CONFIG.dataset_config
+    labels = None
+    if dataset_config.uses_labels and not dataset_config.is_cached(node_name):
+        v1 = api.core_v1()
+        obj = await v1.read_node(node_name)
+        labels = obj.metadata.labels or {}
+    return dataset_config.parent_dataset(node_name, CONFIG.parent_dataset, labels)
+
+
+async def _create_dataset(name, namespace, body, meta, spec, patch):
     storage_class_name = spec['storageClassName']
     storage_class = CONFIG.storage_classes[storage_class_name]
 
@@ -200,15 +466,8 @@ async def create_dataset(name, namespace, body, meta, spec, patch, logger, **_):
     storage_class_mode = storage_class.parameters.get('mode', 'local')
     if storage_class_mode == storage_class.MODE_LOCAL:
         selected_node = meta.annotations['volume.kubernetes.io/selected-node']
-        if CONFIG.dataset_config:
-            dataset_config = CONFIG.dataset_config['node_dataset_map']
-            # Optionally check for node specific parent dataset name.
-            parent_dataset = dataset_config.get(selected_node,
-                dataset_config.get('__default__', CONFIG.parent_dataset)
-            )
-            log.info(parent_dataset)
-        else:
-            parent_dataset = CONFIG.parent_dataset
+        # Optionally check for node specific parent dataset name.
+        parent_dataset = await get_parent_dataset(selected_node)
         dataset_name = pv_name
         mount_point = os.path.join(CONFIG.dataset_mount_dir, pv_name)
 
@@ -239,29 +498,33 @@ async def create_dataset(name, namespace, body, meta, spec, patch, logger, **_):
         raise kopf.HandlerFatalError(f'Unsupported storage class mode: {storage_class_mode}')
 
 
-    template = get_template('pvc.yaml')
-    text = template.format(
+    data = manifests.PERSISTENT_VOLUME.render(
         provisioner_name=storage_class.provisioner,
         pv_name=pv_name,
         access_mode=spec['accessModes'][0],
         storage=spec['resources']['requests']['storage'],
         pvc_name=name,
         pvc_namespace=namespace,
+        pvc_uid=meta['uid'],
         local_path=mount_point,
         selected_node_name=selected_node,
         storage_class_name=storage_class_name,
         volume_mode=spec['volumeMode'],
         reclaim_policy=storage_class.reclaimPolicy,
     )
-    data = yaml.safe_load(text)
 
     message = f'persistent volume {pv_name}'
-    log.info('%s: creating %s', name, message)
-    async with kubernetes_asyncio.client.ApiClient() as api:
-        v1 = kubernetes_asyncio.client.CoreV1Api(api)
-        obj = await v1.create_persistent_volume(
-            body=data,
-        )
+    pv = cache.pv_by_claim(namespace, name)
+    if pv is not None and pv['spec']['claimRef'].get('uid', None) == meta['uid']:
+        # Created for this very PVC by a previous attempt of this handler.
+        log.info('%s: %s already exists', name, message)
+    else:
+        log.info('%s: creating %s', name, message)
+        v1 = api.core_v1()
+        with metrics.time_stage('create', 'pv_create'), tracing.span('pv.create', pv=pv_name):
+            obj = await v1.create_persistent_volume(
+                body=data,
+            )
     kopf.info(body, reason='Bound', message=f'bound {message}')
 
 
@@ -293,11 +556,24 @@ def filter_delete_dataset(body, meta, spec, status, **_):
     return handle_it
 
 
-@kopf.on.delete('', 'v1', 'persistentvolumeclaims',
-    when=filter_delete_dataset)
-async def delete_dataset(name, namespace, body, meta, spec, **_):
+@metrics.timed_handler
+async def delete_dataset(name, namespace, body, meta, spec, retry=0, **_):
     """Schedule a pod that deletes the zfs dataset.
     """
+    node = None
+    if CONFIG.dataset_annotation in meta.annotations:
+        node = json.loads(meta.annotations[CONFIG.dataset_annotation]).get('selected_node', None)
+    with tracing.span('delete_dataset', pvc=f'{namespace}/{name}', node=node) as span, \
+            metrics.track_operation('delete', spec['storageClassName'], node):
+        log.debug('%s: trace_id: %s', name, span.trace_id)
+        try:
+            await _delete_dataset(name, namespace, body, meta, spec)
+        except kopf.TemporaryError as e:
+            _check_retries('delete', retry, e)
+            raise
+
+
+async def _delete_dataset(name, namespace, body, meta, spec):
     storage_class_name = spec['storageClassName']
     storage_class = CONFIG.storage_classes[storage_class_name]
 
@@ -324,8 +600,8 @@ async def delete_dataset(name, namespace, body, meta, spec, **_):
         pv_name = spec['volumeName']
         message = f'persistent volume {pv_name}'
         log.info('%s: deleting %s', name, message)
-        async with kubernetes_asyncio.client.ApiClient() as api:
-            v1 = kubernetes_asyncio.client.CoreV1Api(api)
+        v1 = api.core_v1()
+        with metrics.time_stage('delete', 'pv_delete'), tracing.span('pv.delete', pv=pv_name):
             obj = await v1.delete_persistent_volume(pv_name)
         kopf.info(body, reason='Unbound', message='unbound {message}')
 
@@ -336,6 +612,22 @@ async def delete_dataset(name, namespace, body, meta, spec, **_):
         raise kopf.HandlerFatalError(f'Unsupported storage class mode: {storage_class_mode}')
 
 
+def register_pvc_handlers():
+    """Have kopf watch all PVCs and run the dataset handlers for ours.
+
+    kopf can not watch PVCs by label, so with labelled PVCs the handlers
+    are run by pvcwatch instead and this is not called.
+    """
+    kopf.on.resume('', 'v1', 'persistentvolumeclaims',
+        when=filter_create_dataset)(create_dataset)
+    kopf.on.create('', 'v1', 'persistentvolumeclaims',
+        when=filter_create_dataset)(create_dataset)
+    kopf.on.update('', 'v1', 'persistentvolumeclaims',
+        when=filter_create_dataset)(create_dataset)
+    kopf.on.delete('', 'v1', 'persistentvolumeclaims',
+        when=filter_delete_dataset)(delete_dataset)
+
+
 @click.command()
 @click.option('--verbose', '-v', 'log_level', flag_value='info', help='set log level to info', envvar='TENANTCTL_LOG_LEVEL')
 @click.option('--debug', '-d', 'log_level', flag_value='debug', help='set log level to debug', envvar='TENANTCTL_LOG_LEVEL')
@@ -351,6 +643,7 @@ def main(log_level):
         log.setLevel(getattr(logging, log_level.upper()))
         logging.getLogger('kopf').setLevel(getattr(logging, log_level.upper()))
 
+    register_pvc_handlers()
     log.debug('Starting kopf ...')
     loop = asyncio.get_event_loop()
     tasks = loop.run_until_complete(kopf.spawn_tasks())
@@ -0,0 +1,79 @@
+"""Monitor the lag of the event loop and log what blocks it.
+
+Everything in the controller runs on one event loop, so any blocking call
+delays all other PVCs. A task measures how late the loop wakes it up and
+exports that as `zfs_provisioner_event_loop_lag_seconds`. A watchdog thread
+notices when the loop does not wake the task up in time and logs the stack
+of the loop thread while it is still blocked, pointing at the culprit.
+"""
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from . import metrics
+
+log = logging.getLogger('zfs-provisioner')
+
+
+class LoopMonitor():
+    """Measure the lag of the running event loop every interval seconds
+    and log the stack of blocking callbacks that take longer than
+    slow_threshold seconds, 0 disables the watchdog.
+    """
+
+    def __init__(self, interval=0.5, slow_threshold=0.25):
+        self.interval = interval
+        self.slow_threshold = slow_threshold
+        self._heartbeat = time.monotonic()
+        self._loop_thread = None
+        self._task = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    async def _measure(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._heartbeat = time.monotonic()
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - start - self.interval, 0)
+            metrics.LOOP_LAG.observe(lag)
+            metrics.LOOP_LAG_LAST.set(lag)
+            if self.slow_threshold and lag > self.slow_threshold:
+                log.warning('Event loop was blocked for %.3fs', lag)
+
+    def _watch(self):
+        reported = None
+        while not self._stopped.wait(min(self.interval, self.slow_threshold) / 2):
+            heartbeat = self._heartbeat
+            blocked = time.monotonic() - heartbeat - self.interval
+            if blocked < self.slow_threshold or heartbeat == reported:
+                continue
+            # Only report each stall once.
+            reported = heartbeat
+            frame = sys._current_frames().get(self._loop_thread, None)
+            if frame is None:
+                continue
+            metrics.SLOW_CALLBACKS.inc()
+            log.warning('Event loop blocked for more than %.3fs in:\n%s',
+                blocked, ''.join(traceback.format_stack(frame)).rstrip())
+
+    def start(self):
+        self._loop_thread = threading.get_ident()
+        self._task = asyncio.create_task(self._measure())
+        if self.slow_threshold:
+            self._thread = threading.Thread(target=self._watch,
+                name='zfs-provisioner-loop-watchdog', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,90 @@
+"""Precompiled manifest templates.
+
+The yaml templates are parsed once at import. Rendering a manifest then
+only copies the parsed skeleton and puts the given values in place, instead
+of formatting the template text and parsing the result for every object.
+
+Values are inserted as they are, never as yaml text, so they do not have to
+be escaped and can not change the structure of the manifest.
+"""
+import re
+
+import yaml
+
+from . import get_template
+
+
+PLACEHOLDER_PATTERN = re.compile(r'\{(\w+)\}')
+SENTINEL_PATTERN = re.compile(r'__placeholder_(\w+?)__')
+
+
+def _copy(value):
+    """Copy the containers of the given parsed yaml document.
+    Scalars are immutable and are shared with the original.
+    """
+    if isinstance(value, dict):
+        return {k:_copy(v) for k,v in value.items()}
+    if isinstance(value, list):
+        return [_copy(v) for v in value]
+    return value
+
+
+class Template():
+    """Manifest template with `{name}` placeholders as used by str.format.
+    """
+
+    def __init__(self, text):
+        # Turn the placeholders into plain strings yaml can parse.
+        text = PLACEHOLDER_PATTERN.sub(r'__placeholder_\1__', text)
+        self.skeleton = yaml.safe_load(text)
+        # List of (path, name, format) of all the values with placeholders.
+        # Format is None for values that consist of a single placeholder.
+        self.placeholders = []
+        self._compile(self.skeleton, ())
+
+    def _compile(self, value, path):
+        if isinstance(value, dict):
+            items = value.items()
+        elif isinstance(value, list):
+            items = enumerate(value)
+        else:
+            return
+        for key,item in items:
+            if isinstance(item, str):
+                names = SENTINEL_PATTERN.findall(item)
+                if not names:
+                    continue
+                fmt = SENTINEL_PATTERN.sub(r'{\1}', item)
+                if fmt == '{%s}' % names[0]:
+                    fmt = None
+                self.placeholders.append((path + (key,), names[0], fmt))
+            else:
+                self._compile(item, path + (key,))
+
+    @property
+    def names(self):
+        return {name for path,name,fmt in self.placeholders}
+
+    def render(self, **values):
+        """Return a new manifest with the placeholders replaced by values.
+        """
+        data = _copy(self.skeleton)
+        for path,name,fmt in self.placeholders:
+            container = data
+            for key in path[:-1]:
+                container = container[key]
+            if fmt is None:
+                container[path[-1]] = values[name]
+            else:
+                container[path[-1]] = fmt.format(**values)
+        return data
+
+
+def load(template_file):
+    """Load and compile the given template file.
+    """
+    return Template(get_template(template_file))
+
+
+DATASET_POD: Template = load('dataset-pod.yaml')
+PERSISTENT_VOLUME: Template = load('pvc.yaml')
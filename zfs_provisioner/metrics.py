@@ -0,0 +1,155 @@
+"""Prometheus metrics of the controller.
+"""
+import contextlib
+import functools
+import inspect
+
+import kopf
+import prometheus_client
+
+
+API_POOL_SIZE = prometheus_client.Gauge(
+    'zfs_provisioner_api_pool_size',
+    'Maximum number of connections to the kubernetes API server.',
+)
+API_REQUESTS_IN_FLIGHT = prometheus_client.Gauge(
+    'zfs_provisioner_api_requests_in_flight',
+    'Number of requests to the kubernetes API server that hold or wait for a '
+    'connection, until their response starts.',
+)
+API_CONNECTIONS = prometheus_client.Counter(
+    'zfs_provisioner_api_connections',
+    'Number of connections to the kubernetes API server by whether they were created or reused.',
+    labelnames=('how',),
+)
+
+SCHEDULER_RUNNING = prometheus_client.Gauge(
+    'zfs_provisioner_scheduler_running',
+    'Number of dataset operations that are running.',
+)
+SCHEDULER_QUEUED = prometheus_client.Gauge(
+    'zfs_provisioner_scheduler_queued',
+    'Number of dataset operations that wait for a free slot.',
+)
+SCHEDULER_WAIT = prometheus_client.Histogram(
+    'zfs_provisioner_scheduler_wait_seconds',
+    'Seconds dataset operations waited for a free slot.',
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+
+# Stages of the dataset operations:
+#   queue: waiting for a free slot of the scheduler
+#   pod_create: creating the dataset pod
+#   pod_running: from the pod being created until it runs
+#   zfs: running the zfs commands, in the pod or on the node agent
+#   pv_create/pv_delete: creating/deleting the persistent volume
+STAGE_DURATION = prometheus_client.Histogram(
+    'zfs_provisioner_stage_duration_seconds',
+    'Seconds spent in each stage of the dataset operations.',
+    labelnames=('action', 'stage'),
+    buckets=(0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+OPERATIONS = prometheus_client.Counter(
+    'zfs_provisioner_operations',
+    'Number of finished dataset operations by outcome.',
+    labelnames=('action', 'storage_class', 'node', 'outcome'),
+)
+IN_FLIGHT = prometheus_client.Gauge(
+    'zfs_provisioner_operations_in_flight',
+    'Number of dataset operations that are in progress.',
+    labelnames=('action',),
+)
+POD_EVENTS = prometheus_client.Gauge(
+    'zfs_provisioner_pod_events',
+    'Number of dataset pods whose completion is waited for.',
+    labelnames=('action',),
+)
+
+LOOP_LAG = prometheus_client.Histogram(
+    'zfs_provisioner_event_loop_lag_seconds',
+    'Seconds the event loop was late to run a scheduled callback.',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+LOOP_LAG_LAST = prometheus_client.Gauge(
+    'zfs_provisioner_event_loop_lag_last_seconds',
+    'Seconds the event loop was late at the last measurement.',
+)
+SLOW_CALLBACKS = prometheus_client.Counter(
+    'zfs_provisioner_event_loop_blocked',
+    'Number of times a callback blocked the event loop longer than the threshold.',
+)
+HANDLER_DURATION = prometheus_client.Histogram(
+    'zfs_provisioner_handler_duration_seconds',
+    'Seconds the kopf handlers took per call.',
+    labelnames=('handler',),
+    buckets=(0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300),
+)
+
+CONFIG_RELOADS = prometheus_client.Counter(
+    'zfs_provisioner_config_reloads',
+    'Number of dataset config reloads by result: loaded, unchanged or invalid.',
+    labelnames=('result',),
+)
+
+CACHED_OBJECTS = prometheus_client.Gauge(
+    'zfs_provisioner_cached_objects',
+    'Number of objects in the local cache by resource.',
+    labelnames=('resource',),
+)
+
+OUTCOME_SUCCEEDED = 'succeeded'
+OUTCOME_RETRIED = 'retried'
+OUTCOME_FAILED = 'failed'
+
+
+def observe_stage(action, stage, seconds):
+    STAGE_DURATION.labels(action, stage).observe(seconds)
+
+
+def time_stage(action, stage):
+    """Return a context manager that observes the duration of its block.
+    """
+    return STAGE_DURATION.labels(action, stage).time()
+
+
+@contextlib.contextmanager
+def track_operation(action, storage_class, node):
+    """Count the dataset operation in its block as in flight and record its outcome.
+
+    Outcomes are `succeeded`, `retried` for kopf.TemporaryError and
+    `failed` for any other exception.
+    """
+    in_flight = IN_FLIGHT.labels(action)
+    in_flight.inc()
+    outcome = OUTCOME_FAILED
+    try:
+        yield
+        outcome = OUTCOME_SUCCEEDED
+    except kopf.TemporaryError:
+        outcome = OUTCOME_RETRIED
+        raise
+    finally:
+        in_flight.dec()
+        OPERATIONS.labels(action, storage_class, node or '', outcome).inc()
+
+
+def timed_handler(func):
+    """Decorator that observes the duration of every call of the
+    decorated handler, or coroutine handler, by its name.
+    """
+    histogram = HANDLER_DURATION.labels(func.__name__)
+    if inspect.iscoroutinefunction(func):
+        async def wrapper(*args, **kwargs):
+            with histogram.time():
+                return await func(*args, **kwargs)
+    else:
+        def wrapper(*args, **kwargs):
+            with histogram.time():
+                return func(*args, **kwargs)
+    return functools.wraps(func)(wrapper)
+
+
+def start_server(port, address='0.0.0.0'):
+    """Serve the metrics on http://address:port/metrics in a background thread.
+    """
+    prometheus_client.start_http_server(port, addr=address)
@@ -0,0 +1,66 @@
+"""Dataset operations that run on the node owning the zfs pool.
+
+These are shared by the `zfs-provisioner dataset` commands executed in the
+dataset pods and by the long-running node agent.
+"""
+import logging
+import os
+
+from . import zfs
+
+log = logging.getLogger('zfs-provisioner')
+
+
+def _exists_at(dataset, mountpoint):
+    """Return whether the given dataset exists and has the given mountpoint.
+    """
+    if not zfs.exists(dataset):
+        return False
+    return zfs.get_properties(dataset, 'mountpoint').get('mountpoint', None) == mountpoint
+
+
+def create_dataset(dataset, mountpoint, quota=None, refquota=None):
+    """Create the given dataset and mount it to mountpoint
+    while optionally setting a quota and/or refquota.
+
+    Ensure that the parent dataset, determined from dataset,
+    exists and ensure it has safe permissions. A dataset that already
+    exists with the given mountpoint is considered created.
+    """
+    # Ensure the mountpoints parent folder exists and has safe permissions.
+    mountpoint_dir = os.path.split(mountpoint)[0]
+    os.makedirs(mountpoint_dir, mode=0o700, exist_ok=True)
+    os.chmod(mountpoint_dir, 0o700)
+
+    # Ensure we have parent dataset whith mountpoint set to legacy
+    # and create our dataset.
+    try:
+        zfs.create_with_parent(dataset, {'mountpoint': 'legacy'},
+            mountpoint=mountpoint, quota=quota, refquota=refquota)
+    except zfs.ZfsCommandError:
+        if not _exists_at(dataset, mountpoint):
+            raise
+        # Created by an earlier attempt whose result got lost.
+        log.info('Dataset %s already exists at %s', dataset, mountpoint)
+
+    # Ensure the dataset is writable by the pod.
+    os.chmod(mountpoint, 0o777)
+
+
+def destroy_dataset(dataset, mountpoint):
+    """Destroy the given dataset and delete it's former mountpoint.
+    A dataset that does not exist is considered destroyed.
+    """
+    # Destroy the dataset.
+    try:
+        zfs.destroy(dataset)
+    except zfs.ZfsCommandError:
+        if zfs.exists(dataset):
+            raise
+        log.info('Dataset %s does not exist', dataset)
+
+    # Delete the mountpint.
+    try:
+        os.rmdir(mountpoint)
+    except FileNotFoundError:
+        pass
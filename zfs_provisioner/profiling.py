@@ -0,0 +1,231 @@
+"""On-demand profiling of the running controller.
+
+A profiling session runs for a given number of seconds and writes its
+results to the profile directory:
+
+- `<name>.collapsed`: stacks sampled from all threads in the collapsed
+  format understood by flamegraph.pl, speedscope and friends
+- `<name>.pstats`: cProfile statistics of the event loop thread, readable
+  with `python -m pstats`, only if requested as it slows the loop down
+- `<name>.tracemalloc` and `<name>-allocations.txt`: a tracemalloc snapshot,
+  loadable with tracemalloc.Snapshot.load, and the top allocation sites,
+  only if requested
+
+Sessions are started by sending SIGUSR2 to the process or by the admin
+endpoint:
+
+    curl -X POST 'http://127.0.0.1:9478/debug/profile?seconds=30&pstats=1&allocations=1'
+"""
+import asyncio
+import collections
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+from . import Error
+
+log = logging.getLogger('zfs-provisioner')
+
+
+SIGNAL = signal.SIGUSR2
+
+# Number of frames tracemalloc keeps per allocation.
+ALLOCATION_FRAMES = 25
+
+# The running session, there is at most one at a time.
+SESSION = None
+
+# Runner of the admin HTTP server.
+_runner = None
+
+
+class ProfilingError(Error):
+    """Error raised when a profiling session can not be started.
+    """
+    pass
+
+
+class StackSampler():
+    """Sample the stacks of all other threads every interval seconds
+    and count them in collapsed form.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.counts = collections.Counter()
+        self.samples = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _collapse(frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            frame = frame.f_back
+        return ';'.join(reversed(stack))
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident,frame in sys._current_frames().items():
+                if ident != own:
+                    name = names.get(ident, str(ident)).replace(' ', '_')
+                    self.counts[f'{name};{self._collapse(frame)}'] += 1
+            self.samples += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='zfs-provisioner-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            for stack,count in self.counts.most_common():
+                f.write(f'{stack} {count}\n')
+
+
+class Session():
+    """A profiling session, has to be started and stopped on the event loop thread.
+    """
+
+    def __init__(self, directory, pstats=False, allocations=False, interval=0.005):
+        self.directory = directory
+        self.name = time.strftime('%Y%m%d-%H%M%S') + f'-{os.getpid()}'
+        self.sampler = StackSampler(interval)
+        self.pstats = pstats
+        self.allocations = allocations
+        self.profile = None
+        self.snapshot = None
+        self._started_tracemalloc = False
+
+    def path(self, suffix):
+        return os.path.join(self.directory, self.name + suffix)
+
+    def start(self):
+        log.info('Profiling to %s (pstats: %s, allocations: %s)',
+            self.path('.*'), self.pstats, self.allocations)
+        if self.allocations:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(ALLOCATION_FRAMES)
+                self._started_tracemalloc = True
+        if self.pstats:
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        self.sampler.start()
+
+    def stop(self):
+        self.sampler.stop()
+        if self.profile is not None:
+            self.profile.disable()
+        if self.allocations:
+            import tracemalloc
+            self.snapshot = tracemalloc.take_snapshot()
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+
+    def dump(self):
+        """Write the results and return the paths of the written files.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        paths = [self.path('.collapsed')]
+        self.sampler.write(paths[-1])
+        if self.profile is not None:
+            paths.append(self.path('.pstats'))
+            self.profile.dump_stats(paths[-1])
+        if self.snapshot is not None:
+            paths.append(self.path('.tracemalloc'))
+            self.snapshot.dump(paths[-1])
+            paths.append(self.path('-allocations.txt'))
+            with open(paths[-1], 'w') as f:
+                for stat in self.snapshot.statistics('traceback')[:50]:
+                    f.write(f'{stat}\n')
+                    f.writelines(f'    {line}\n' for line in stat.traceback.format())
+        log.info('Profiling finished, wrote: %s', ', '.join(paths))
+        return paths
+
+
+async def profile(directory, seconds, **options):
+    """Profile the process for the given seconds and return the paths
+    of the written files. See `Session` for the options.
+    """
+    global SESSION
+    if SESSION is not None:
+        raise ProfilingError(f'A profiling session is already running: {SESSION.name}')
+    session = Session(directory, **options)
+    SESSION = session
+    try:
+        session.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            session.stop()
+        return await asyncio.get_running_loop().run_in_executor(None, session.dump)
+    finally:
+        SESSION = None
+
+
+def install_signal_handler(directory, seconds):
+    """Start a profiling session of the given seconds on SIGUSR2.
+    """
+    loop = asyncio.get_running_loop()
+
+    def on_signal():
+        if SESSION is not None:
+            log.warning('Ignoring %s, a profiling session is already running', SIGNAL.name)
+            return
+        loop.create_task(profile(directory, seconds))
+
+    loop.add_signal_handler(SIGNAL, on_signal)
+
+
+def _flag(value):
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+async def start_server(address, port, directory, seconds):
+    """Serve the admin endpoint on address:port.
+    """
+    import aiohttp.web
+    global _runner
+
+    async def handle_profile(request):
+        try:
+            paths = await profile(directory,
+                float(request.query.get('seconds', seconds)),
+                pstats=_flag(request.query.get('pstats', '')),
+                allocations=_flag(request.query.get('allocations', '')),
+            )
+        except ProfilingError as e:
+            return aiohttp.web.json_response({'error': str(e)}, status=409)
+        except ValueError as e:
+            return aiohttp.web.json_response({'error': str(e)}, status=400)
+        return aiohttp.web.json_response({'files': paths})
+
+    async def handle_status(request):
+        return aiohttp.web.json_response({'running': SESSION.name if SESSION else None})
+
+    app = aiohttp.web.Application()
+    app.router.add_post('/debug/profile', handle_profile)
+    app.router.add_get('/debug/profile', handle_status)
+    _runner = aiohttp.web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    await aiohttp.web.TCPSite(_runner, address, port).start()
+    log.info('Serving admin endpoint on %s:%s', address, port)
+
+
+async def stop_server():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
@@ -0,0 +1,357 @@
+"""Label selected watches of the PVCs, used with labelled PVCs.
+
+kopf watches all PVCs of the cluster and has no way to pass a label
+selector to the API server. With labelled PVCs the PVC handlers are
+therefore not registered with kopf, see `handlers.register_pvc_handlers`,
+and two watches of our own replace them:
+
+- `watch_managed_pvcs` lists and watches only the PVCs labelled as ours,
+  keeps `cache.PVCS` current and runs the dataset handlers for them.
+- `watch_unlabelled_pvcs` lists and watches only the PVCs without the
+  managed label, keeps their name and storage class in
+  `cache.UNLABELLED_PVCS` and labels the ones of our storage classes.
+
+The dataset handlers are run much like kopf would. A TemporaryError is
+retried after its delay up to max_retries times, and only one handler
+runs per PVC at a time. Deletion of a PVC is held back by a finalizer. It
+is added before the dataset is created and only removed once the dataset
+has been deleted, or if none was created.
+"""
+import asyncio
+import logging
+
+from typing import Dict, List
+
+import aiohttp
+import kopf
+import kubernetes_asyncio
+
+from . import api
+from . import cache
+from . import handlers
+from .handlers import CONFIG
+
+log = logging.getLogger('zfs-provisioner')
+
+
+FINALIZER = 'zfs-provisioner/dataset'
+
+# Seconds after which the API server ends a watch, it is then resumed
+# from the last seen resourceVersion.
+WATCH_TIMEOUT = 300
+
+# Number of PVCs to fetch per LIST request.
+PAGE_SIZE = 500
+
+# Running handler tasks by the uid of their PVC.
+_handler_tasks: Dict[str, asyncio.Task] = {}
+
+# resourceVersions the watch delivered while the handlers ran, by uid.
+_seen: Dict[str, List[str]] = {}
+
+# resourceVersion of the last write of the handlers by uid, for the PVCs
+# whose watch has not delivered it yet. Older events are not handled.
+_expected: Dict[str, str] = {}
+
+
+def managed_selector():
+    return f'{CONFIG.managed_label}={CONFIG.provisioner_name}'
+
+
+def unlabelled_selector():
+    return f'!{CONFIG.managed_label}'
+
+
+async def _list(v1, label_selector):
+    """Return the PVCs matching the label selector as dicts
+    and the resourceVersion to watch them from.
+    """
+    items = []
+    _continue = None
+    while True:
+        # Skip the deserialization into models, the handlers work on dicts.
+        response = await v1.list_persistent_volume_claim_for_all_namespaces(
+            label_selector=label_selector, limit=PAGE_SIZE, _continue=_continue,
+            _preload_content=False)
+        result = await response.json()
+        items.extend(result['items'])
+        _continue = result['metadata'].get('continue', None)
+        if not _continue:
+            return items, result['metadata']['resourceVersion']
+
+
+async def _watch(label_selector, replace, apply):
+    """List and watch the PVCs matching the label selector. Call replace
+    with the result of every LIST and apply with the type and object of
+    every event.
+    """
+    v1 = api.core_v1()
+    resource_version = None
+    while True:
+        try:
+            if resource_version is None:
+                items, resource_version = await _list(v1, label_selector)
+                await replace(items)
+            stream = kubernetes_asyncio.watch.Watch().stream(
+                v1.list_persistent_volume_claim_for_all_namespaces,
+                label_selector=label_selector, resource_version=resource_version,
+                timeout_seconds=WATCH_TIMEOUT)
+            async for event in stream:
+                if event['type'] == 'ERROR':
+                    # Expired resourceVersion of older kubernetes_asyncio versions.
+                    resource_version = None
+                    break
+                obj = event['raw_object']
+                resource_version = obj['metadata']['resourceVersion']
+                await apply(event['type'], obj)
+        except kubernetes_asyncio.client.exceptions.ApiException as e:
+            if e.status != 410:
+                log.error('Watching PVCs with %s failed, retrying in %ss: %s',
+                    label_selector, CONFIG.retry_delay, e)
+                await asyncio.sleep(CONFIG.retry_delay)
+            resource_version = None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log.error('Watching PVCs with %s failed, retrying in %ss: %s',
+                label_selector, CONFIG.retry_delay, e)
+            await asyncio.sleep(CONFIG.retry_delay)
+
+
+async def _patch_pvc(obj, patch):
+    v1 = api.core_v1()
+    metadata = obj['metadata']
+    response = await v1.patch_namespaced_persistent_volume_claim(metadata['name'],
+        metadata['namespace'], patch, _preload_content=False)
+    return await response.json()
+
+
+async def _set_finalizer(obj, present):
+    finalizers = [f for f in obj['metadata'].get('finalizers', None) or [] if f != FINALIZER]
+    if present:
+        finalizers.append(FINALIZER)
+    # The resourceVersion makes the patch fail instead of dropping
+    # finalizers that were changed concurrently.
+    return await _patch_pvc(obj, {'metadata': {
+        'finalizers': finalizers,
+        'resourceVersion': obj['metadata']['resourceVersion'],
+    }})
+
+
+def _latest(name, namespace, uid):
+    obj = cache.PVCS.get(name, namespace)
+    if obj is None or obj['metadata']['uid'] != uid:
+        return None
+    return obj
+
+
+async def _call(handler, obj):
+    """Run the kopf style handler for the PVC until it succeeds and return
+    the patch it made, or None if it failed permanently or the PVC is gone.
+
+    Like handlers._check_retries, give up once the handler has been
+    retried max_retries times.
+    """
+    metadata = obj['metadata']
+    name, namespace, uid = metadata['name'], metadata['namespace'], metadata['uid']
+    retry = 0
+    while True:
+        body = kopf.Body(obj)
+        patch = kopf.Patch()
+        try:
+            await handler(name=name, namespace=namespace, body=body, meta=body.meta,
+                spec=body.spec, status=body.status, patch=patch, logger=log, retry=retry)
+            return patch
+        except kopf.TemporaryError as e:
+            delay = e.delay if e.delay is not None else CONFIG.retry_delay
+            error = e
+        except kopf.PermanentError as e:
+            log.error('%s: %s failed permanently: %s', name, handler.__name__, e)
+            return None
+        except Exception as e:
+            delay = CONFIG.retry_delay
+            error = e
+            log.exception('%s: %s failed', name, handler.__name__)
+        if retry >= CONFIG.max_retries:
+            log.error('%s: %s failed permanently, giving up after %s attempts: %s',
+                name, handler.__name__, retry + 1, error)
+            return None
+        log.error('%s: %s failed, retrying in %ss: %s', name, handler.__name__, delay, error)
+        await asyncio.sleep(delay)
+        retry += 1
+        obj = _latest(name, namespace, uid)
+        if obj is None:
+            return None
+
+
+async def _handle(obj):
+    """Run the handlers for the PVC and return the resourceVersion
+    of their last write, if any.
+    """
+    metadata = obj['metadata']
+    body = kopf.Body(obj)
+    finalizers = metadata.get('finalizers', None) or []
+    written = None
+    if metadata.get('deletionTimestamp', None):
+        if FINALIZER not in finalizers:
+            return None
+        # Without the annotation no dataset was created.
+        if CONFIG.dataset_annotation in body.meta.annotations:
+            if not handlers.filter_delete_dataset(body=body, meta=body.meta, spec=body.spec,
+                    status=body.status):
+                # Keep the finalizer until the dataset can be deleted, e.g. once
+                # the storage class is known, see on_storage_class.
+                log.info('%s: not deleting dataset yet, keeping finalizer', metadata['name'])
+                return None
+            if await _call(handlers.delete_dataset, obj) is None:
+                return None
+        obj = await _set_finalizer(obj, False)
+        written = obj['metadata']['resourceVersion']
+    elif (CONFIG.dataset_annotation not in body.meta.annotations
+            and handlers.filter_create_dataset(body=body, meta=body.meta, spec=body.spec,
+                status=body.status)):
+        if FINALIZER not in finalizers:
+            obj = await _set_finalizer(obj, True)
+            written = obj['metadata']['resourceVersion']
+        patch = await _call(handlers.create_dataset, obj)
+        if patch:
+            obj = await _patch_pvc(obj, dict(patch))
+            written = obj['metadata']['resourceVersion']
+    return written
+
+
+def _redispatch(name, namespace, uid):
+    obj = _latest(name, namespace, uid)
+    if obj is not None:
+        _dispatch(obj)
+
+
+def _dispatch(obj):
+    """Run the handlers for the PVC unless they are already running for it.
+
+    The watch delivers the changes of a PVC in order. Once the handlers
+    finished they run again for changes that came after their last write,
+    changes before it are outdated. If they failed, they run again with
+    the latest state of the PVC after retry_delay.
+    """
+    metadata = obj['metadata']
+    name, namespace, uid = metadata['name'], metadata['namespace'], metadata['uid']
+    if uid in _handler_tasks or uid in _expected:
+        return
+    task = asyncio.create_task(_handle(obj))
+    _handler_tasks[uid] = task
+    _seen[uid] = []
+
+    def done(task):
+        del _handler_tasks[uid]
+        seen = _seen.pop(uid)
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            log.error('%s: handling failed, retrying in %ss: %r', name, CONFIG.retry_delay,
+                task.exception())
+            asyncio.get_running_loop().call_later(CONFIG.retry_delay, _redispatch,
+                name, namespace, uid)
+            return
+        written = task.result()
+        if written is not None and written not in seen:
+            _expected[uid] = written
+        elif seen and seen[-1] != written:
+            _redispatch(name, namespace, uid)
+    task.add_done_callback(done)
+
+
+def _changed(obj):
+    metadata = obj['metadata']
+    uid, resource_version = metadata['uid'], metadata['resourceVersion']
+    if uid in _seen:
+        _seen[uid].append(resource_version)
+    elif uid in _expected:
+        if _expected[uid] == resource_version:
+            del _expected[uid]
+    else:
+        _dispatch(obj)
+
+
+async def _replace_managed(items):
+    cache.PVCS.replace(items)
+    # The LIST is the current state, no older changes can follow.
+    _expected.clear()
+    for obj in items:
+        _changed(obj)
+
+
+async def _apply_managed(event_type, obj):
+    if event_type == 'DELETED':
+        cache.PVCS.delete(obj)
+        _expected.pop(obj['metadata']['uid'], None)
+        return
+    cache.PVCS.update(obj)
+    _changed(obj)
+
+
+async def watch_managed_pvcs():
+    """Watch the PVCs labelled as ours and run the dataset handlers for them.
+    """
+    await _watch(managed_selector(), _replace_managed, _apply_managed)
+
+
+def _unlabelled(obj):
+    # Only keep what is needed to label the PVC later.
+    metadata = obj['metadata']
+    return {
+        'metadata': {'name': metadata['name'], 'namespace': metadata['namespace']},
+        'spec': {'storageClassName': obj['spec'].get('storageClassName', None)},
+    }
+
+
+async def label_pvc(obj):
+    """Label the PVC as ours.
+    """
+    metadata = obj['metadata']
+    log.info('%s: labelling with %s=%s', metadata['name'], CONFIG.managed_label,
+        CONFIG.provisioner_name)
+    try:
+        await _patch_pvc(obj, {'metadata': {'labels': {CONFIG.managed_label: CONFIG.provisioner_name}}})
+    except kubernetes_asyncio.client.exceptions.ApiException as e:
+        if e.status != 404:
+            log.error('%s: labelling failed: %s', metadata['name'], e)
+            return
+    # The watch may not tell us that it no longer matches.
+    cache.UNLABELLED_PVCS.delete(obj)
+
+
+async def _replace_unlabelled(items):
+    cache.UNLABELLED_PVCS.replace(_unlabelled(obj) for obj in items)
+    for storage_class_name in list(CONFIG.storage_classes):
+        await label_storage_class_pvcs(storage_class_name)
+
+
+async def _apply_unlabelled(event_type, obj):
+    if event_type == 'DELETED':
+        cache.UNLABELLED_PVCS.delete(obj)
+        return
+    obj = _unlabelled(obj)
+    cache.UNLABELLED_PVCS.update(obj)
+    if obj['spec']['storageClassName'] in CONFIG.storage_classes:
+        await label_pvc(obj)
+
+
+async def watch_unlabelled_pvcs():
+    """Watch the PVCs without the managed label and label the ones of our storage classes.
+    """
+    await _watch(unlabelled_selector(), _replace_unlabelled, _apply_unlabelled)
+
+
+async def label_storage_class_pvcs(storage_class_name):
+    """Label the known unlabelled PVCs of the storage class.
+    """
+    for obj in cache.unlabelled_pvcs_by_storage_class(storage_class_name):
+        await label_pvc(obj)
+
+
+async def on_storage_class(storage_class_name):
+    """Pick up the PVCs of a storage class that just became ours.
+    """
+    # Labelled PVCs seen before the storage class was known were skipped.
+    for obj in cache.pvcs_by_storage_class(storage_class_name):
+        _dispatch(obj)
+    await label_storage_class_pvcs(storage_class_name)
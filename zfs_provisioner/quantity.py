@@ -0,0 +1,137 @@
+"""Parser for kubernetes resource quantities.
+
+Implements the quantity grammar of the kubernetes API:
+
+    <quantity>        ::= <signedNumber><suffix>
+    <signedNumber>    ::= <number> | +<number> | -<number>
+    <number>          ::= <digits> | <digits>.<digits> | <digits>. | .<digits>
+    <suffix>          ::= <binarySI> | <decimalExponent> | <decimalSI>
+    <binarySI>        ::= Ki | Mi | Gi | Ti | Pi | Ei
+    <decimalSI>       ::= m | "" | k | M | G | T | P | E
+    <decimalExponent> ::= "e" <signedNumber> | "E" <signedNumber>
+
+Values are represented exactly as fractions.Fraction.
+"""
+import fractions
+import functools
+import math
+import re
+
+from . import Error
+
+
+class QuantityError(Error, ValueError):
+    """Error raised for strings that are not valid quantities.
+    """
+    pass
+
+
+BINARY_SI = 'BinarySI'
+DECIMAL_SI = 'DecimalSI'
+DECIMAL_EXPONENT = 'DecimalExponent'
+
+BINARY_SUFFIXES = {
+    'Ki': 1024,
+    'Mi': 1024 ** 2,
+    'Gi': 1024 ** 3,
+    'Ti': 1024 ** 4,
+    'Pi': 1024 ** 5,
+    'Ei': 1024 ** 6,
+}
+
+# Map of decimal suffix to its base 10 exponent.
+DECIMAL_SUFFIXES = {
+    'm': -3,
+    '': 0,
+    'k': 3,
+    'M': 6,
+    'G': 9,
+    'T': 12,
+    'P': 15,
+    'E': 18,
+}
+
+QUANTITY_PATTERN = re.compile(r'''
+    (?P<number>[+-]?(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+))
+    (?:
+        (?P<binary>Ki|Mi|Gi|Ti|Pi|Ei)
+        |[eE](?P<exponent>[+-]?[0-9]+)
+        |(?P<decimal>[mkMGTPE]?)
+    )
+    ''', re.VERBOSE)
+
+
+@functools.lru_cache(maxsize=1024)
+def parse(quantity):
+    """Parse the given quantity string and return a tuple of
+    its value as Fraction and its format.
+    """
+    match = QUANTITY_PATTERN.fullmatch(quantity.strip())
+    if match is None:
+        raise QuantityError(f'Invalid quantity: {quantity!r}')
+    value = fractions.Fraction(match.group('number'))
+    if match.group('binary'):
+        return value * BINARY_SUFFIXES[match.group('binary')], BINARY_SI
+    if match.group('exponent') is not None:
+        return value * fractions.Fraction(10) ** int(match.group('exponent')), DECIMAL_EXPONENT
+    return value * fractions.Fraction(10) ** DECIMAL_SUFFIXES[match.group('decimal')], DECIMAL_SI
+
+
+def parse_quantity(quantity):
+    """Return the value of the given quantity string as Fraction.
+    """
+    return parse(quantity)[0]
+
+
+def to_bytes(quantity):
+    """Return the given quantity as integer, rounded up like the
+    API server does for byte values.
+    """
+    return math.ceil(parse_quantity(quantity))
+
+
+def _format_decimal(value, exponent_format):
+    sign = '-' if value < 0 else ''
+    value = abs(value)
+    # Kubernetes does not keep precision below milli units, round up.
+    value = fractions.Fraction(math.ceil(value * 1000), 1000)
+    if value == 0:
+        return '0'
+    exponent = -3
+    while exponent < 18 and (value / fractions.Fraction(10) ** (exponent + 3)).denominator == 1:
+        exponent += 3
+    mantissa = value / fractions.Fraction(10) ** exponent
+    if exponent_format:
+        suffix = f'e{exponent}' if exponent else ''
+    else:
+        suffix = {v:k for k,v in DECIMAL_SUFFIXES.items()}[exponent]
+    return f'{sign}{mantissa.numerator}{suffix}'
+
+
+def format_quantity(value, format=DECIMAL_SI):
+    """Return the canonical string representation of value in the given format.
+    """
+    value = fractions.Fraction(value)
+    if format == BINARY_SI:
+        if value.denominator == 1 and abs(value) >= 1024:
+            sign = '-' if value < 0 else ''
+            number = abs(value.numerator)
+            suffix = ''
+            for name,factor in BINARY_SUFFIXES.items():
+                if number % factor == 0:
+                    suffix = name
+                else:
+                    break
+            if suffix:
+                return f'{sign}{number // BINARY_SUFFIXES[suffix]}{suffix}'
+        # Like kubernetes use decimal notation if there is no exact binary one.
+        return _format_decimal(value, False)
+    return _format_decimal(value, format == DECIMAL_EXPONENT)
+
+
+@functools.lru_cache(maxsize=1024)
+def canonicalize(quantity):
+    """Return the canonical form of the given quantity string.
+    """
+    value, format = parse(quantity)
+    return format_quantity(value, format)
@@ -0,0 +1,123 @@
+"""Concurrency limits for dataset operations.
+
+Limits the number of dataset operations that run at the same time, both in
+total and per node. Operations that have to wait are queued per namespace
+and the namespaces are served round-robin, so a single namespace scaling a
+StatefulSet to hundreds of replicas can not starve all the others.
+"""
+import asyncio
+import collections
+import contextlib
+import dataclasses
+import logging
+import time
+
+from . import metrics
+
+log = logging.getLogger('zfs-provisioner')
+
+
+@dataclasses.dataclass(eq=False)
+class Waiter():
+    namespace: str
+    node: str
+    future: asyncio.Future
+    enqueued: float
+
+
+class Scheduler():
+    """Grant slots for dataset operations within a global and a per node limit.
+    """
+
+    def __init__(self, limit=50, node_limit=5):
+        self.limit = limit
+        self.node_limit = node_limit
+        self.running = 0
+        self.running_per_node = collections.Counter()
+        # Queues of waiting operations per namespace in round-robin order.
+        self.queues = collections.OrderedDict()
+
+    @property
+    def queued(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def _available(self, node):
+        return self.running < self.limit and self.running_per_node[node] < self.node_limit
+
+    def _acquire(self, node):
+        self.running += 1
+        self.running_per_node[node] += 1
+        metrics.SCHEDULER_RUNNING.set(self.running)
+
+    def _release(self, node):
+        self.running -= 1
+        self.running_per_node[node] -= 1
+        if not self.running_per_node[node]:
+            del self.running_per_node[node]
+        metrics.SCHEDULER_RUNNING.set(self.running)
+        self._dispatch()
+
+    def _dispatch(self):
+        """Hand out free slots to the waiting operations, taking at most
+        one operation from each namespace per round.
+        """
+        while self.running < self.limit:
+            dispatched = False
+            for namespace in list(self.queues):
+                queue = self.queues[namespace]
+                for waiter in queue:
+                    if self._available(waiter.node):
+                        queue.remove(waiter)
+                        self._acquire(waiter.node)
+                        waiter.future.set_result(None)
+                        dispatched = True
+                        break
+                if not queue:
+                    del self.queues[namespace]
+                elif dispatched:
+                    # Serve the other namespaces first next time.
+                    self.queues.move_to_end(namespace)
+                if dispatched or self.running >= self.limit:
+                    break
+            if not dispatched:
+                break
+        metrics.SCHEDULER_QUEUED.set(self.queued)
+
+    def _remove(self, waiter):
+        queue = self.queues.get(waiter.namespace, None)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del self.queues[waiter.namespace]
+        metrics.SCHEDULER_QUEUED.set(self.queued)
+
+    async def _wait(self, namespace, node):
+        waiter = Waiter(namespace, node, asyncio.get_running_loop().create_future(), time.monotonic())
+        self.queues.setdefault(namespace, collections.deque()).append(waiter)
+        self._dispatch()
+        if waiter.future.done():
+            metrics.SCHEDULER_WAIT.observe(0)
+            return
+        log.debug('scheduler: queued %s on %s (running: %d, queued: %d)',
+            namespace, node, self.running, self.queued)
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Got a slot but nobody is going to use it.
+                self._release(node)
+            else:
+                self._remove(waiter)
+            raise
+        metrics.SCHEDULER_WAIT.observe(time.monotonic() - waiter.enqueued)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, namespace, node):
+        """Wait until an operation for namespace may run on node
+        and hold the slot for the duration of the context.
+        """
+        await self._wait(namespace, node)
+        try:
+            yield
+        finally:
+            self._release(node)
@@ -0,0 +1,18 @@
+-- Read-only channel program that reports whether a dataset exists and the
+-- values of the requested properties in a single call.
+--
+-- Usage: zfs program -n -j <pool> probe-dataset.lua <dataset> [<property> ...]
+args = ...
+argv = args["argv"]
+dataset = argv[1]
+
+result = {}
+result["exists"] = zfs.exists(dataset)
+if result["exists"] then
+    properties = {}
+    for i = 2, #argv do
+        properties[argv[i]] = zfs.get_prop(dataset, argv[i])
+    end
+    result["properties"] = properties
+end
+return result
@@ -0,0 +1,204 @@
+"""Lightweight tracing of dataset operations across processes.
+
+A trace follows a PVC from the controllers handler through the dataset pod
+or the node agent down to the individual zfs calls. The trace context is
+propagated in the W3C `traceparent` format: in the ZFS_PROVISIONER_TRACEPARENT
+environment variable of the dataset pods and in the `traceparent` header of
+the requests to the node agents.
+
+Finished spans are appended as JSON lines to the file given to `configure`,
+or in the ZFS_PROVISIONER_TRACE_FILE environment variable. Without a trace
+file spans only propagate their context and cost next to nothing.
+
+Example of an exported span:
+
+    {"trace_id": "4bf92f3577b34da6a3ce929d0e0e4736", "span_id": "00f067aa0ba902b7",
+     "parent_id": "b7ad6b7169203331", "name": "zfs.create", "start": 1589203412.21,
+     "duration": 0.043, "attributes": {"dataset": "tank/provisioner/x"}}
+"""
+import collections
+import contextlib
+import contextvars
+import functools
+import os
+import threading
+import time
+
+
+TRACEPARENT_ENV = 'ZFS_PROVISIONER_TRACEPARENT'
+TRACE_FILE_ENV = 'ZFS_PROVISIONER_TRACE_FILE'
+TRACEPARENT_HEADER = 'traceparent'
+
+# Same as inspect.CO_COROUTINE, inspect is too slow to import for the worker.
+_CO_COROUTINE = 0x80
+
+# Context of a span that was started in another process.
+RemoteContext = collections.namedtuple('RemoteContext', ('trace_id', 'span_id'))
+
+_current = contextvars.ContextVar('zfs_provisioner_span', default=None)
+
+# Exporter of the finished spans, None if spans are not exported.
+EXPORTER = None
+
+
+def _new_id(size):
+    return os.urandom(size).hex()
+
+
+class Span():
+    """A timed operation within a trace.
+    """
+
+    def __init__(self, name, trace_id, parent_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.attributes = attributes or {}
+        self.error = None
+        self.start = time.time()
+        self.duration = None
+        self._started = time.perf_counter()
+
+    @property
+    def traceparent(self):
+        return f'00-{self.trace_id}-{self.span_id}-01'
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._started
+
+    def to_dict(self):
+        data = {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration': self.duration,
+            'attributes': self.attributes,
+        }
+        if self.error is not None:
+            data['error'] = self.error
+        return data
+
+
+class JsonlExporter():
+    """Append spans as JSON lines to a file.
+
+    Every span is written with a single write to a file opened for appending,
+    so several processes can share the same file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        import json
+        line = json.dumps(span.to_dict(), separators=(',', ':'), default=str) + '\n'
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a', buffering=1)
+            self._file.write(line)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def configure(trace_file=None):
+    """Export the finished spans to trace_file,
+    default to the file in the ZFS_PROVISIONER_TRACE_FILE environment variable.
+    """
+    global EXPORTER
+    if trace_file is None:
+        trace_file = os.environ.get(TRACE_FILE_ENV, None)
+    if EXPORTER is not None:
+        EXPORTER.close()
+    EXPORTER = JsonlExporter(trace_file) if trace_file else None
+
+
+def parse_traceparent(traceparent):
+    """Return the RemoteContext of the given traceparent or None if it is invalid.
+    """
+    try:
+        version, trace_id, span_id, flags = traceparent.split('-')
+        int(trace_id, 16)
+        int(span_id, 16)
+    except (AttributeError, ValueError):
+        return None
+    if len(trace_id) != 32 or len(span_id) != 16:
+        return None
+    return RemoteContext(trace_id, span_id)
+
+
+def current_traceparent():
+    """Return the traceparent of the current span or None if there is none.
+    """
+    current = _current.get()
+    if current is None:
+        return None
+    return f'00-{current.trace_id}-{current.span_id}-01'
+
+
+@contextlib.contextmanager
+def remote(traceparent):
+    """Continue the trace of the given traceparent for the duration of the context.
+
+    Does nothing if traceparent is None or invalid.
+    """
+    context = parse_traceparent(traceparent)
+    if context is None:
+        yield
+        return
+    token = _current.set(context)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Run the context in a new span that is a child of the current span,
+    or starts a new trace if there is no current span.
+    """
+    parent = _current.get()
+    if parent is None:
+        current = Span(name, _new_id(16), attributes=attributes)
+    else:
+        current = Span(name, parent.trace_id, parent.span_id, attributes=attributes)
+    token = _current.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        _current.reset(token)
+        current.finish()
+        if EXPORTER is not None:
+            EXPORTER.export(current)
+
+
+def traced(name):
+    """Decorator that runs the decorated function, or coroutine function,
+    in a span with the functions first argument as `dataset` attribute.
+    """
+    def decorator(func):
+        if func.__code__.co_flags & _CO_COROUTINE:
+            async def wrapper(*args, **kwargs):
+                with span(name, dataset=args[0] if args else None):
+                    return await func(*args, **kwargs)
+        else:
+            def wrapper(*args, **kwargs):
+                with span(name, dataset=args[0] if args else None):
+                    return func(*args, **kwargs)
+        return functools.wraps(func)(wrapper)
+    return decorator
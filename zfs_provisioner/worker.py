@@ -0,0 +1,105 @@
+"""Minimal entry point for the dataset operations run in the dataset pods.
+
+Every dataset pod runs a single short-lived operation, so the interpreter
+and import overhead of the full `zfs-provisioner` cli would dominate its
+runtime. This entry point only imports the `zfs` module (through `node`)
+and parses its few arguments by hand.
+
+Usage:
+    zfs-provisioner-worker create [--quota QUOTA] [--refquota REFQUOTA] DATASET MOUNTPOINT
+    zfs-provisioner-worker destroy DATASET MOUNTPOINT
+
+Configuration is read from the same environment variables as the cli:
+ZFS_PROVISIONER_LOG_LEVEL, ZFS_PROVISIONER_ZFS_BACKEND and
+ZFS_PROVISIONER_ZFS_CHANNEL_PROGRAM. The operation joins the trace given in
+ZFS_PROVISIONER_TRACEPARENT and exports its spans to ZFS_PROVISIONER_TRACE_FILE.
+"""
+import os
+import sys
+
+from . import node
+from . import tracing
+from . import zfs
+
+
+USAGE = __doc__[__doc__.index('Usage:'):__doc__.index('\n\n', __doc__.index('Usage:'))]
+
+TRUE_VALUES = ('1', 'true', 'yes', 'on')
+
+
+class UsageError(Exception):
+    pass
+
+
+def _parse_args(argv):
+    """Return the command, its positional arguments and its options.
+    """
+    if not argv or argv[0] in ('-h', '--help'):
+        raise UsageError()
+    command = argv[0]
+    arguments = []
+    options = {}
+    args = iter(argv[1:])
+    for arg in args:
+        if arg.startswith('--'):
+            name, _, value = arg[2:].partition('=')
+            if name not in ('quota', 'refquota') or command != 'create':
+                raise UsageError(f'Unknown option: {arg}')
+            if not value:
+                value = next(args, None)
+                if value is None:
+                    raise UsageError(f'Missing value for option: {arg}')
+            options[name] = value
+        else:
+            arguments.append(arg)
+    if command not in ('create', 'destroy'):
+        raise UsageError(f'Unknown command: {command}')
+    if len(arguments) != 2:
+        raise UsageError('Expected the arguments DATASET and MOUNTPOINT')
+    return command, arguments, options
+
+
+def _configure(environ):
+    log_level = environ.get('ZFS_PROVISIONER_LOG_LEVEL', '')
+    if log_level:
+        import logging
+        logging.basicConfig(level=logging.ERROR, format='%(levelname)s: %(message)s', stream=sys.stdout)
+        zfs.log.setLevel(getattr(logging, log_level.upper()))
+
+    backend = environ.get('ZFS_PROVISIONER_ZFS_BACKEND', zfs.CliBackend.name)
+    if backend == zfs.CliBackend.name:
+        channel_program = environ.get('ZFS_PROVISIONER_ZFS_CHANNEL_PROGRAM', '').lower() in TRUE_VALUES
+        zfs.set_backend(backend, channel_program=channel_program)
+    else:
+        zfs.set_backend(backend)
+
+    tracing.configure(environ.get(tracing.TRACE_FILE_ENV, None))
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    try:
+        command, (dataset, mountpoint), options = _parse_args(argv)
+    except UsageError as e:
+        if e.args:
+            print(f'Error: {e}', file=sys.stderr)
+        print(USAGE, file=sys.stderr)
+        return 2
+
+    _configure(os.environ)
+    try:
+        with tracing.remote(os.environ.get(tracing.TRACEPARENT_ENV, None)), \
+                tracing.span(f'worker.{command}', dataset=dataset):
+            if command == 'create':
+                node.create_dataset(dataset, mountpoint, **options)
+            else:
+                node.destroy_dataset(dataset, mountpoint)
+    except (zfs.ZfsCommandError, OSError) as e:
+        print(f'Error: {e}', file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,20 @@
+import collections
 import logging
+import os
 import subprocess
+import sys
+import time
+
+from typing import List
 
 log = logging.getLogger('zfs-provisioner')
 
 from . import Error
+from . import tracing
+
+
+# Record yielded by the streaming parsers for every line of `zfs get` output.
+Property = collections.namedtuple('Property', ('name', 'property', 'value'))
 
 
 class ZfsCommandError(Error):
@@ -12,87 +23,726 @@ class ZfsCommandError(Error):
     pass
 
 
-def create(dataset, *args, **properties):
-    """Create the given dataset with the given properties.
+class Backend():
+    """Interface of the backends that implement the zfs operations.
     """
-    cmd = ['zfs', 'create']
-    cmd.extend(args)
-    for k,v in properties.items():
-        if v is not None:
-            cmd.extend(['-o', f'{k}={v}'])
+    name: str = None
+
+    def exists(self, dataset):
+        """Return True if the given dataset exists.
+        """
+        raise NotImplementedError()
+
+    def create(self, dataset, *args, **properties):
+        raise NotImplementedError()
+
+    def destroy(self, dataset, *args):
+        raise NotImplementedError()
+
+    def set_properties(self, dataset, **properties):
+        raise NotImplementedError()
+
+    def get_properties(self, dataset, *keys):
+        raise NotImplementedError()
+
+    def list(self, dataset, recursive=False):
+        """Return the names of the given dataset and,
+        if recursive is True, all its descendants.
+        """
+        raise NotImplementedError()
+
+    def iter_list(self, dataset, recursive=False):
+        """Like `list` but yield the names one at a time.
+        """
+        yield from self.list(dataset, recursive=recursive)
+
+    def list_properties(self, dataset, *keys, recursive=False):
+        """Return a dict mapping the names of the given dataset and,
+        if recursive is True, all its descendants to a dict of the
+        given properties.
+        """
+        return {name:self.get_properties(name, *keys)
+            for name in self.list(dataset, recursive=recursive)}
+
+    def iter_properties(self, datasets, *keys, recursive=False, depth=None):
+        """Yield a Property for each of the given properties of the given
+        datasets and, if recursive is True, their descendants up to depth
+        levels deep.
+        """
+        for dataset in datasets:
+            if recursive:
+                level = dataset.count('/')
+                names = (name for name in self.iter_list(dataset, recursive=True)
+                    if depth is None or name.count('/') - level <= depth)
+            else:
+                names = (dataset,)
+            for name in names:
+                for key,value in self.get_properties(name, *keys).items():
+                    yield Property(name, key, value)
+
+    def create_with_parent(self, dataset, parent_properties, **properties):
+        """Ensure the parent of the given dataset exists with the given
+        parent_properties and create the dataset with the given properties.
+        """
+        parent = os.path.split(dataset)[0]
+        if self.exists(parent):
+            self.set_properties(parent, **parent_properties)
+        else:
+            self._create_parent(parent, parent_properties)
+        self.create(dataset, **properties)
+
+    def _create_parent(self, parent, parent_properties):
+        try:
+            self.create(parent, **parent_properties)
+        except ZfsCommandError:
+            # Created concurrently by another operation.
+            if not self.exists(parent):
+                raise
+            self.set_properties(parent, **parent_properties)
+
+
+PROBE_PROGRAM: str = os.path.join(os.path.dirname(__file__), 'templates', 'probe-dataset.lua')
+
+
+def _probe_command(dataset, keys):
+    pool = dataset.split('/')[0]
+    return ['zfs', 'program', '-n', '-j', pool, PROBE_PROGRAM, dataset] + list(keys)
+
+
+def _parse_probe_output(output):
+    """Parse the output of the probe channel program and return the
+    properties of the probed dataset or None if it does not exist.
+    """
+    # Imported here to keep the import of this module cheap for the worker.
+    import json
+    result = json.loads(output)['return']
+    if not result['exists']:
+        return None
+    return {k:str(v) for k,v in result.get('properties', {}).items()}
+
+
+def _changed_properties(current, properties):
+    return {k:v for k,v in properties.items() if current.get(k, None) != str(v)}
+
+
+# Properties whose values are numbers when requested with `zfs get -p`.
+NUMERIC_PROPERTIES = frozenset((
+    'available', 'compressratio', 'copies', 'createtxg', 'creation',
+    'filesystem_count', 'filesystem_limit', 'guid', 'logicalreferenced',
+    'logicalused', 'objsetid', 'quota', 'recordsize', 'refcompressratio',
+    'referenced', 'refquota', 'refreservation', 'reservation',
+    'snapshot_count', 'snapshot_limit', 'used', 'usedbychildren',
+    'usedbydataset', 'usedbyrefreservation', 'usedbysnapshots', 'volblocksize',
+    'volsize', 'written',
+))
+
+
+def parse_property(key, value):
+    """Convert the value of the given property to a number if the property
+    is numeric. Numeric properties without a value are returned as None.
+    """
+    if key not in NUMERIC_PROPERTIES:
+        return value
+    if value in ('-', 'none', ''):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            # Ratios like compressratio.
+            return float(value.rstrip('x'))
+        except ValueError:
+            return value
+
+
+def _get_properties_many_command(datasets, keys, recursive=False, depth=None):
+    cmd = ['zfs', 'get', '-Hp', '-o', 'name,property,value']
+    if recursive:
+        cmd.append('-r')
+    if depth is not None:
+        cmd.extend(['-d', str(depth)])
+    cmd.append(','.join(keys) or 'all')
+    cmd.extend(datasets)
+    return cmd
+
+
+def _parse_line(line):
+    """Split a line of `zfs -H` output into its fields.
+    """
+    return line.decode('utf-8').rstrip('\n').split('\t')
+
+
+def _parse_get_properties_output(lines):
+    """Parse the output of `zfs get -Hp` for a single dataset
+    into a dict of its properties.
+    """
+    properties = {}
+    for line in lines:
+        parts = _parse_line(line)
+        properties[parts[1]] = parts[2]
+    return properties
+
+
+def _property_record(line):
+    name, key, value = _parse_line(line)
+    # Property names repeat for every dataset, share a single copy.
+    return Property(name, sys.intern(key), value)
+
+
+def _iter_output(cmd):
+    """Run the given command and yield the lines of its output as they
+    are produced, so the output never has to be held in memory at once.
+
+    Raise subprocess.CalledProcessError, with stderr as its `output`,
+    if the command fails.
+    """
+    # Imported here to keep the import of this module cheap for the worker.
+    import tempfile
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr)
+        finished = False
+        try:
+            for line in process.stdout:
+                yield line
+            finished = True
+        finally:
+            if not finished:
+                # The consumer stopped early.
+                process.kill()
+            process.stdout.close()
+            returncode = process.wait()
+        if returncode != 0:
+            stderr.seek(0)
+            raise subprocess.CalledProcessError(returncode, cmd, output=stderr.read())
+
+
+def _list_properties_command(dataset, keys, recursive=False):
+    cmd = ['zfs', 'list', '-Hp', '-o', ','.join(('name',) + tuple(keys))]
+    if recursive:
+        cmd.append('-r')
     cmd.append(dataset)
-    log.debug('zfs.create: %s', cmd)
+    return cmd
+
+
+def _parse_list_properties_output(lines, keys):
+    datasets = {}
+    for line in lines:
+        parts = _parse_line(line)
+        datasets[parts[0]] = dict(zip(keys, parts[1:]))
+    return datasets
+
+
+class CliBackend(Backend):
+    """Backend that runs the `zfs` command line tool.
+
+    If channel_program is True, `create_with_parent` inspects the parent
+    dataset with a single read-only channel program and only runs the
+    commands that are actually needed to bring it into the desired state.
+    """
+    name = 'cli'
+
+    def __init__(self, channel_program=False):
+        self.channel_program = channel_program
+
+    def exists(self, dataset):
+        cmd = ['zfs', 'list', '-Hp', dataset]
+        try:
+            subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        except subprocess.SubprocessError as e:
+            if e.output and b'dataset does not exist' in e.output:
+                return False
+            else:
+                raise ZfsCommandError(f'Failed to list dataset "{dataset}" running command: {cmd}') from e
+        return True
+
+    def create(self, dataset, *args, **properties):
+        cmd = ['zfs', 'create']
+        cmd.extend(args)
+        for k,v in properties.items():
+            cmd.extend(['-o', f'{k}={v}'])
+        cmd.append(dataset)
+        log.debug('zfs.create: %s', cmd)
+
+        try:
+            subprocess.check_call(cmd)
+        except subprocess.SubprocessError as e:
+            log.error(e)
+            raise ZfsCommandError(f'Failed to create dataset "{dataset}" running command: {cmd}') from e
+
+    def destroy(self, dataset, *args):
+        cmd = ['zfs', 'destroy']
+        cmd.extend(args)
+        cmd.append(dataset)
+        log.debug('zfs.destroy: %s', cmd)
+
+        try:
+            subprocess.check_call(cmd)
+        except subprocess.SubprocessError as e:
+            log.error(e)
+            raise ZfsCommandError(f'Failed to destroy dataset "{dataset}" running command: {cmd}') from e
+
+    def set_properties(self, dataset, **properties):
+        cmd = ['zfs', 'set']
+        for k,v in properties.items():
+            cmd.append(f'{k}={v}')
+        cmd.append(dataset)
+        log.debug('zfs.set_properties: %s', cmd)
+        try:
+            subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        except subprocess.SubprocessError as e:
+            raise ZfsCommandError(f'Failed to set properties on dataset "{dataset}" running command: {cmd}') from e
+
+    def get_properties(self, dataset, *keys):
+        cmd = ['zfs', 'get', '-Hp']
+        cmd.append(','.join(keys))
+        cmd.append(dataset)
+        log.debug('zfs.get_properties: %s', cmd)
+        try:
+            # Output of a single dataset is small, no need to stream it.
+            output = subprocess.check_output(cmd, stderr=subprocess.PIPE)
+            return _parse_get_properties_output(output.splitlines())
+        except subprocess.SubprocessError as e:
+            raise ZfsCommandError(f'Failed to get properties for dataset "{dataset}" running command: {cmd}') from e
+
+    def list(self, dataset, recursive=False):
+        return [name for name in self.iter_list(dataset, recursive=recursive)]
+
+    def iter_list(self, dataset, recursive=False):
+        cmd = ['zfs', 'list', '-Hp', '-o', 'name']
+        if recursive:
+            cmd.append('-r')
+        cmd.append(dataset)
+        log.debug('zfs.list: %s', cmd)
+        try:
+            for line in _iter_output(cmd):
+                yield line.decode('utf-8').rstrip('\n')
+        except subprocess.SubprocessError as e:
+            raise ZfsCommandError(f'Failed to list dataset "{dataset}" running command: {cmd}') from e
+
+    def list_properties(self, dataset, *keys, recursive=False):
+        cmd = _list_properties_command(dataset, keys, recursive=recursive)
+        log.debug('zfs.list_properties: %s', cmd)
+        try:
+            return _parse_list_properties_output(_iter_output(cmd), keys)
+        except subprocess.SubprocessError as e:
+            raise ZfsCommandError(f'Failed to list dataset "{dataset}" running command: {cmd}') from e
+
+    def iter_properties(self, datasets, *keys, recursive=False, depth=None):
+        cmd = _get_properties_many_command(datasets, keys, recursive=recursive, depth=depth)
+        log.debug('zfs.iter_properties: %s', cmd)
+        try:
+            for line in _iter_output(cmd):
+                yield _property_record(line)
+        except subprocess.SubprocessError as e:
+            raise ZfsCommandError(f'Failed to get properties for datasets {datasets} running command: {cmd}') from e
+
+    def probe(self, dataset, *keys):
+        """Return the given properties of the given dataset
+        or None if it does not exist.
+        """
+        cmd = _probe_command(dataset, keys)
+        log.debug('zfs.probe: %s', cmd)
+        try:
+            output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        except subprocess.SubprocessError as e:
+            raise ZfsCommandError(f'Failed to probe dataset "{dataset}" running command: {cmd}') from e
+        return _parse_probe_output(output)
+
+    def create_with_parent(self, dataset, parent_properties, **properties):
+        if not self.channel_program:
+            return super().create_with_parent(dataset, parent_properties, **properties)
+        parent = os.path.split(dataset)[0]
+        current = self.probe(parent, *parent_properties)
+        if current is None:
+            self._create_parent(parent, parent_properties)
+        else:
+            changed = _changed_properties(current, parent_properties)
+            if changed:
+                self.set_properties(parent, **changed)
+        self.create(dataset, **properties)
+
+
+class LibzfsCoreBackend(CliBackend):
+    """Backend that creates and destroys datasets in-process through pyzfs.
+
+    pyzfs does not implement getting and setting properties or listing
+    datasets yet (`lzc_get_props`, `lzc_set_prop` and `lzc_list_children`
+    raise NotImplementedError), so those run the `zfs` command line tool.
+    libzfs_core does not mount datasets, so mounting and unmounting is done
+    with the mount(2) and umount2(2) system calls.
+    """
+    name = 'libzfs_core'
+
+    def __init__(self):
+        super().__init__()
+        try:
+            import libzfs_core
+        except ImportError as e:
+            raise ZfsCommandError('The libzfs_core backend requires pyzfs to be installed') from e
+        import ctypes.util
+        self.lzc = libzfs_core
+        self.ctypes = ctypes
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+    @staticmethod
+    def _encode(value):
+        if isinstance(value, int):
+            return value
+        value = str(value)
+        if value.isdigit():
+            return int(value)
+        return value.encode('utf-8')
+
+    def _check_args(self, operation, args, supported=()):
+        unsupported = [arg for arg in args if arg not in supported]
+        if unsupported:
+            raise ZfsCommandError(f'Unsupported arguments for {operation}: {unsupported}')
+
+    def _mount(self, dataset, mountpoint):
+        os.makedirs(mountpoint, exist_ok=True)
+        if self.libc.mount(dataset.encode(), mountpoint.encode(), b'zfs', 0, b'zfsutil') != 0:
+            errno = self.ctypes.get_errno()
+            raise ZfsCommandError(f'Failed to mount dataset "{dataset}" on "{mountpoint}": {os.strerror(errno)}')
 
+    def _umount(self, dataset, mountpoint):
+        if self.libc.umount2(mountpoint.encode(), 0) != 0:
+            errno = self.ctypes.get_errno()
+            raise ZfsCommandError(f'Failed to unmount dataset "{dataset}" from "{mountpoint}": {os.strerror(errno)}')
+
+    def exists(self, dataset):
+        return self.lzc.lzc_exists(dataset.encode())
+
+    def create(self, dataset, *args, **properties):
+        self._check_args('create', args, supported=('-p',))
+        log.debug('zfs.create: lzc_create %s %s', dataset, properties)
+        if '-p' in args:
+            parent = os.path.split(dataset)[0]
+            if '/' in parent and not self.exists(parent):
+                self.create(parent, '-p')
+        props = {k.encode(): self._encode(v) for k,v in properties.items()}
+        try:
+            self.lzc.lzc_create(dataset.encode(), props=props)
+        except self.lzc.exceptions.ZFSError as e:
+            raise ZfsCommandError(f'Failed to create dataset "{dataset}": {e}') from e
+        mountpoint = properties.get('mountpoint', None)
+        if mountpoint and mountpoint not in ('legacy', 'none'):
+            self._mount(dataset, mountpoint)
+
+    def destroy(self, dataset, *args):
+        self._check_args('destroy', args)
+        log.debug('zfs.destroy: lzc_destroy %s', dataset)
+        mountpoint = self.get_properties(dataset, 'mountpoint').get('mountpoint', None)
+        if mountpoint and os.path.ismount(mountpoint):
+            self._umount(dataset, mountpoint)
+        try:
+            self.lzc.lzc_destroy(dataset.encode())
+        except self.lzc.exceptions.ZFSError as e:
+            raise ZfsCommandError(f'Failed to destroy dataset "{dataset}": {e}') from e
+
+
+
+class FakeBackend(Backend):
+    """In-memory backend for tests and benchmarks that need no real pool.
+
+    Delegates to a `fakezfs.Simulator`, which behaves like the `zfs` command
+    line tool including its error messages. Unless a simulator is given, one
+    is created from the FAKEZFS_* environment variables, see `fakezfs`.
+    """
+    name = 'fake'
+
+    def __init__(self, datasets=None, simulator=None):
+        from . import fakezfs
+        if simulator is None:
+            simulator = fakezfs.Simulator.from_environ()
+        for dataset in datasets or ():
+            pool = dataset.split('/')[0]
+            if pool not in simulator.pools:
+                simulator.add_pool(pool)
+            if dataset != pool:
+                simulator.create(dataset, parents=True)
+        self.simulator = simulator
+
+    def exists(self, dataset):
+        return self.simulator.exists(dataset)
+
+    def create(self, dataset, *args, **properties):
+        log.debug('zfs.create: fake %s %s %s', dataset, args, properties)
+        self.simulator.create(dataset, properties, parents='-p' in args)
+
+    def destroy(self, dataset, *args):
+        log.debug('zfs.destroy: fake %s %s', dataset, args)
+        self.simulator.destroy(dataset, recursive='-r' in args)
+
+    def set_properties(self, dataset, **properties):
+        self.simulator.set(dataset, properties)
+
+    def get_properties(self, dataset, *keys):
+        rows = self.simulator.get([dataset], keys or ('all',))
+        return {key:value for name,key,value,source in rows}
+
+    def list(self, dataset, recursive=False):
+        return [name for name, in self.simulator.list([dataset], recursive=recursive)]
+
+    def iter_properties(self, datasets, *keys, recursive=False, depth=None):
+        rows = self.simulator.get(list(datasets), keys or ('all',), recursive=recursive, depth=depth)
+        for name,key,value,source in rows:
+            yield Property(name, key, value)
+
+
+class Inventory():
+    """In-memory snapshot of the datasets below root and the values of
+    the given properties.
+
+    The snapshot is taken with a single recursive list and taken again once
+    it is older than ttl seconds. In between it is kept current by the
+    create, destroy and set operations of this module.
+    """
+
+    def __init__(self, root, keys=(), ttl=60):
+        self.root = root
+        self.keys = tuple(keys)
+        self.ttl = ttl
+        self.datasets = {}
+        self.timestamp = None
+
+    def covers(self, dataset):
+        return dataset == self.root or dataset.startswith(self.root + '/')
+
+    @property
+    def expired(self):
+        return self.timestamp is None or time.monotonic() - self.timestamp > self.ttl
+
+    def replace(self, datasets):
+        self.datasets = datasets
+        self.timestamp = time.monotonic()
+        log.debug('zfs.inventory: %s: %d datasets', self.root, len(datasets))
+
+    def invalidate(self):
+        self.timestamp = None
+
+    def lookup(self, dataset):
+        """Return the cached properties of the given dataset
+        or None if it does not exist.
+        """
+        return self.datasets.get(dataset, None)
+
+    def add(self, dataset, properties):
+        self.datasets[dataset] = {k:str(v) for k,v in properties.items() if k in self.keys}
+
+    def update(self, dataset, properties):
+        try:
+            current = self.datasets[dataset]
+        except KeyError:
+            return
+        current.update({k:str(v) for k,v in properties.items() if k in self.keys})
+
+    def remove(self, dataset):
+        prefix = dataset + '/'
+        for name in [name for name in self.datasets if name == dataset or name.startswith(prefix)]:
+            del self.datasets[name]
+
+
+# Inventories of the subtrees managed by the provisioner.
+INVENTORIES: List[Inventory] = []
+
+
+def enable_inventory(root, keys=('mountpoint', 'quota', 'refquota'), ttl=60):
+    """Cache the datasets below root and their given properties.
+    """
+    inventory = Inventory(root, keys=keys, ttl=ttl)
+    INVENTORIES.append(inventory)
+    return inventory
+
+
+def find_inventory(dataset):
+    """Return the inventory covering the given dataset or None.
+    """
+    for inventory in INVENTORIES:
+        if inventory.covers(dataset):
+            return inventory
+    return None
+
+
+def _get_inventory(dataset):
+    inventory = find_inventory(dataset)
+    if inventory is not None and inventory.expired:
+        try:
+            datasets = BACKEND.list_properties(inventory.root, *inventory.keys, recursive=True)
+        except ZfsCommandError:
+            if BACKEND.exists(inventory.root):
+                raise
+            datasets = {}
+        inventory.replace(datasets)
+    return inventory
+
+
+BACKENDS = {
+    backend.name: backend
+    for backend in (CliBackend, LibzfsCoreBackend, FakeBackend)
+}
+
+BACKEND: Backend = CliBackend()
+
+
+def set_backend(backend, **options):
+    """Set the backend used by the functions in this module.
+
+    `backend` is either the name of one of the BACKENDS, which is then
+    created with the given options, or a Backend instance.
+    """
+    global BACKEND
+    if isinstance(backend, str):
+        try:
+            backend = BACKENDS[backend](**options)
+        except KeyError:
+            raise ZfsCommandError(f'Unknown zfs backend: {backend}')
+    BACKEND = backend
+    log.debug('zfs.set_backend: %s', BACKEND.name)
+    return BACKEND
+
+
+@tracing.traced('zfs.exists')
+def exists(dataset):
+    """Return True if the given dataset exists.
+    """
+    return BACKEND.exists(dataset)
+
+
+@tracing.traced('zfs.create')
+def create(dataset, *args, **properties):
+    """Create the given dataset with the given properties.
+    """
+    properties = {k:v for k,v in properties.items() if v is not None}
+    inventory = find_inventory(dataset)
     try:
-        subprocess.check_call(cmd)
-    except subprocess.SubprocessError as e:
-        log.error(e)
-        raise ZfsCommandError(f'Failed to create dataset "{dataset}" running command: {cmd}') from e
+        BACKEND.create(dataset, *args, **properties)
+    except ZfsCommandError:
+        if inventory is not None:
+            inventory.invalidate()
+        raise
+    if inventory is not None:
+        inventory.add(dataset, properties)
 
 
+@tracing.traced('zfs.ensure')
 def ensure(dataset, *args, **properties):
     """Ensure the given dataset exists
     with the given properties.
     """
-    cmd = ['zfs', 'list', '-Hp', dataset]
-    try:
-        subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-    except subprocess.SubprocessError as e:
-        if e.output and b'dataset does not exist' in e.output:
+    inventory = _get_inventory(dataset)
+    if inventory is not None:
+        current = inventory.lookup(dataset)
+        if current is None:
             return create(dataset, *args, **properties)
-        else:
-            raise ZfsCommandError(f'Failed to list dataset "{dataset}" running command: {cmd}') from e
+        # Dataset exists, only set the properties that differ.
+        changed = _changed_properties(current, properties)
+        if changed:
+            set_properties(dataset, **changed)
+    elif not BACKEND.exists(dataset):
+        return create(dataset, *args, **properties)
     else:
         # Dataset exists, ensure properties are correct.
         set_properties(dataset, **properties)
 
 
+@tracing.traced('zfs.create_with_parent')
+def create_with_parent(dataset, parent_properties, **properties):
+    """Ensure the parent of the given dataset exists with the given
+    parent_properties and create the dataset with the given properties.
+    """
+    parent = os.path.split(dataset)[0]
+    if find_inventory(parent) is not None:
+        try:
+            ensure(parent, **parent_properties)
+        except ZfsCommandError:
+            # Created concurrently by another operation.
+            if not BACKEND.exists(parent):
+                raise
+            set_properties(parent, **parent_properties)
+        return create(dataset, **properties)
+    properties = {k:v for k,v in properties.items() if v is not None}
+    BACKEND.create_with_parent(dataset, parent_properties, **properties)
+    inventory = find_inventory(dataset)
+    if inventory is not None:
+        inventory.add(dataset, properties)
+
+
+@tracing.traced('zfs.destroy')
 def destroy(dataset, *args):
     """Destroy the given dataset.
     """
-    cmd = ['zfs', 'destroy']
-    cmd.extend(args)
-    cmd.append(dataset)
-    log.debug('zfs.destroy: %s', cmd)
-
+    inventory = find_inventory(dataset)
     try:
-        subprocess.check_call(cmd)
-    except subprocess.SubprocessError as e:
-        log.error(e)
-        raise ZfsCommandError(f'Failed to destroy dataset "{dataset}" running command: {cmd}') from e
+        BACKEND.destroy(dataset, *args)
+    except ZfsCommandError:
+        if inventory is not None:
+            inventory.invalidate()
+        raise
+    if inventory is not None:
+        inventory.remove(dataset)
 
 
+@tracing.traced('zfs.set_properties')
 def set_properties(dataset, **properties):
     """Set the given properties on the given dataset.
     """
-    cmd = ['zfs', 'set']
-    for k,v in properties.items():
-        cmd.append(f'{k}={v}')
-    cmd.append(dataset)
-    log.debug('zfs.set_properties: %s', cmd)
-    try:
-        subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-    except subprocess.SubprocessError as e:
-        raise ZfsCommandError(f'Failed to set properties on dataset "{dataset}" running command: {cmd}') from e
+    BACKEND.set_properties(dataset, **properties)
+    inventory = find_inventory(dataset)
+    if inventory is not None:
+        inventory.update(dataset, properties)
 
 
+@tracing.traced('zfs.get_properties')
 def get_properties(dataset, *keys):
     """Get the current properties of the given dataset.
+
+    Served from the inventory if it covers the dataset and the keys.
     """
-    cmd = ['zfs', 'get', '-Hp']
-    cmd.append(','.join(keys))
-    cmd.append(dataset)
-    log.debug('zfs.get_properties: %s', cmd)
-    try:
-        output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-    except subprocess.SubprocessError as e:
-        raise ZfsCommandError(f'Failed to get properties for dataset "{dataset}" running command: {cmd}') from e
+    if keys and find_inventory(dataset) is not None:
+        inventory = _get_inventory(dataset)
+        current = inventory.lookup(dataset)
+        if current is not None and all(k in current for k in keys):
+            return {k:current[k] for k in keys}
+    return BACKEND.get_properties(dataset, *keys)
 
-    output = output.decode('utf-8')
-    properties = {}
-    for line in output.split('\n'):
-        line = line.strip()
-        if line:
-            parts = line.split('\t')
-            properties[parts[1]] = parts[2]
-    return properties
+
+@tracing.traced('zfs.get_properties_many')
+def get_properties_many(datasets, *keys, recursive=False, depth=None):
+    """Get the given properties of many datasets at once.
+
+    Return a dict mapping the given datasets and, if recursive is True,
+    their descendants up to depth levels deep to a dict of their properties.
+    Values of numeric properties are converted to numbers.
+    """
+    result = {}
+    for record in iter_properties(datasets, *keys, recursive=recursive, depth=depth):
+        result.setdefault(record.name, {})[record.property] = record.value
+    return result
+
+
+def iter_properties(datasets, *keys, recursive=False, depth=None):
+    """Like `get_properties_many` but yield a Property record per
+    dataset and property while the output of zfs is being read.
+
+    Memory use is constant regardless of the number of datasets.
+    """
+    if isinstance(datasets, str):
+        datasets = [datasets]
+    if depth is not None:
+        recursive = True
+    for record in BACKEND.iter_properties(datasets, *keys, recursive=recursive, depth=depth):
+        yield Property(record.name, record.property, parse_property(record.property, record.value))
+
+
+@tracing.traced('zfs.list_datasets')
+def list_datasets(dataset, recursive=False):
+    """List the given dataset and optionally all its descendants.
+    """
+    return BACKEND.list(dataset, recursive=recursive)
+
+
+def iter_datasets(dataset, recursive=False):
+    """Like `list_datasets` but yield the names while the
+    output of zfs is being read.
+    """
+    return BACKEND.iter_list(dataset, recursive=recursive)